@@ -1,4 +1,7 @@
 import argparse
+import logging
+import os
+import sys
 
 import gradio as gr
 from peft import AutoPeftModelForCausalLM, PeftModel
@@ -9,6 +12,22 @@ from threading import Thread
 from langchain.vectorstores.pgvector import PGVector
 from langchain.embeddings.sentence_transformer import SentenceTransformerEmbeddings
 
+# reuse the vector db helpers from the 1-vectordb lab
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../1-vectordb/scripts")
+)
+from bm25_index import BM25Index
+from db_config import CONNECTION_STRING
+from devices import default_device
+from embedding_cache import with_embedding_cache
+from hybrid_search import HybridSearch
+from local_store import LocalVectorStore
+from query_cache import CachedPGVector, CollectionVersion, LRUEmbeddings, SemanticCache
+from reduction import with_collection_reducer
+from reranker import DEFAULT_RERANKER, CrossEncoderReranker, RerankedSearch
+
+# cache and latency stats per question, shown with logging at DEBUG level
+logger = logging.getLogger(__name__)
 
 parser = argparse.ArgumentParser()
 parser.add_argument(
@@ -27,6 +46,87 @@ parser.add_argument(
     help="Path to the saved lora adapter",
 )
 
+parser.add_argument(
+    "--embedding_cache_dir",
+    type=str,
+    default=None,
+    required=False,
+    help="Directory of the on-disk embedding cache, disabled if not set",
+)
+
+parser.add_argument(
+    "--query_cache_size",
+    type=int,
+    default=0,
+    required=False,
+    help="Questions whose embeddings and search results are cached, 0 disables",
+)
+
+parser.add_argument(
+    "--local_store",
+    type=str,
+    default=None,
+    required=False,
+    help="Search the in-process store in this directory instead of Postgres",
+)
+
+parser.add_argument(
+    "--bm25_index",
+    type=str,
+    default=None,
+    required=False,
+    help="BM25 index built by embed_documents.py, fused with the vector search",
+)
+
+parser.add_argument(
+    "--rerank",
+    nargs="?",
+    const=DEFAULT_RERANKER,
+    default=None,
+    required=False,
+    help=f"Cross-encoder reranking retrieved documents, {DEFAULT_RERANKER} by default",
+)
+
+parser.add_argument(
+    "--rerank_candidates",
+    type=int,
+    default=20,
+    required=False,
+    help="Documents retrieved and rescored with --rerank",
+)
+
+parser.add_argument(
+    "--max_rerank_ms",
+    type=float,
+    default=None,
+    required=False,
+    help="Time --rerank may take before keeping the vector order, unlimited if not set",
+)
+
+parser.add_argument(
+    "--answer_cache_size",
+    type=int,
+    default=0,
+    required=False,
+    help="Answers reused for paraphrases of their question, 0 disables",
+)
+
+parser.add_argument(
+    "--answer_cache_threshold",
+    type=float,
+    default=0.95,
+    required=False,
+    help="Cosine similarity from which a question gets a cached answer",
+)
+
+parser.add_argument(
+    "--answer_cache_ttl",
+    type=float,
+    default=None,
+    required=False,
+    help="Seconds a cached answer is kept, forever if not set",
+)
+
 args = parser.parse_args()
 
 if args.lora_path:
@@ -51,29 +151,76 @@ else:
     )
     tokenizer = AutoTokenizer.from_pretrained(args.model_path_or_id)
 
-# The connection to the database
-CONNECTION_STRING = PGVector.connection_string_from_db_params(
-    driver= "psycopg2",
-    host = "localhost",
-    port = "5432",
-    database = "postgres",
-    user= "username",
-    password="password"
-)
-
 # The embedding function that will be used to store into the database
 embedding_function = SentenceTransformerEmbeddings(
     model_name="BAAI/bge-large-en-v1.5",
-    model_kwargs = {'device': 'cuda'},
+    model_kwargs = {'device': default_device()},
     encode_kwargs = {'normalize_embeddings': True}
 )
+embedding_function = with_embedding_cache(embedding_function, args.embedding_cache_dir)
+collection_version = None
+if args.local_store is None:
+    # project queries like the stored embeddings, if they were reduced, with
+    # the reducer read again whenever the collection is rebuilt
+    collection_version = CollectionVersion(CONNECTION_STRING, "embeddings").current
+    embedding_function = with_collection_reducer(
+        embedding_function, CONNECTION_STRING, version = collection_version
+    )
+if args.answer_cache_size:
+    # the answer cache and the search embed the same question, the second
+    # time is a lookup
+    embedding_function = LRUEmbeddings(
+        embedding_function, max_size = 1000, version = collection_version
+    )
 
 # Creates the database connection to our existing DB
-db = PGVector(
-    connection_string = CONNECTION_STRING,
-    collection_name = "embeddings",
-    embedding_function = embedding_function
-)
+if args.local_store is not None:
+    # searched in-process, no database involved
+    db = LocalVectorStore(args.local_store, embedding_function)
+elif args.query_cache_size:
+    # repeated questions skip the model and the table scan
+    db = CachedPGVector(
+        connection_string = CONNECTION_STRING,
+        collection_name = "embeddings",
+        embedding_function = embedding_function,
+        max_results = args.query_cache_size,
+        max_embeddings = args.query_cache_size
+    )
+else:
+    db = PGVector(
+        connection_string = CONNECTION_STRING,
+        collection_name = "embeddings",
+        embedding_function = embedding_function
+    )
+
+vectorstore = db
+if args.bm25_index is not None:
+    # exact table names and acronyms are found without raising k
+    db = HybridSearch(vectorstore, BM25Index(args.bm25_index))
+if args.rerank is not None:
+    # over-fetch and keep the chunk the cross-encoder ranks best, scored on
+    # CPU to leave the GPU to the LLM
+    db = RerankedSearch(
+        db,
+        CrossEncoderReranker(args.rerank, device = "cpu"),
+        candidates = args.rerank_candidates,
+        max_rerank_ms = args.max_rerank_ms
+    )
+
+answer_cache = None
+if args.answer_cache_size:
+    # paraphrases of an answered question skip retrieval and generation, and
+    # answers are dropped once the documents change
+    if args.local_store is not None:
+        version = vectorstore.version
+    else:
+        version = collection_version
+    answer_cache = SemanticCache(
+        threshold = args.answer_cache_threshold,
+        max_size = args.answer_cache_size,
+        ttl = args.answer_cache_ttl,
+        version = version
+    )
 
 with gr.Blocks() as demo:
     gr.HTML(
@@ -107,7 +254,22 @@ with gr.Blocks() as demo:
         # Format the instruction using the format string with key
         # {instruction}
 
+        if answer_cache is not None:
+            # an answer only serves the settings it was generated with
+            cache_key = (prompt_format, max_new_tokens, temperature)
+            embedding = embedding_function.embed_query(chat_history[-1][0])
+            cached = answer_cache.get(embedding, cache_key)
+            logger.debug("answer cache: %s", answer_cache.stats())
+            if cached is not None:
+                chat_history[-1][1] = cached[0]["answer"]
+                yield chat_history
+                return
+
         docs_with_scores = db.similarity_search_with_score(chat_history[-1][0], k = 1)
+        if isinstance(vectorstore, CachedPGVector):
+            logger.debug("query cache: %s", vectorstore.cache_stats())
+        if isinstance(db, (HybridSearch, RerankedSearch)):
+            logger.debug("retrieval latency: %s", db.stats())
         formatted_inst = prompt_format.format(
             context = docs_with_scores[0][0].page_content,
             question = chat_history[-1][0]
@@ -138,6 +300,18 @@ with gr.Blocks() as demo:
             chat_history[-1][1] += new_text
             yield chat_history
 
+        if answer_cache is not None:
+            answer_cache.put(
+                embedding,
+                {
+                    "answer": chat_history[-1][1],
+                    "sources": [
+                        (doc.page_content, doc.metadata) for doc, _ in docs_with_scores
+                    ],
+                },
+                cache_key
+            )
+
     msg.submit(user, [msg, chat_history], [msg, chat_history], queue=False).then(
         bot, [chat_history, prompt_format, max_new_tokens, temperature], chat_history
     )
@@ -0,0 +1,424 @@
+import glob
+import json
+import os
+import random
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+from langchain.document_loaders import PyPDFLoader
+from langchain.embeddings.sentence_transformer import SentenceTransformerEmbeddings
+from langchain.text_splitter import CharacterTextSplitter
+from langchain_core.documents import Document
+
+from bm25_index import BM25Index
+from chunking import SENTENCE_BOUNDARY, TokenBudgetSplitter
+from devices import resolve_device
+from hybrid_search import HybridSearch
+from local_store import LocalVectorStore
+
+# the small sentence-transformers model shipped with the RAG lab, so that a
+# benchmark runs offline
+DEFAULT_MODEL = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "../../2-rag-prompt-engineering/all-MiniLM-L6-v2",
+)
+
+# Dolly categories whose instruction is a question about their context, as in
+# finetuning.py
+DOLLY_CATEGORIES = ("closed_qa", "information_extraction")
+
+# metrics where a lower value is better, when comparing to a baseline
+LOWER_IS_BETTER = ("p50_ms", "p95_ms", "p99_ms", "index_seconds")
+
+
+def _normalize(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+def sentence_queries(
+    doc_dir: str,
+    n_queries: int = 200,
+    min_words: int = 8,
+    max_words: int = 40,
+    seed: int = 0,
+) -> Dict:
+    """A labelled query set from the PDFs of a directory.
+
+    Each query is a sentence sampled from a page, and the chunks relevant to
+    it are those containing that sentence (an inverse cloze probe), so the
+    labels hold whatever the chunking being benchmarked.
+
+    :param doc_dir: directory of PDFs
+    :type doc_dir: str
+    :param n_queries: number of queries
+    :type n_queries: int, optional
+    :param min_words: shortest sentence used as a query
+    :type min_words: int, optional
+    :param max_words: longest sentence used as a query
+    :type max_words: int, optional
+    :param seed: seed of the sampling
+    :type seed: int, optional
+    :return: {"documents": [...], "queries": [...]}
+    :rtype: Dict
+    """
+    pages = []
+    for path in sorted(glob.glob(f"{doc_dir}/*.pdf")):
+        pages += PyPDFLoader(path).load()
+
+    sentences = []
+    for page in pages:
+        for sentence in SENTENCE_BOUNDARY.split(page.page_content):
+            if min_words <= len(sentence.split()) <= max_words:
+                sentences.append(" ".join(sentence.split()))
+    sentences = sorted(set(sentences))
+    random.Random(seed).shuffle(sentences)
+
+    return {
+        "documents": [
+            {"page_content": page.page_content, "metadata": page.metadata}
+            for page in pages
+        ],
+        "queries": [
+            {"id": i, "query": sentence, "evidence": sentence}
+            for i, sentence in enumerate(sentences[:n_queries])
+        ],
+    }
+
+
+def dolly_queries(
+    n_queries: int = 200, dolly_file: Optional[str] = None, seed: int = 0
+) -> Dict:
+    """A labelled query set from databricks-dolly-15k.
+
+    The corpus is the `context` of every closed QA and information
+    extraction row, and each sampled `instruction` is a query whose relevant
+    chunks are those of its own context.
+
+    :param n_queries: number of queries
+    :type n_queries: int, optional
+    :param dolly_file: local copy of databricks-dolly-15k.jsonl, read from the
+        datasets cache if not set
+    :type dolly_file: Optional[str], optional
+    :param seed: seed of the sampling
+    :type seed: int, optional
+    :return: {"documents": [...], "queries": [...]}
+    :rtype: Dict
+    """
+    if dolly_file is not None:
+        with open(dolly_file) as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+    else:
+        from datasets import load_dataset
+
+        rows = list(load_dataset("databricks/databricks-dolly-15k", split="train"))
+    rows = [
+        row
+        for row in rows
+        if row["category"] in DOLLY_CATEGORIES and row["context"].strip()
+    ]
+
+    contexts = sorted({" ".join(row["context"].split()) for row in rows})
+    sample = random.Random(seed).sample(rows, min(n_queries, len(rows)))
+    return {
+        "documents": [
+            {"page_content": context, "metadata": {"source": f"dolly-{i}"}}
+            for i, context in enumerate(contexts)
+        ],
+        "queries": [
+            {
+                "id": i,
+                "query": row["instruction"],
+                "evidence": " ".join(row["context"].split()),
+            }
+            for i, row in enumerate(sample)
+        ],
+    }
+
+
+def is_relevant(chunk: str, evidence: str) -> bool:
+    """Whether a chunk holds the evidence of a query, or is part of it when
+    the evidence (a Dolly context) was split across chunks."""
+    chunk, evidence = _normalize(chunk), _normalize(evidence)
+    return evidence in chunk or chunk in evidence
+
+
+def get_splitter(
+    chunker: str,
+    model_name: str,
+    chunk_tokens: Optional[int] = None,
+    overlap_tokens: int = 0,
+):
+    """The splitter of a benchmark run, None to index documents whole."""
+    if chunker == "none":
+        return None
+    if chunker == "character":
+        return CharacterTextSplitter(chunk_size=1000, chunk_overlap=0)
+    # budgeted in the benchmarked model's own tokens
+    return TokenBudgetSplitter(
+        model_name, max_tokens=chunk_tokens, overlap_tokens=overlap_tokens
+    )
+
+
+def run_benchmark(
+    query_set: Dict,
+    k: List[int],
+    model_name: str = DEFAULT_MODEL,
+    device: Optional[str] = None,
+    chunker: str = "token",
+    chunk_tokens: Optional[int] = None,
+    overlap_tokens: int = 0,
+    store_dir: Optional[str] = None,
+    hnsw: bool = False,
+    ef_search: int = 64,
+    hybrid: bool = False,
+) -> Dict:
+    """Index the documents of a query set in a local store and search every
+    query, one at a time.
+
+    :param query_set: from `sentence_queries` or `dolly_queries`
+    :type query_set: Dict
+    :param k: cutoffs of recall@k, the largest one is retrieved
+    :type k: List[int]
+    :param model_name: sentence-transformers model to embed with
+    :type model_name: str, optional
+    :param device: device to embed on, autodetected by default
+    :type device: Optional[str], optional
+    :param chunker: "token", "character" or "none"
+    :type chunker: str, optional
+    :param chunk_tokens: token budget of a chunk with the "token" chunker
+    :type chunk_tokens: Optional[int], optional
+    :param overlap_tokens: tokens shared by consecutive chunks
+    :type overlap_tokens: int, optional
+    :param store_dir: directory of the store, a temporary one by default
+    :type store_dir: Optional[str], optional
+    :param hnsw: search an HNSW graph instead of scanning exactly
+    :type hnsw: bool, optional
+    :param ef_search: candidate list size of the HNSW search
+    :type ef_search: int, optional
+    :param hybrid: fuse BM25 results with the vector ones
+    :type hybrid: bool, optional
+    :return: recall@k, MRR, latency percentiles, QPS and indexing cost
+    :rtype: Dict
+    """
+    store_dir = store_dir or tempfile.mkdtemp(prefix="retrieval-benchmark-")
+    documents = [Document(**doc) for doc in query_set["documents"]]
+    splitter = get_splitter(chunker, model_name, chunk_tokens, overlap_tokens)
+    chunks = splitter.split_documents(documents) if splitter else documents
+
+    embedding_function = SentenceTransformerEmbeddings(
+        model_name=model_name,
+        model_kwargs={"device": resolve_device(device)},
+        encode_kwargs={"normalize_embeddings": True},
+    )
+
+    start = time.perf_counter()
+    db = LocalVectorStore(
+        store_dir,
+        embedding_function,
+        pre_delete_collection=True,
+        hnsw=hnsw,
+        ef_search=ef_search,
+    )
+    db.add_documents(chunks)
+    db.persist()
+    if hybrid:
+        index = BM25Index(os.path.join(store_dir, "bm25.sqlite"), pre_delete=True)
+        index.add(chunks)
+        db = HybridSearch(db, index)
+    index_seconds = time.perf_counter() - start
+
+    max_k = max(k)
+    # the first call through the model is much slower than the next ones
+    db.similarity_search_with_score("warmup", k=max_k)
+
+    latencies, ranks = [], []
+    for query in query_set["queries"]:
+        start = time.perf_counter()
+        results = db.similarity_search_with_score(query["query"], k=max_k)
+        latencies.append(time.perf_counter() - start)
+        rank = next(
+            (
+                i
+                for i, (doc, _) in enumerate(results, 1)
+                if is_relevant(doc.page_content, query["evidence"])
+            ),
+            None,
+        )
+        ranks.append(rank)
+
+    n_queries = len(ranks)
+    p50, p95, p99 = np.percentile(np.array(latencies) * 1000, [50, 95, 99])
+    report = {
+        "config": {
+            "model": os.path.basename(os.path.normpath(model_name)),
+            "chunker": chunker,
+            "chunk_tokens": chunk_tokens,
+            "overlap_tokens": overlap_tokens,
+            "hnsw": hnsw,
+            "ef_search": ef_search if hnsw else None,
+            "hybrid": hybrid,
+        },
+        "n_documents": len(documents),
+        "n_chunks": len(chunks),
+        "n_queries": n_queries,
+        "index_seconds": index_seconds,
+    }
+    for cutoff in sorted(k):
+        hits = sum(1 for rank in ranks if rank is not None and rank <= cutoff)
+        report[f"recall@{cutoff}"] = hits / n_queries
+    report[f"mrr@{max_k}"] = sum(1 / rank for rank in ranks if rank) / n_queries
+    report["p50_ms"], report["p95_ms"], report["p99_ms"] = p50, p95, p99
+    report["qps"] = n_queries / sum(latencies)
+    return report
+
+
+def print_report(report: Dict, baseline: Optional[Dict] = None) -> None:
+    """Print the metrics of a run, next to those of a baseline if given."""
+    print(
+        f"{report['n_queries']} queries over {report['n_chunks']} chunks "
+        f"of {report['n_documents']} documents, {report['config']}"
+    )
+    metrics = [key for key, value in report.items() if isinstance(value, float)]
+    if baseline is None:
+        for metric in metrics:
+            print(f"{metric:<16}{report[metric]:>12.4f}")
+        return
+
+    if baseline.get("config") != report["config"]:
+        print(f"baseline: {baseline.get('config')}")
+    print(f"{'metric':<16}{'baseline':>12}{'current':>12}{'change':>12}")
+    for metric in metrics:
+        if metric not in baseline:
+            continue
+        change = report[metric] - baseline[metric]
+        worse = change > 0 if metric in LOWER_IS_BETTER else change < 0
+        print(
+            f"{metric:<16}{baseline[metric]:>12.4f}{report[metric]:>12.4f}"
+            f"{change:>+12.4f}{'  worse' if worse and change else ''}"
+        )
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "command",
+        choices=["build", "run"],
+        help="build a labelled query set, or benchmark retrieval on one",
+    )
+    parser.add_argument(
+        "--queries",
+        type=str,
+        required=True,
+        help="JSON query set, written by build and read by run",
+    )
+    parser.add_argument(
+        "--source",
+        type=str,
+        default="dolly",
+        choices=["dolly", "docs"],
+        help="build from Dolly contexts and instructions, or sentences of PDFs",
+    )
+    parser.add_argument(
+        "--doc_dir", type=str, default=None, help="PDFs to build queries from"
+    )
+    parser.add_argument(
+        "--dolly_file",
+        type=str,
+        default=None,
+        help="local databricks-dolly-15k.jsonl, the datasets cache if not set",
+    )
+    parser.add_argument(
+        "--n_queries", type=int, default=200, help="queries in the built set"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="sampling seed")
+    parser.add_argument(
+        "--k", type=int, nargs="+", default=[1, 5, 10], help="recall@k cutoffs"
+    )
+    parser.add_argument(
+        "--model",
+        type=str,
+        default=DEFAULT_MODEL,
+        help="sentence-transformers model, the bundled all-MiniLM-L6-v2 by default",
+    )
+    parser.add_argument(
+        "--device", type=str, default=None, help="device, autodetected by default"
+    )
+    parser.add_argument(
+        "--chunker",
+        type=str,
+        default="token",
+        choices=["token", "character", "none"],
+        help="how documents are chunked before indexing",
+    )
+    parser.add_argument(
+        "--chunk_tokens", type=int, default=None, help="token budget of a chunk"
+    )
+    parser.add_argument(
+        "--chunk_overlap_tokens",
+        type=int,
+        default=0,
+        help="tokens shared by consecutive chunks",
+    )
+    parser.add_argument(
+        "--store_dir",
+        type=str,
+        default=None,
+        help="directory of the local store, a temporary one if not set",
+    )
+    parser.add_argument("--hnsw", action="store_true", help="search an HNSW graph")
+    parser.add_argument(
+        "--ef_search", type=int, default=64, help="HNSW candidate list size"
+    )
+    parser.add_argument(
+        "--hybrid", action="store_true", help="fuse BM25 and vector results"
+    )
+    parser.add_argument(
+        "--output", type=str, default=None, help="JSON file to save the report to"
+    )
+    parser.add_argument(
+        "--baseline", type=str, default=None, help="JSON report to compare to"
+    )
+
+    args = parser.parse_args()
+
+    if args.command == "build":
+        if args.source == "docs":
+            if args.doc_dir is None:
+                parser.error("--source docs needs a --doc_dir")
+            query_set = sentence_queries(args.doc_dir, args.n_queries, seed=args.seed)
+        else:
+            query_set = dolly_queries(args.n_queries, args.dolly_file, args.seed)
+        with open(args.queries, "w") as f:
+            json.dump(query_set, f)
+        print(
+            f"Wrote {len(query_set['queries'])} queries over "
+            f"{len(query_set['documents'])} documents to {args.queries}."
+        )
+    else:
+        with open(args.queries) as f:
+            query_set = json.load(f)
+        report = run_benchmark(
+            query_set,
+            args.k,
+            model_name=args.model,
+            device=args.device,
+            chunker=args.chunker,
+            chunk_tokens=args.chunk_tokens,
+            overlap_tokens=args.chunk_overlap_tokens,
+            store_dir=args.store_dir,
+            hnsw=args.hnsw,
+            ef_search=args.ef_search,
+            hybrid=args.hybrid,
+        )
+        baseline = None
+        if args.baseline is not None:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        print_report(report, baseline)
+        if args.output is not None:
+            with open(args.output, "w") as f:
+                json.dump(report, f, indent=2)
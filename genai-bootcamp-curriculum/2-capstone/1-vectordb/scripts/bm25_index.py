@@ -0,0 +1,320 @@
+import heapq
+import json
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter, defaultdict
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+
+from manifest import chunk_id, metadata_json
+from metadata_filter import matches
+
+WORD = re.compile(r"[A-Za-z0-9]+")
+# the parts of a camelCase or PascalCase identifier, e.g. Column|Acronyms
+CAMEL_PARTS = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|[0-9]+")
+
+# frequent words that would only make the posting lists long
+STOPWORDS = frozenset(
+    "a an and are as at be by for from has have in is it its of on or that the "
+    "this to was were what when where which who will with".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased terms of a text, without stopwords.
+
+    Identifiers are kept whole and also split into their camelCase parts, so
+    `ColumnAcronyms` matches a query for "ColumnAcronyms" best, and one for
+    "column acronyms" too.
+
+    :param text: text to tokenize
+    :type text: str
+    :return: terms, repeated as often as they occur
+    :rtype: List[str]
+    """
+    terms = []
+    for word in WORD.findall(text):
+        terms.append(word.lower())
+        parts = CAMEL_PARTS.findall(word)
+        if len(parts) > 1:
+            terms.extend(part.lower() for part in parts)
+    return [term for term in terms if term not in STOPWORDS]
+
+
+@lru_cache(maxsize=64)
+def _parse_filter(filter: str) -> Dict:
+    return json.loads(filter)
+
+
+def _metadata_matches(metadata: Optional[str], filter: str) -> int:
+    # sqlite function evaluating a json filter on a chunk's metadata
+    return int(matches(json.loads(metadata or "{}"), _parse_filter(filter)))
+
+
+class BM25Index:
+    """An inverted index of chunks, searched by Okapi BM25.
+
+    Dense embeddings blur rare exact tokens such as table names and
+    acronyms, which lexical search matches exactly. The index is a sqlite
+    file of posting lists (term -> chunk, term frequency) built alongside
+    the vectors by `embed_documents.py --bm25_index`, with the chunks' text
+    and metadata, so a search is one indexed lookup per query term.
+
+    :param path: sqlite file of the index
+    :type path: str
+    :param pre_delete: start the index over
+    :type pre_delete: bool, optional
+    :param k1: term frequency saturation
+    :type k1: float, optional
+    :param b: document length normalization
+    :type b: float, optional
+    """
+
+    def __init__(
+        self, path: str, pre_delete: bool = False, k1: float = 1.2, b: float = 0.75
+    ):
+        self.path = path
+        self.k1, self.b = k1, b
+        if pre_delete and os.path.exists(path):
+            os.remove(path)
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.n_added = 0
+        self.build_seconds = 0.0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._db.create_function(
+            "metadata_matches", 2, _metadata_matches, deterministic=True
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS chunks (row INTEGER PRIMARY KEY, "
+            "id TEXT UNIQUE NOT NULL, document TEXT NOT NULL, cmetadata TEXT, "
+            "length INTEGER NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS postings (term TEXT NOT NULL, "
+            "row INTEGER NOT NULL, tf INTEGER NOT NULL, PRIMARY KEY (term, row)) "
+            "WITHOUT ROWID"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS postings_row ON postings (row)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS stats (key TEXT PRIMARY KEY, value INTEGER)"
+        )
+        self._db.execute(
+            "INSERT OR IGNORE INTO stats VALUES ('n_chunks', 0), ('total_length', 0)"
+        )
+
+    def _delete(self, ids: List[str]) -> None:
+        for i in range(0, len(ids), 500):
+            part = ids[i : i + 500]
+            placeholders = ",".join("?" * len(part))
+            rows = self._db.execute(
+                f"SELECT row, length FROM chunks WHERE id IN ({placeholders})", part
+            ).fetchall()
+            if not rows:
+                continue
+            self._db.executemany(
+                "DELETE FROM postings WHERE row = ?", [(row,) for row, _ in rows]
+            )
+            self._db.executemany(
+                "DELETE FROM chunks WHERE row = ?", [(row,) for row, _ in rows]
+            )
+            self._update_stats(-len(rows), -sum(length for _, length in rows))
+
+    def _update_stats(self, n_chunks: int, total_length: int) -> None:
+        self._db.executemany(
+            "UPDATE stats SET value = value + ? WHERE key = ?",
+            [(n_chunks, "n_chunks"), (total_length, "total_length")],
+        )
+
+    def add(self, chunks: List[Document], ids: Optional[List[str]] = None) -> None:
+        """Index chunks, replacing any chunk indexed with the same id.
+
+        :param chunks: chunks to index
+        :type chunks: List[Document]
+        :param ids: their ids, defaults to their `chunk_id`
+        :type ids: Optional[List[str]], optional
+        """
+        start = time.perf_counter()
+        ids = ids or [chunk_id(chunk) for chunk in chunks]
+        # a chunk repeated within the batch is indexed once
+        chunks_by_id = dict(zip(ids, chunks))
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._delete(list(chunks_by_id))
+                next_row = self._db.execute(
+                    "SELECT coalesce(max(row) + 1, 0) FROM chunks"
+                ).fetchone()[0]
+                chunk_rows, postings, total_length = [], [], 0
+                for row, (id_, chunk) in enumerate(chunks_by_id.items(), next_row):
+                    terms = Counter(tokenize(chunk.page_content))
+                    length = sum(terms.values())
+                    total_length += length
+                    chunk_rows.append(
+                        (
+                            row,
+                            id_,
+                            chunk.page_content,
+                            metadata_json(chunk.metadata),
+                            length,
+                        )
+                    )
+                    postings += [(term, row, tf) for term, tf in terms.items()]
+                self._db.executemany(
+                    "INSERT INTO chunks VALUES (?, ?, ?, ?, ?)", chunk_rows
+                )
+                self._db.executemany("INSERT INTO postings VALUES (?, ?, ?)", postings)
+                self._update_stats(len(chunk_rows), total_length)
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        self.n_added += len(chunks_by_id)
+        self.build_seconds += time.perf_counter() - start
+
+    def delete(self, ids: List[str]) -> None:
+        """Remove chunks from the index by id."""
+        with self._lock:
+            self._db.execute("BEGIN")
+            self._delete(ids)
+            self._db.execute("COMMIT")
+
+    def search(
+        self, query: str, k: int = 4, filter: Optional[Dict] = None
+    ) -> List[Tuple[Document, float]]:
+        """The `k` chunks with the highest BM25 score for `query`.
+
+        A metadata filter is applied in the query on the postings, so the
+        `k` best matching chunks are returned however few chunks match.
+        Term statistics stay those of the whole index, so a chunk scores the
+        same with or without a filter.
+
+        :param query: search text
+        :type query: str
+        :param k: number of chunks to return
+        :type k: int, optional
+        :param filter: metadata filter, see `metadata_filter`
+        :type filter: Optional[Dict], optional
+        :return: (chunk, score) pairs, best first; chunks sharing no term
+            with the query are never returned
+        :rtype: List[Tuple[Document, float]]
+        """
+        terms = sorted(set(tokenize(query)))
+        if not terms:
+            return []
+        placeholders = ",".join("?" * len(terms))
+        where, params = f"p.term IN ({placeholders})", list(terms)
+        if filter:
+            where += " AND metadata_matches(c.cmetadata, ?)"
+            params.append(json.dumps(filter, sort_keys=True))
+        with self._lock:
+            stats = dict(self._db.execute("SELECT key, value FROM stats"))
+            n_chunks = stats["n_chunks"]
+            if not n_chunks:
+                return []
+            avg_length = stats["total_length"] / n_chunks
+            df = dict(
+                self._db.execute(
+                    "SELECT term, count(*) FROM postings "
+                    f"WHERE term IN ({placeholders}) GROUP BY term",
+                    terms,
+                )
+            )
+            postings = self._db.execute(
+                "SELECT p.term, p.row, p.tf, c.length FROM postings AS p "
+                f"JOIN chunks AS c ON c.row = p.row WHERE {where}",
+                params,
+            ).fetchall()
+
+            scores = defaultdict(float)
+            for term, row, tf, length in postings:
+                idf = math.log(1 + (n_chunks - df[term] + 0.5) / (df[term] + 0.5))
+                norm = self.k1 * (1 - self.b + self.b * length / avg_length)
+                scores[row] += idf * tf * (self.k1 + 1) / (tf + norm)
+            best = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+            rows = [row for row, _ in best]
+            documents = {}
+            if rows:
+                placeholders = ",".join("?" * len(rows))
+                for row, document, metadata in self._db.execute(
+                    "SELECT row, document, cmetadata FROM chunks "
+                    f"WHERE row IN ({placeholders})",
+                    rows,
+                ):
+                    documents[row] = Document(
+                        page_content=document, metadata=json.loads(metadata or "{}")
+                    )
+        return [(documents[row], score) for row, score in best]
+
+    def __len__(self) -> int:
+        return self._db.execute(
+            "SELECT value FROM stats WHERE key = 'n_chunks'"
+        ).fetchone()[0]
+
+    def close(self) -> None:
+        self._db.close()
+
+
+def bench(index_path: str, queries: List[str], n_queries: int, k: int) -> Dict:
+    """Time BM25 searches on their own, without the dense retrieval.
+
+    :param index_path: sqlite file of the index
+    :type index_path: str
+    :param queries: queries, repeated in turn
+    :type queries: List[str]
+    :param n_queries: number of searches
+    :type n_queries: int
+    :param k: results per search
+    :type k: int
+    :return: chunks indexed, p50/p99 latency in ms and queries per second
+    :rtype: Dict
+    """
+    index = BM25Index(index_path)
+    latencies = []
+    for i in range(n_queries):
+        start = time.perf_counter()
+        index.search(queries[i % len(queries)], k)
+        latencies.append(time.perf_counter() - start)
+    p50, p99 = np.percentile(np.array(latencies) * 1000, [50, 99])
+    return {
+        "n_chunks": len(index),
+        "p50_ms": p50,
+        "p99_ms": p99,
+        "qps": n_queries / sum(latencies),
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--index", type=str, required=True, help="sqlite file of the BM25 index"
+    )
+    parser.add_argument(
+        "--query",
+        type=str,
+        nargs="+",
+        default=["What does ColumnAcronyms contain?"],
+        help="queries to time",
+    )
+    parser.add_argument("--n_queries", type=int, default=1000, help="searches run")
+    parser.add_argument("--k", type=int, default=20, help="results per search")
+
+    args = parser.parse_args()
+
+    stats = bench(args.index, args.query, args.n_queries, args.k)
+    print(
+        f"BM25 over {stats['n_chunks']} chunks: p50 {stats['p50_ms']:.2f}ms, "
+        f"p99 {stats['p99_ms']:.2f}ms, {stats['qps']:.0f} queries/s"
+    )
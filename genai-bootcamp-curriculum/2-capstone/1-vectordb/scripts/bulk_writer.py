@@ -0,0 +1,252 @@
+import io
+import re
+import struct
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import psycopg2
+
+from db_config import psycopg2_dsn
+from manifest import metadata_json
+
+EMBEDDING_TABLE = "langchain_pg_embedding"
+COLLECTION_TABLE = "langchain_pg_collection"
+# definitions of the indexes a load dropped, until they are rebuilt
+DEFERRED_INDEX_TABLE = "langchain_pg_deferred_index"
+
+# binary COPY framing, see https://www.postgresql.org/docs/current/sql-copy.html
+COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+COPY_TRAILER = struct.pack("!h", -1)
+
+
+def _if_not_exists(definition: str) -> str:
+    # pg_indexes gives "CREATE [UNIQUE] INDEX name ON ..."
+    return re.sub(
+        r"^CREATE (UNIQUE )?INDEX ", r"CREATE \1INDEX IF NOT EXISTS ", definition
+    )
+
+
+def _encode_text(value: str) -> bytes:
+    return value.encode()
+
+
+def _encode_jsonb(value: str) -> bytes:
+    # jsonb's binary format is a version byte followed by the json text
+    return b"\x01" + value.encode()
+
+
+def _encode_uuid(value: str) -> bytes:
+    return uuid.UUID(str(value)).bytes
+
+
+def _encode_vector(value: np.ndarray) -> bytes:
+    # pgvector's binary format: int16 dim, int16 unused, then float4s
+    value = np.asarray(value, dtype=">f4")
+    return struct.pack("!hh", value.shape[0], 0) + value.tobytes()
+
+
+# binary encoders by the column's udt_name
+ENCODERS: Dict[str, Callable] = {
+    "uuid": _encode_uuid,
+    "varchar": _encode_text,
+    "text": _encode_text,
+    "json": _encode_text,
+    "jsonb": _encode_jsonb,
+    "vector": _encode_vector,
+}
+
+
+class BulkVectorWriter:
+    """Loads embeddings into a PGVector collection with binary `COPY`.
+
+    Rows go into the same `langchain_pg_embedding` table, with the same
+    columns, that `PGVector.add_embeddings` writes, so the collection stays
+    readable by `PGVector` (and `query_documents.py`). The collection itself
+    must already exist, e.g. by constructing a `PGVector` for it first.
+
+    :param connection_string: database url
+    :type connection_string: str
+    :param collection_name: collection to write to
+    :type collection_name: str
+    :param restore_indexes: first rebuild the indexes a killed load left
+        deferred, see `restore_indexes`
+    :type restore_indexes: bool, optional
+    """
+
+    def __init__(
+        self,
+        connection_string: str,
+        collection_name: str,
+        restore_indexes: bool = True,
+    ):
+        self.conn = psycopg2.connect(psycopg2_dsn(connection_string))
+        self.n_rows = 0
+        self.copy_seconds = 0.0
+
+        with self.conn.cursor() as cur:
+            cur.execute(
+                f"SELECT uuid FROM {COLLECTION_TABLE} WHERE name = %s",
+                (collection_name,),
+            )
+            row = cur.fetchone()
+            if row is None:
+                raise ValueError(f"Collection {collection_name!r} does not exist")
+            self.collection_id = str(row[0])
+
+            cur.execute(
+                "SELECT column_name, udt_name FROM information_schema.columns "
+                "WHERE table_name = %s",
+                (EMBEDDING_TABLE,),
+            )
+            self.column_types = dict(cur.fetchall())
+
+        # the id column is `uuid` up to langchain 0.1 and `id` afterwards
+        self.id_column = "uuid" if "uuid" in self.column_types else "id"
+        self.columns = [
+            self.id_column,
+            "collection_id",
+            "embedding",
+            "document",
+            "cmetadata",
+            "custom_id",
+        ]
+        self.encoders = [ENCODERS[self.column_types[c]] for c in self.columns]
+        if restore_indexes:
+            self.restore_indexes()
+
+    def write(
+        self,
+        texts: List[str],
+        embeddings: List[List[float]],
+        metadatas: Optional[List[Dict]] = None,
+        ids: Optional[List[str]] = None,
+    ) -> int:
+        """COPY one batch of rows and commit it.
+
+        :param texts: document texts
+        :type texts: List[str]
+        :param embeddings: one embedding per text
+        :type embeddings: List[List[float]]
+        :param metadatas: one metadata dict per text, defaults to empty
+        :type metadatas: Optional[List[Dict]], optional
+        :param ids: custom ids, defaults to random uuids like `PGVector`
+        :type ids: Optional[List[str]], optional
+        :return: number of rows written
+        :rtype: int
+        """
+        if metadatas is None:
+            metadatas = [{} for _ in texts]
+        if ids is None:
+            ids = [str(uuid.uuid4()) for _ in texts]
+
+        buf = io.BytesIO()
+        buf.write(COPY_HEADER)
+        n_fields = struct.pack("!h", len(self.columns))
+        for text, embedding, metadata, custom_id in zip(
+            texts, embeddings, metadatas, ids
+        ):
+            values = [
+                str(uuid.uuid4()),
+                self.collection_id,
+                embedding,
+                text,
+                metadata_json(metadata),
+                custom_id,
+            ]
+            buf.write(n_fields)
+            for encode, value in zip(self.encoders, values):
+                data = encode(value)
+                buf.write(struct.pack("!i", len(data)))
+                buf.write(data)
+        buf.write(COPY_TRAILER)
+        buf.seek(0)
+
+        start = time.time()
+        with self.conn.cursor() as cur:
+            cur.copy_expert(
+                f"COPY {EMBEDDING_TABLE} ({', '.join(self.columns)}) "
+                "FROM STDIN WITH (FORMAT binary)",
+                buf,
+            )
+        self.conn.commit()
+        self.copy_seconds += time.time() - start
+        self.n_rows += len(texts)
+        return len(texts)
+
+    def _deferred(self, cur) -> List[Tuple[str, str]]:
+        cur.execute(
+            f"CREATE TABLE IF NOT EXISTS {DEFERRED_INDEX_TABLE} "
+            "(indexname text PRIMARY KEY, indexdef text NOT NULL)"
+        )
+        cur.execute(f"SELECT indexname, indexdef FROM {DEFERRED_INDEX_TABLE}")
+        return cur.fetchall()
+
+    def restore_indexes(self) -> int:
+        """Rebuild the indexes dropped by `deferred_indexes` and not rebuilt
+        yet, e.g. because the load was killed.
+
+        :return: number of indexes rebuilt
+        :rtype: int
+        """
+        start = time.time()
+        with self.conn.cursor() as cur:
+            indexes = self._deferred(cur)
+            for _, definition in indexes:
+                cur.execute(_if_not_exists(definition))
+            cur.execute(f"DELETE FROM {DEFERRED_INDEX_TABLE}")
+        self.conn.commit()
+        if indexes:
+            print(f"Rebuilt {len(indexes)} indexes in {time.time() - start:.1f}s.")
+        return len(indexes)
+
+    @contextmanager
+    def deferred_indexes(self) -> Iterator[None]:
+        """Drop the secondary indexes of the embedding table for the duration
+        of a load and rebuild them afterwards.
+
+        Building an index once over the loaded table is much cheaper than
+        maintaining it row by row. Only the primary key and other constraint
+        indexes are kept. The table is shared by every collection, whose
+        searches go without these indexes meanwhile, so this is only worth it
+        for large loads.
+
+        The definitions are saved in `DEFERRED_INDEX_TABLE` in the transaction
+        that drops the indexes, so a load that dies before rebuilding them
+        leaves them to the next writer: the next deferred (e.g. resumed) load
+        rebuilds them when it finishes, any other as it starts.
+        """
+        with self.conn.cursor() as cur:
+            deferred = self._deferred(cur)
+            cur.execute(
+                "SELECT i.indexname, i.indexdef FROM pg_indexes i "
+                "WHERE i.tablename = %s AND NOT EXISTS ("
+                "SELECT 1 FROM pg_constraint c WHERE c.conname = i.indexname)",
+                (EMBEDDING_TABLE,),
+            )
+            indexes = cur.fetchall()
+            for name, definition in indexes:
+                cur.execute(
+                    f"INSERT INTO {DEFERRED_INDEX_TABLE} (indexname, indexdef) "
+                    "VALUES (%s, %s) ON CONFLICT (indexname) DO NOTHING",
+                    (name, definition),
+                )
+                cur.execute(f'DROP INDEX IF EXISTS "{name}"')
+        self.conn.commit()
+        n_deferred = len({name for name, _ in deferred + indexes})
+        if n_deferred:
+            print(f"Deferred {n_deferred} indexes until the load finishes.")
+
+        try:
+            yield
+        finally:
+            self.conn.rollback()
+            self.restore_indexes()
+
+    def rows_per_second(self) -> float:
+        return self.n_rows / self.copy_seconds if self.copy_seconds else 0.0
+
+    def close(self) -> None:
+        self.conn.close()
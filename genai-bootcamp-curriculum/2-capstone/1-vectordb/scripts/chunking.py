@@ -0,0 +1,141 @@
+import re
+from typing import List, Optional, Tuple
+
+from langchain_core.documents import Document
+from transformers import AutoTokenizer
+
+# end of a sentence, or a blank line between paragraphs
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+|\n\s*\n")
+
+
+class TokenBudgetSplitter:
+    """Split documents into chunks of at most `max_tokens` tokens of the
+    embedding model, snapping chunk edges to sentence boundaries.
+
+    Sentences are tokenized with the model's fast tokenizer in one batch per
+    call and packed greedily, so chunks come out close to the budget and
+    similar in size, which is what fills embedding batches without padding.
+    No chunk is ever longer than the model's input, so nothing is silently
+    truncated. A sentence longer than the budget is cut into budget-sized
+    token windows. Consecutive chunks share up to `overlap_tokens` tokens of
+    whole sentences.
+    """
+
+    def __init__(
+        self,
+        model_name: str = "BAAI/bge-large-en-v1.5",
+        max_tokens: Optional[int] = None,
+        overlap_tokens: int = 0,
+    ):
+        self.model_name = model_name
+        self._max_tokens = max_tokens
+        self.overlap_tokens = overlap_tokens
+        self._tokenizer = None
+
+    def __getstate__(self):
+        # the tokenizer is reloaded lazily in each worker process
+        state = self.__dict__.copy()
+        state["_tokenizer"] = None
+        return state
+
+    @property
+    def tokenizer(self):
+        if self._tokenizer is None:
+            self._tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+        return self._tokenizer
+
+    @property
+    def max_tokens(self) -> int:
+        """Token budget of a chunk, by default the model's input length minus
+        its special tokens."""
+        if self._max_tokens is None:
+            self._max_tokens = (
+                min(self.tokenizer.model_max_length, 512)
+                - self.tokenizer.num_special_tokens_to_add()
+            )
+        return self._max_tokens
+
+    def _pieces(
+        self, spans: List[Tuple[int, int]], offsets: List[List]
+    ) -> List[Tuple[int, int, int]]:
+        """(start, end, n_tokens) of each sentence, cutting sentences that
+        are over budget into budget-sized windows."""
+        pieces = []
+        for (start, end), sentence_offsets in zip(spans, offsets):
+            if len(sentence_offsets) <= self.max_tokens:
+                pieces.append((start, end, len(sentence_offsets)))
+                continue
+            for i in range(0, len(sentence_offsets), self.max_tokens):
+                window = sentence_offsets[i : i + self.max_tokens]
+                pieces.append(
+                    (start + window[0][0], start + window[-1][1], len(window))
+                )
+        return pieces
+
+    def _pack(self, text: str, pieces: List[Tuple[int, int, int]]) -> List[str]:
+        chunks = []
+        i = 0
+        while i < len(pieces):
+            j, n_tokens = i, 0
+            while j < len(pieces) and n_tokens + pieces[j][2] <= self.max_tokens:
+                n_tokens += pieces[j][2]
+                j += 1
+            chunks.append(text[pieces[i][0] : pieces[j - 1][1]])
+            if j == len(pieces):
+                break
+
+            # start the next chunk on the trailing sentences that fit in the
+            # overlap (and still leave room for the next new sentence), always
+            # moving forward by at least one sentence
+            k, n_overlap = j, 0
+            while k - 1 > i:
+                n_with = n_overlap + pieces[k - 1][2]
+                if n_with > self.overlap_tokens:
+                    break
+                if n_with + pieces[j][2] > self.max_tokens:
+                    break
+                n_overlap = n_with
+                k -= 1
+            i = k
+        return chunks
+
+    def split_documents(self, documents: List[Document]) -> List[Document]:
+        """Split documents into token-budgeted chunks, keeping their metadata.
+
+        :param documents: documents to split, e.g. the pages of a PDF
+        :type documents: List[Document]
+        :return: chunks
+        :rtype: List[Document]
+        """
+        doc_spans = []
+        sentences = []
+        for doc in documents:
+            spans = []
+            start = 0
+            for boundary in SENTENCE_BOUNDARY.finditer(doc.page_content):
+                spans.append((start, boundary.start()))
+                start = boundary.end()
+            spans.append((start, len(doc.page_content)))
+            spans = [(s, e) for s, e in spans if doc.page_content[s:e].strip()]
+            doc_spans.append(spans)
+            sentences += [doc.page_content[s:e] for s, e in spans]
+
+        if not sentences:
+            return []
+
+        # a single batched call to the fast tokenizer for every sentence
+        offsets = self.tokenizer(
+            sentences, add_special_tokens=False, return_offsets_mapping=True
+        )["offset_mapping"]
+
+        chunks = []
+        first = 0
+        for doc, spans in zip(documents, doc_spans):
+            doc_offsets = offsets[first : first + len(spans)]
+            first += len(spans)
+            pieces = self._pieces(spans, doc_offsets)
+            chunks += [
+                Document(page_content=text, metadata=dict(doc.metadata))
+                for text in self._pack(doc.page_content, pieces)
+            ]
+        return chunks
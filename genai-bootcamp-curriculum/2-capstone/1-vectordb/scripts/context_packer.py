@@ -0,0 +1,122 @@
+from typing import Dict, List, Set, Tuple
+
+from langchain_core.documents import Document
+
+from chunking import SENTENCE_BOUNDARY
+from dedup import normalize
+
+
+def _shingles(text: str, size: int = 5) -> Set[str]:
+    words = text.split()
+    n = max(len(words) - size + 1, 1)
+    return {" ".join(words[i : i + size]) for i in range(n)}
+
+
+def _n_tokens(tokenizer, text: str) -> int:
+    return len(tokenizer(text, add_special_tokens=False)["input_ids"])
+
+
+def pack_context(
+    docs: List[Document],
+    tokenizer,
+    max_tokens: int = 1024,
+    near_duplicate: float = 0.8,
+    separator: str = "\n\n",
+) -> Tuple[str, Dict]:
+    """Pack retrieved documents into a prompt context of at most `max_tokens`
+    tokens of the generation model.
+
+    Documents are taken best first, in the order of the search's scores. A
+    document whose word 5-grams mostly (`near_duplicate`) appeared in the
+    documents already taken is dropped, as are the sentences it shares with
+    them, e.g. the overlap of consecutive chunks. Documents are then added
+    whole while they fit and the first one that does not is cut at the last
+    sentence that fits, so the prompt never outgrows the context window nor
+    pays prefill for the same text twice.
+
+    :param docs: retrieved documents, best first
+    :type docs: List[Document]
+    :param tokenizer: tokenizer of the generation model
+    :param max_tokens: token budget of the context
+    :type max_tokens: int, optional
+    :param near_duplicate: share of a document's 5-grams already in the
+        context above which it is dropped
+    :type near_duplicate: float, optional
+    :param separator: text between documents
+    :type separator: str, optional
+    :return: the context, and the documents used, duplicates dropped, tokens
+        of the context and tokens saved over joining every document
+    :rtype: Tuple[str, Dict]
+    """
+    seen_sentences: Set[str] = set()
+    seen_shingles: Set[str] = set()
+    unique: List[List[str]] = []
+    duplicates = 0
+    for doc in docs:
+        text = normalize(doc.page_content)
+        if not text:
+            continue
+        shingles = _shingles(text)
+        if len(shingles & seen_shingles) >= near_duplicate * len(shingles):
+            duplicates += 1
+            continue
+        sentences = [
+            " ".join(sentence.split())
+            for sentence in SENTENCE_BOUNDARY.split(doc.page_content)
+            if sentence.strip()
+        ]
+        new = [s for s in sentences if normalize(s) not in seen_sentences]
+        if not new:
+            duplicates += 1
+            continue
+        seen_sentences.update(normalize(s) for s in new)
+        seen_shingles |= shingles
+        unique.append(new)
+
+    # one batched tokenizer call for every sentence
+    flat = [sentence for sentences in unique for sentence in sentences]
+    ids = tokenizer(flat, add_special_tokens=False)["input_ids"] if flat else []
+    lengths = iter(len(sentence_ids) for sentence_ids in ids)
+    separator_tokens = _n_tokens(tokenizer, separator)
+
+    packed: List[List[str]] = []
+    used, truncated = 0, False
+    for sentences in unique:
+        cost = separator_tokens if packed else 0
+        taken = []
+        for sentence in sentences:
+            n = next(lengths)
+            if used + cost + n > max_tokens:
+                break
+            taken.append(sentence)
+            cost += n
+        if taken:
+            packed.append(taken)
+            used += cost
+        elif not packed and sentences:
+            # a first sentence longer than the whole budget is cut to it
+            ids = tokenizer(sentences[0], add_special_tokens=False)["input_ids"]
+            packed.append([tokenizer.decode(ids[:max_tokens])])
+        if len(taken) < len(sentences):
+            truncated = True
+            break
+
+    context = separator.join(" ".join(sentences) for sentences in packed)
+    # sentences tokenized apart can merge differently once joined
+    while packed and _n_tokens(tokenizer, context) > max_tokens:
+        packed[-1].pop()
+        if not packed[-1]:
+            packed.pop()
+        context = separator.join(" ".join(sentences) for sentences in packed)
+        truncated = True
+
+    tokens = _n_tokens(tokenizer, context)
+    naive = _n_tokens(tokenizer, separator.join(doc.page_content for doc in docs))
+    return context, {
+        "docs": len(docs),
+        "docs_used": len(packed),
+        "duplicates": duplicates,
+        "truncated": truncated,
+        "tokens": tokens,
+        "tokens_saved": naive - tokens,
+    }
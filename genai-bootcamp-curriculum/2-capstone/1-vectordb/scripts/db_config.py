@@ -0,0 +1,16 @@
+from langchain.vectorstores.pgvector import PGVector
+
+# The connection to the database, shared by every script
+CONNECTION_STRING = PGVector.connection_string_from_db_params(
+    driver="psycopg2",
+    host="localhost",
+    port="5432",
+    database="postgres",
+    user="username",
+    password="password",
+)
+
+
+def psycopg2_dsn(connection_string: str) -> str:
+    """Turn a SQLAlchemy `postgresql+psycopg2://` url into a libpq one."""
+    return connection_string.replace("postgresql+psycopg2://", "postgresql://", 1)
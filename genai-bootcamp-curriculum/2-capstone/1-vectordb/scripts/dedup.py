@@ -0,0 +1,315 @@
+import hashlib
+import re
+import zlib
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple, TypeVar
+
+import numpy as np
+import psycopg2
+from langchain_core.documents import Document
+from psycopg2.extras import execute_values
+
+from bulk_writer import COLLECTION_TABLE, EMBEDDING_TABLE
+from db_config import psycopg2_dsn
+from manifest import chunk_id, metadata_json
+
+T = TypeVar("T")
+
+# a prime just above 2**32, the universal hashes (a * x + b) % p of a 32 bit
+# shingle hash then fit in uint64 without overflowing
+PRIME_32 = (1 << 32) + 15
+
+WHITESPACE = re.compile(r"\s+")
+
+
+def normalize(text: str) -> str:
+    """Lowercase and collapse whitespace, so copies of a text that were laid
+    out differently on the page compare equal."""
+    return WHITESPACE.sub(" ", text).strip().lower()
+
+
+def lsh_bands(
+    threshold: float, num_perm: int, false_negative_weight: float = 0.9
+) -> Tuple[int, int]:
+    """Pick (bands, rows) for a banded LSH index over `num_perm` MinHash
+    values, so that pairs above `threshold` Jaccard similarity become
+    candidates.
+
+    Two texts of similarity s share at least one band with probability
+    1 - (1 - s^rows)^bands. The split minimizes the weighted area of that
+    curve above 0 below `threshold` (candidates to verify for nothing) and
+    under 1 above it (duplicates missed). Candidates are verified against
+    their signatures, so missing a duplicate is weighted as the worse error.
+
+    :param threshold: Jaccard similarity from which chunks are duplicates
+    :type threshold: float
+    :param num_perm: number of MinHash values per signature
+    :type num_perm: int
+    :param false_negative_weight: weight of missed duplicates, between 0 and 1
+    :type false_negative_weight: float, optional
+    :return: number of bands and rows per band
+    :rtype: Tuple[int, int]
+    """
+    below = np.linspace(0, threshold, 100)
+    above = np.linspace(threshold, 1, 100)
+
+    def error(bands: int, rows: int) -> float:
+        false_positives = np.mean(1 - (1 - below**rows) ** bands) * threshold
+        false_negatives = np.mean((1 - above**rows) ** bands) * (1 - threshold)
+        return (
+            1 - false_negative_weight
+        ) * false_positives + false_negative_weight * false_negatives
+
+    return min(
+        ((num_perm // rows, rows) for rows in range(1, num_perm + 1)),
+        key=lambda br: error(*br),
+    )
+
+
+class ChunkDeduplicator:
+    """Drop chunks that are copies of chunks seen before, e.g. page headers,
+    disclaimers or appendices repeated across PDFs.
+
+    Exact copies (after `normalize`) are found by hash. With `threshold`
+    below 1, near copies are found with MinHash signatures of the chunks'
+    word shingles: a banded LSH index proposes candidates in constant time
+    per chunk, and a candidate counts as a duplicate if its estimated
+    Jaccard similarity is at least `threshold`. Memory grows with the number
+    of unique chunks, `4 * num_perm` bytes of signature each, so millions of
+    chunks fit in a few GB.
+
+    The first chunk of each group survives. The metadata of the chunks
+    dropped as its duplicates is kept until `take_duplicates` hands it over,
+    keyed by the survivor's `chunk_id`. Chunks kept by an earlier run, e.g.
+    the rows an interrupted run committed, are registered with `seed` so
+    that their copies are dropped too.
+    """
+
+    def __init__(
+        self,
+        threshold: float = 1.0,
+        num_perm: int = 128,
+        shingle_size: int = 5,
+        seed: int = 1,
+    ):
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.exact: Dict[bytes, int] = {}
+        self.ids: List[str] = []
+        # metadata of the dropped chunks by index of their survivor in `ids`
+        self.pending: Dict[int, List[Dict]] = defaultdict(list)
+        self.n_exact = self.n_near = 0
+
+        self.near = threshold < 1.0
+        if self.near:
+            self.bands, self.rows = lsh_bands(threshold, num_perm)
+            rng = np.random.default_rng(seed)
+            self.a = rng.integers(1, 1 << 32, num_perm, dtype=np.uint64)
+            self.b = rng.integers(0, 1 << 32, num_perm, dtype=np.uint64)
+            self.signatures: List[np.ndarray] = []
+            self.buckets: List[Dict[bytes, List[int]]] = [{} for _ in range(self.bands)]
+
+    def signature(self, text: str) -> np.ndarray:
+        """MinHash signature of the word shingles of a normalized text.
+
+        :param text: normalized text
+        :type text: str
+        :return: `num_perm` uint32 values
+        :rtype: np.ndarray
+        """
+        words = text.split(" ")
+        n = max(len(words) - self.shingle_size + 1, 1)
+        shingles = {" ".join(words[i : i + self.shingle_size]) for i in range(n)}
+        hashes = np.fromiter(
+            (zlib.crc32(shingle.encode()) for shingle in shingles),
+            dtype=np.uint64,
+            count=len(shingles),
+        )
+        permuted = (self.a[:, None] * hashes[None, :] + self.b[:, None]) % PRIME_32
+        return permuted.min(axis=1).astype(np.uint32)
+
+    def _band_keys(self, signature: np.ndarray) -> List[bytes]:
+        return [
+            signature[i * self.rows : (i + 1) * self.rows].tobytes()
+            for i in range(self.bands)
+        ]
+
+    def find(self, text: str) -> Tuple[Optional[int], List[bytes], np.ndarray]:
+        """Index of the chunk `text` duplicates, None if it's new, with its
+        LSH band keys and signature to register it."""
+        signature = self.signature(text)
+        keys = self._band_keys(signature)
+        candidates = set()
+        for bucket, key in zip(self.buckets, keys):
+            candidates.update(bucket.get(key, ()))
+        best, best_similarity = None, self.threshold
+        for candidate in candidates:
+            similarity = np.mean(self.signatures[candidate] == signature)
+            if similarity >= best_similarity:
+                best, best_similarity = candidate, similarity
+        return best, keys, signature
+
+    def _add(
+        self, text: str, make_id: Callable[[], str]
+    ) -> Tuple[Optional[str], Optional[int]]:
+        # ("exact" or "near", index of the survivor) for a duplicate, else
+        # (None, None) once the text is registered under `make_id()`
+        digest = hashlib.blake2b(text.encode(), digest_size=16).digest()
+        survivor = self.exact.get(digest)
+        if survivor is not None:
+            return "exact", survivor
+
+        if self.near:
+            survivor, keys, signature = self.find(text)
+            if survivor is not None:
+                return "near", survivor
+            for bucket, key in zip(self.buckets, keys):
+                bucket.setdefault(key, []).append(len(self.ids))
+            self.signatures.append(signature)
+
+        self.exact[digest] = len(self.ids)
+        self.ids.append(make_id())
+        return None, None
+
+    def add(self, chunk: Document) -> bool:
+        """Register a chunk, returning False if it duplicates one seen before.
+
+        :param chunk: chunk about to be embedded
+        :type chunk: Document
+        :return: whether the chunk is new and should be kept
+        :rtype: bool
+        """
+        kind, survivor = self._add(
+            normalize(chunk.page_content), lambda: chunk_id(chunk)
+        )
+        if kind is None:
+            return True
+        if kind == "exact":
+            self.n_exact += 1
+        else:
+            self.n_near += 1
+        self.pending[survivor].append(chunk.metadata)
+        return False
+
+    def seed(self, chunks: Iterable[Tuple[str, str]]) -> int:
+        """Register chunks kept before, without counting them as new.
+
+        :param chunks: (text, chunk id) of each chunk
+        :type chunks: Iterable[Tuple[str, str]]
+        :return: number of chunks registered
+        :rtype: int
+        """
+        n_ids = len(self.ids)
+        for text, id_ in chunks:
+            self._add(normalize(text), lambda: id_)
+        return len(self.ids) - n_ids
+
+    def take_duplicates(self, n_kept: Optional[int] = None) -> Dict[str, List[Dict]]:
+        """Hand over the metadata of the duplicates found so far.
+
+        :param n_kept: only those of the first `n_kept` survivors (seeded
+            ones included), e.g. the ones committed, all by default
+        :type n_kept: Optional[int], optional
+        :return: metadata of the dropped chunks by survivor `chunk_id`
+        :rtype: Dict[str, List[Dict]]
+        """
+        survivors = [i for i in self.pending if n_kept is None or i < n_kept]
+        return {self.ids[i]: self.pending.pop(i) for i in survivors}
+
+    def filter(
+        self, items: Iterator[Tuple[Document, T]]
+    ) -> Iterator[Tuple[Document, T]]:
+        """Keep the (chunk, anything) pairs whose chunk is new."""
+        for chunk, item in items:
+            if self.add(chunk):
+                yield chunk, item
+
+
+def committed_chunks(
+    connection_string: str, collection_name: str
+) -> Iterator[Tuple[str, str]]:
+    """(text, custom id) of every row of a collection, streamed, e.g. to seed
+    a `ChunkDeduplicator` with what an interrupted run committed.
+
+    :param connection_string: database url
+    :type connection_string: str
+    :param collection_name: collection to read
+    :type collection_name: str
+    :return: iterator of (text, custom id)
+    :rtype: Iterator[Tuple[str, str]]
+    """
+    conn = psycopg2.connect(psycopg2_dsn(connection_string))
+    try:
+        with conn.cursor(name="committed_chunks") as cur:
+            cur.itersize = 10000
+            cur.execute(
+                f"SELECT e.document, e.custom_id FROM {EMBEDDING_TABLE} AS e, "
+                f"{COLLECTION_TABLE} AS c "
+                "WHERE e.collection_id = c.uuid AND c.name = %s",
+                (collection_name,),
+            )
+            yield from cur
+    finally:
+        conn.close()
+
+
+# survivors are looked up by custom_id, which LangChain leaves unindexed
+CUSTOM_ID_INDEX = f"{EMBEDDING_TABLE}_custom_id_idx"
+
+
+def record_duplicates(
+    connection_string: str, collection_name: str, duplicates: Dict[str, List[Dict]]
+) -> None:
+    """Add the metadata of dropped duplicates to their surviving rows, as a
+    `duplicates` list in `cmetadata`.
+
+    The survivors are matched on `custom_id` in a single set-based UPDATE,
+    through an index on `(collection_id, custom_id)` created by the first
+    call, so that the batches of a run each update their survivors instead
+    of scanning the table.
+
+    :param connection_string: database url
+    :type connection_string: str
+    :param collection_name: collection the survivors were written to
+    :type collection_name: str
+    :param duplicates: metadata of the dropped chunks by survivor `custom_id`
+    :type duplicates: Dict[str, List[Dict]]
+    """
+    if not duplicates:
+        return
+
+    conn = psycopg2.connect(psycopg2_dsn(connection_string))
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT udt_name FROM information_schema.columns "
+            "WHERE table_name = %s AND column_name = 'cmetadata'",
+            (EMBEDDING_TABLE,),
+        )
+        column_type = cur.fetchone()[0]
+        cur.execute(
+            f"CREATE INDEX IF NOT EXISTS {CUSTOM_ID_INDEX} "
+            f"ON {EMBEDDING_TABLE} (collection_id, custom_id)"
+        )
+        cur.execute(
+            "CREATE TEMPORARY TABLE chunk_duplicates "
+            "(custom_id varchar PRIMARY KEY, duplicates jsonb) ON COMMIT DROP"
+        )
+        execute_values(
+            cur,
+            "INSERT INTO chunk_duplicates VALUES %s",
+            [(cid, metadata_json(metadatas)) for cid, metadatas in duplicates.items()],
+            page_size=1000,
+        )
+        cur.execute("ANALYZE chunk_duplicates")
+        cur.execute(
+            f"UPDATE {EMBEDDING_TABLE} AS e SET cmetadata = ("
+            "coalesce(e.cmetadata::jsonb, '{}'::jsonb) || jsonb_build_object("
+            "'duplicates', coalesce(e.cmetadata::jsonb -> 'duplicates', '[]'::jsonb)"
+            f" || d.duplicates))::{column_type} "
+            "FROM chunk_duplicates AS d, "
+            f"{COLLECTION_TABLE} AS c WHERE e.custom_id = d.custom_id "
+            "AND e.collection_id = c.uuid AND c.name = %s",
+            (collection_name,),
+        )
+    conn.commit()
+    conn.close()
@@ -0,0 +1,56 @@
+import os
+from typing import List, Optional
+
+import torch
+
+
+def default_device() -> str:
+    """The device to embed on: CUDA if available, then Apple's MPS, else CPU.
+
+    :return: a torch device name
+    :rtype: str
+    """
+    if torch.cuda.is_available():
+        return "cuda"
+    if torch.backends.mps.is_available():
+        return "mps"
+    return "cpu"
+
+
+def resolve_device(device: Optional[str] = None) -> str:
+    """`device`, or the autodetected one if it is None or "auto"."""
+    if device is None or device == "auto":
+        return default_device()
+    return device
+
+
+def available_cores() -> List[int]:
+    """CPU cores this process may run on (respects taskset and cgroups
+    cpusets on Linux)."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def default_encode_processes(device: str, threads_per_process: int = 4) -> int:
+    """Number of encoding processes for `device`: one per
+    `threads_per_process` cores on CPU, a single process on an accelerator.
+
+    :param device: device the model runs on
+    :type device: str
+    :param threads_per_process: torch threads given to each process
+    :type threads_per_process: int, optional
+    :return: number of processes
+    :rtype: int
+    """
+    if device != "cpu":
+        return 1
+    return max(1, len(available_cores()) // threads_per_process)
+
+
+def split_cores(n_processes: int) -> List[List[int]]:
+    """Partition the available cores into `n_processes` disjoint runs of
+    consecutive cores."""
+    cores = available_cores()
+    n = min(n_processes, len(cores))
+    return [cores[len(cores) * i // n : len(cores) * (i + 1) // n] for i in range(n)]
@@ -1,83 +1,1010 @@
+import argparse
 import glob
-from typing import List
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from dataclasses import dataclass, fields
+from functools import partial
+from itertools import chain, islice
+from typing import Dict, Iterator, List, Optional, Tuple, Union
 
 from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
 from langchain.document_loaders import TextLoader, PyPDFLoader
 from langchain.embeddings.sentence_transformer import SentenceTransformerEmbeddings
 from langchain.text_splitter import CharacterTextSplitter
 from langchain.vectorstores.pgvector import PGVector
+import psycopg2
 
+from bm25_index import BM25Index
+from bulk_writer import BulkVectorWriter
+from chunking import TokenBudgetSplitter
+from db_config import CONNECTION_STRING, psycopg2_dsn
+from dedup import ChunkDeduplicator, committed_chunks, record_duplicates
+from devices import resolve_device
+from embedding_cache import with_embedding_cache
+from encoding import BucketedEmbeddings
+from local_store import LocalVectorStore
+from manage_index import release_fixed_dimensions
+from manifest import chunk_id, hash_file, load_manifest, save_manifest, stale_chunk_ids
+from pipeline import batched, bounded_map, load_checkpoint, save_checkpoint
+from query_cache import bump_collection_version
+from reduction import (
+    ReducedEmbeddings,
+    Reducer,
+    save_reducer,
+    with_collection_reducer,
+)
+from tabular import TABLE_EXTENSIONS, render_table
+
+# Chunks of up to the 510 tokens bge-large embeds (512 minus [CLS] and [SEP])
+DEFAULT_TEXT_SPLITTER = TokenBudgetSplitter("BAAI/bge-large-en-v1.5")
+
+
+def get_text_splitter(
+    chunker: str = "token", chunk_tokens: Optional[int] = None, overlap_tokens: int = 0
+):
+    """Build the text splitter used to chunk pages.
+
+    :param chunker: "token" for chunks sized in embedding model tokens, or
+        "character" for the original `CharacterTextSplitter`
+    :type chunker: str, optional
+    :param chunk_tokens: token budget of a chunk, defaults to the model's
+        maximum input length
+    :type chunk_tokens: Optional[int], optional
+    :param overlap_tokens: tokens of whole sentences shared by consecutive
+        chunks
+    :type overlap_tokens: int, optional
+    :return: text splitter with a `split_documents` method
+    """
+    if chunker == "character":
+        # split document based on the `\n\n` character, quite unintuitive
+        # https://stackoverflow.com/questions/76633836/what-does-langchain-charactertextsplitters-chunk-size-param-even-do
+        return CharacterTextSplitter(chunk_size=1000, chunk_overlap=0)
+    return TokenBudgetSplitter(
+        "BAAI/bge-large-en-v1.5", max_tokens=chunk_tokens, overlap_tokens=overlap_tokens
+    )
+
+
+def splitter_signature(text_splitter=None) -> str:
+    """Describe a text splitter's settings, to tell if chunks are stale.
+
+    :param text_splitter: splitter passed to `chunk_document`
+    :return: settings of the splitter
+    :rtype: str
+    """
+    if text_splitter is None:
+        text_splitter = DEFAULT_TEXT_SPLITTER
+    if isinstance(text_splitter, TokenBudgetSplitter):
+        return (
+            f"token:{text_splitter.model_name}:{text_splitter.max_tokens}"
+            f":{text_splitter.overlap_tokens}"
+        )
+    return type(text_splitter).__name__
 
-def chunk_document(doc_path: str) -> List[Document]:
+
+def chunk_document(doc_path: str, text_splitter=None) -> List[Document]:
     """Chunk a document into smaller langchain Documents for embedding.
 
     :param doc_path: path to document
     :type doc_path: str
+    :param text_splitter: splitter to chunk pages with, defaults to chunks of
+        at most bge-large's input length split on sentence boundaries
     :return: List of Document chunks
     :rtype: List[Document]
     """
     loader = PyPDFLoader(doc_path)
     documents = loader.load()
 
-    # split document based on the `\n\n` character, quite unintuitive
-    # https://stackoverflow.com/questions/76633836/what-does-langchain-charactertextsplitters-chunk-size-param-even-do
-    text_splitter = CharacterTextSplitter(chunk_size=1000, chunk_overlap=0)
+    if text_splitter is None:
+        text_splitter = DEFAULT_TEXT_SPLITTER
 
     return text_splitter.split_documents(documents)
 
 
-# The connection to the database
-CONNECTION_STRING = PGVector.connection_string_from_db_params(
-    driver="psycopg2",
-    host="localhost",
-    port="5432",
-    database="postgres",
-    user="username",
-    password="password",
-)
+def _chunk_document_safe(
+    doc_path: str, text_splitter=None
+) -> Tuple[str, List[Document], Optional[str]]:
+    """Chunk a document, capturing any failure instead of raising.
+
+    Runs inside the worker processes so that one corrupt PDF only drops that
+    file from the run.
+
+    :param doc_path: path to document
+    :type doc_path: str
+    :param text_splitter: splitter passed to `chunk_document`
+    :return: the path, its chunks and an error message (None on success)
+    :rtype: Tuple[str, List[Document], Optional[str]]
+    """
+    try:
+        return doc_path, chunk_document(doc_path, text_splitter), None
+    except Exception as e:
+        return doc_path, [], f"{type(e).__name__}: {e}"
+
+
+def iter_document_chunks(
+    doc_paths: List[str], workers: int = 1, text_splitter=None
+) -> Iterator[Tuple[str, List[Document]]]:
+    """Parse and chunk documents, yielding the chunks of each file in input order.
+
+    With `workers > 1` the files are parsed in a process pool, PDF parsing
+    being CPU bound. At most `2 * workers` files are in flight at once, so
+    parsing never runs far ahead of the consumer. Files that fail to parse
+    are reported and skipped.
+
+    :param doc_paths: paths of the documents to chunk
+    :type doc_paths: List[str]
+    :param workers: number of worker processes, defaults to 1 (in-process)
+    :type workers: int, optional
+    :param text_splitter: splitter passed to `chunk_document`
+    :return: iterator of (path, chunks) pairs
+    :rtype: Iterator[Tuple[str, List[Document]]]
+    """
+    chunk = partial(_chunk_document_safe, text_splitter=text_splitter)
+    if workers <= 1:
+        yield from _skip_failures(map(chunk, doc_paths))
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = bounded_map(executor, chunk, doc_paths, max_pending=2 * workers)
+        yield from _skip_failures(results)
+
+
+def _skip_failures(
+    results: Iterator[Tuple[str, List[Document], Optional[str]]],
+) -> Iterator[Tuple[str, List[Document]]]:
+    for doc_path, chunks, error in results:
+        if error is not None:
+            print(f"Skipping {doc_path}: {error}")
+            continue
+        yield doc_path, chunks
+
+
+def iter_positioned_chunks(
+    doc_paths: List[str],
+    workers: int = 1,
+    start: Tuple[int, int] = (0, 0),
+    text_splitter=None,
+) -> Iterator[Tuple[Document, Tuple[int, int]]]:
+    """Stream every chunk of `doc_paths`, starting at position `start`.
 
+    Each chunk comes with the position just past it, (file index, chunk
+    index), which is what a checkpoint stores to resume after that chunk.
+    Files before `start` are not parsed at all.
+
+    :param doc_paths: sorted document paths
+    :type doc_paths: List[str]
+    :param workers: number of processes used to parse and chunk documents
+    :type workers: int, optional
+    :param start: (file index, chunk index) of the first chunk to yield
+    :type start: Tuple[int, int], optional
+    :param text_splitter: splitter passed to `chunk_document`
+    :return: iterator of (chunk, position) pairs
+    :rtype: Iterator[Tuple[Document, Tuple[int, int]]]
+    """
+    start_file, start_chunk = start
+    file_indexes = {doc_path: i for i, doc_path in enumerate(doc_paths)}
+    chunked = iter_document_chunks(doc_paths[start_file:], workers, text_splitter)
+    for doc_path, chunks in chunked:
+        file_index = file_indexes[doc_path]
+        first = start_chunk if file_index == start_file else 0
+        for chunk_index in range(first, len(chunks)):
+            yield chunks[chunk_index], (file_index, chunk_index + 1)
 
-def embed_documents(doc_dir: str, add_docs: bool = False):
-    # load the document and split it into chunks
-    doc_chunks = []
-    for doc in glob.glob(f"{doc_dir}/*.pdf"):
-        doc_chunks += chunk_document(doc)
 
+def get_embedding_function(
+    cache_dir: Optional[str] = None,
+    max_batch_tokens: Optional[int] = 16384,
+    device: Optional[str] = None,
+    encode_processes: Optional[int] = None,
+) -> Embeddings:
     # The embedding function that will be used to store into the database
-    embedding_function = SentenceTransformerEmbeddings(
-        model_name="BAAI/bge-large-en-v1.5",
-        model_kwargs={"device": "cuda"},
-        encode_kwargs={"normalize_embeddings": True},
+    device = resolve_device(device)
+    if max_batch_tokens:
+        # length-sorted batches under a padded token budget, sharded across
+        # processes on CPU
+        embedding_function = BucketedEmbeddings(
+            model_name="BAAI/bge-large-en-v1.5",
+            device=device,
+            normalize_embeddings=True,
+            max_batch_tokens=max_batch_tokens,
+            processes=encode_processes,
+        )
+    else:
+        embedding_function = SentenceTransformerEmbeddings(
+            model_name="BAAI/bge-large-en-v1.5",
+            model_kwargs={"device": device},
+            encode_kwargs={"normalize_embeddings": True},
+        )
+    return with_embedding_cache(embedding_function, cache_dir)
+
+
+def open_collection(
+    collection_name: str,
+    embedding_function: Embeddings,
+    pre_delete_collection: bool = False,
+    local_store: Optional[str] = None,
+    local_hnsw: bool = False,
+) -> Union[PGVector, LocalVectorStore]:
+    """The collection to write to, in Postgres or in a local store.
+
+    :param collection_name: collection to open
+    :type collection_name: str
+    :param embedding_function: embedding function of the collection
+    :type embedding_function: Embeddings
+    :param pre_delete_collection: start the collection over
+    :type pre_delete_collection: bool, optional
+    :param local_store: directory of a `LocalVectorStore` to write to
+        instead of Postgres
+    :type local_store: Optional[str], optional
+    :param local_hnsw: search the local store with an HNSW graph, defaults
+        to what it was created with
+    :type local_hnsw: bool, optional
+    :return: the collection
+    :rtype: Union[PGVector, LocalVectorStore]
+    """
+    if local_store is not None:
+        return LocalVectorStore(
+            local_store,
+            embedding_function,
+            collection_name=collection_name,
+            pre_delete_collection=pre_delete_collection,
+            hnsw=local_hnsw or None,
+        )
+    return PGVector(
+        connection_string=CONNECTION_STRING,
+        collection_name=collection_name,
+        embedding_function=embedding_function,
+        pre_delete_collection=pre_delete_collection,
     )
 
-    if not add_docs:
-        db = PGVector.from_documents(
-            doc_chunks,
-            connection_string=CONNECTION_STRING,
-            collection_name="embeddings",
-            embedding=embedding_function,
-            pre_delete_collection=True,
+
+@dataclass
+class EmbeddingOptions:
+    """How chunks are embedded and where they are written, shared by
+    `embed_documents`, `sync_documents` and `embed_tables`.
+
+    :param embedding_cache_dir: on-disk embedding cache, defaults to no cache
+    :type embedding_cache_dir: Optional[str], optional
+    :param bulk_copy: write with `COPY` instead of row by row inserts
+    :type bulk_copy: bool, optional
+    :param max_batch_tokens: padded token budget of an encoding batch, 0 or
+        None for sentence-transformers' fixed size batches
+    :type max_batch_tokens: Optional[int], optional
+    :param device: device to embed on, autodetected by default
+    :type device: Optional[str], optional
+    :param encode_processes: CPU encoding processes, defaults to one per 4
+        cores
+    :type encode_processes: Optional[int], optional
+    :param local_store: directory of a local store to write to instead of
+        Postgres
+    :type local_store: Optional[str], optional
+    :param local_hnsw: build an HNSW graph over the local store
+    :type local_hnsw: bool, optional
+    :param bm25_index: sqlite file of a BM25 index to keep alongside the
+        collection
+    :type bm25_index: Optional[str], optional
+    """
+
+    embedding_cache_dir: Optional[str] = None
+    bulk_copy: bool = False
+    max_batch_tokens: Optional[int] = 16384
+    device: Optional[str] = None
+    encode_processes: Optional[int] = None
+    local_store: Optional[str] = None
+    local_hnsw: bool = False
+    bm25_index: Optional[str] = None
+
+    def __post_init__(self):
+        if self.local_store is not None and self.bulk_copy:
+            raise ValueError("A local store is written without COPY")
+
+    @classmethod
+    def from_args(cls, args: argparse.Namespace) -> "EmbeddingOptions":
+        """The options parsed from the flags of `add_embedding_arguments`."""
+        return cls(**{field.name: getattr(args, field.name) for field in fields(cls)})
+
+    def embedding_function(self, collection_name: str, rebuild: bool) -> Embeddings:
+        """The embedding function of `collection_name`, projecting with the
+        reduction saved in the collection unless it is rebuilt or local."""
+        embedding_function = get_embedding_function(
+            self.embedding_cache_dir,
+            self.max_batch_tokens,
+            self.device,
+            self.encode_processes,
+        )
+        if not rebuild and self.local_store is None:
+            embedding_function = with_collection_reducer(
+                embedding_function, CONNECTION_STRING, collection_name
+            )
+        return embedding_function
+
+    def open_collection(
+        self, collection_name: str, embedding_function: Embeddings, rebuild: bool
+    ) -> Union[PGVector, LocalVectorStore]:
+        return open_collection(
+            collection_name,
+            embedding_function,
+            rebuild,
+            self.local_store,
+            self.local_hnsw,
+        )
+
+    def open_lexical_index(self, rebuild: bool) -> Optional[BM25Index]:
+        return BM25Index(self.bm25_index, rebuild) if self.bm25_index else None
+
+    def open_writer(self, collection_name: str, **kwargs) -> Optional[BulkVectorWriter]:
+        """A `BulkVectorWriter` to the collection with `bulk_copy`, else None
+        to insert through the vector store."""
+        if not self.bulk_copy:
+            return None
+        return BulkVectorWriter(CONNECTION_STRING, collection_name, **kwargs)
+
+
+def add_embedding_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the command line flags of `EmbeddingOptions` to `parser`."""
+    parser.add_argument(
+        "--max_batch_tokens",
+        type=int,
+        default=16384,
+        help="padded token budget of an encoding batch, 0 for fixed size batches",
+    )
+    parser.add_argument(
+        "--device",
+        type=str,
+        default=None,
+        help="device to embed on (cuda, mps, cpu), autodetected by default",
+    )
+    parser.add_argument(
+        "--encode_processes",
+        type=int,
+        default=None,
+        help="processes encoding on CPU, each pinned to its share of the cores; "
+        "defaults to one per 4 cores",
+    )
+    parser.add_argument(
+        "--embedding_cache_dir",
+        type=str,
+        default=None,
+        help="directory of the on-disk embedding cache, disabled if not set",
+    )
+    parser.add_argument(
+        "--bulk_copy",
+        action="store_true",
+        help="load embeddings with binary COPY instead of row by row inserts",
+    )
+    parser.add_argument(
+        "--local_store",
+        type=str,
+        default=None,
+        help="directory of an in-process vector store to write to instead of "
+        "Postgres",
+    )
+    parser.add_argument(
+        "--local_hnsw",
+        action="store_true",
+        help="build an HNSW graph over the --local_store (needs hnswlib)",
+    )
+    parser.add_argument(
+        "--bm25_index",
+        type=str,
+        default=None,
+        help="sqlite file of a BM25 index of the chunks to build alongside the "
+        "vectors, for hybrid search",
+    )
+
+
+def prepare_embedding_column(embedding_function: Embeddings) -> None:
+    """Let the embedding column, shared by every collection, take the vectors
+    of a collection about to be rebuilt, whose dimension may differ from the
+    one it replaces, see `manage_index.release_fixed_dimensions`."""
+    dim = len(embedding_function.embed_query("dimension"))
+    conn = psycopg2.connect(psycopg2_dsn(CONNECTION_STRING))
+    try:
+        release_fixed_dimensions(conn, dim)
+    finally:
+        conn.close()
+
+
+def write_duplicates(
+    db: Union[PGVector, LocalVectorStore], duplicates: Dict[str, List[Dict]]
+) -> None:
+    """Append the metadata of dropped duplicate chunks to the `duplicates`
+    list of their committed survivors, by survivor id."""
+    if not duplicates:
+        return
+    if isinstance(db, LocalVectorStore):
+        db.extend_metadata(
+            {cid: {"duplicates": metadatas} for cid, metadatas in duplicates.items()}
         )
-        print(f"Created new database with {len(doc_chunks)} embeddings.")
     else:
-        db = PGVector(
-            connection_string=CONNECTION_STRING,
-            collection_name="embeddings",
-            embedding=embedding_function,
+        record_duplicates(CONNECTION_STRING, db.collection_name, duplicates)
+
+
+def print_index_build(lexical_index: Optional[BM25Index]) -> None:
+    if lexical_index is not None:
+        print(
+            f"Indexed {lexical_index.n_added} chunks for BM25 in "
+            f"{lexical_index.build_seconds:.1f}s, {len(lexical_index)} in the index."
         )
-        res = db.add_documents(doc_chunks)
-        print(f"Added {len(res)} embeddings.")
+        lexical_index.close()
 
 
-if __name__ == "__main__":
-    import argparse
+def publish_collection(db: Union[PGVector, LocalVectorStore]) -> None:
+    """Make a finished run visible to the apps searching `db`: save the HNSW
+    graph of a local store, or bump the version of a Postgres collection so
+    query caches drop their results."""
+    if isinstance(db, LocalVectorStore):
+        db.persist()
+    else:
+        bump_collection_version(CONNECTION_STRING, db.collection_name)
+
+
+def write_chunks(
+    db: Union[PGVector, LocalVectorStore],
+    writer: Optional[BulkVectorWriter],
+    chunks: List[Document],
+    ids: Optional[List[str]] = None,
+    lexical_index: Optional[BM25Index] = None,
+) -> None:
+    """Embed chunks and commit them to the collection of `db`, and to a BM25
+    index if one is given.
+
+    :param db: the collection, also providing the embedding function
+    :type db: Union[PGVector, LocalVectorStore]
+    :param writer: bulk writer to `COPY` with, None to insert through `db`
+    :type writer: Optional[BulkVectorWriter]
+    :param chunks: chunks to embed
+    :type chunks: List[Document]
+    :param ids: custom ids of the chunks, defaults to random ones
+    :type ids: Optional[List[str]], optional
+    :param lexical_index: BM25 index of the collection
+    :type lexical_index: Optional[BM25Index], optional
+    """
+    if writer is None:
+        # embeds the chunks and inserts them in a single committed transaction
+        db.add_documents(chunks, ids=ids)
+    else:
+        texts = [chunk.page_content for chunk in chunks]
+        writer.write(
+            texts,
+            db.embedding_function.embed_documents(texts),
+            [chunk.metadata for chunk in chunks],
+            ids=ids,
+        )
+    if lexical_index is not None:
+        lexical_index.add(chunks, ids)
+
+
+def embed_documents(
+    doc_dir: str,
+    add_docs: bool = False,
+    workers: int = 1,
+    batch_size: int = 256,
+    resume: bool = False,
+    checkpoint_path: Optional[str] = None,
+    text_splitter=None,
+    reduce: Optional[str] = None,
+    reduce_dim: int = 256,
+    reduce_fit_samples: int = 10000,
+    dedup: Optional[str] = None,
+    dedup_threshold: float = 0.9,
+    options: Optional[EmbeddingOptions] = None,
+):
+    """Embed every PDF in `doc_dir` into the "embeddings" collection.
+
+    Chunks are streamed through parse -> chunk -> embed -> write in batches
+    of `batch_size`, each batch being committed before the next is read, so
+    memory stays flat however large the corpus is. A checkpoint is written
+    after every batch; with `resume` an interrupted run carries on after the
+    last committed batch instead of starting over.
 
+    With `options.bulk_copy` batches are loaded with binary `COPY` instead of
+    `PGVector.add_documents`, and when the collection is rebuilt the table's
+    secondary indexes are only rebuilt once the load is done.
+
+    With `reduce`, a PCA or random projection to `reduce_dim` dimensions is
+    fitted on the embeddings of the first `reduce_fit_samples` chunks when
+    the collection is rebuilt, and saved in the collection's metadata. Every
+    stored vector is projected; adding to or resuming a reduced collection
+    reuses its saved projection.
+
+    With `dedup`, chunks that repeat an earlier chunk of the run, exactly
+    ("exact") or with a MinHash Jaccard similarity of at least
+    `dedup_threshold` ("near"), are dropped before embedding. The metadata
+    of the dropped copies is added to the surviving row's metadata as a
+    `duplicates` list as soon as the survivor is committed. A resumed run
+    first registers the chunks committed before, so that their copies are
+    dropped too.
+
+    With `options.local_store`, the collection is written to a
+    `LocalVectorStore` in that directory instead of Postgres.
+
+    :param doc_dir: directory of PDFs
+    :type doc_dir: str
+    :param add_docs: add to the existing collection instead of replacing it
+    :type add_docs: bool, optional
+    :param workers: number of processes used to parse and chunk documents
+    :type workers: int, optional
+    :param batch_size: chunks embedded and committed at a time
+    :type batch_size: int, optional
+    :param resume: resume from the checkpoint of an interrupted run
+    :type resume: bool, optional
+    :param checkpoint_path: checkpoint location, defaults to
+        `<doc_dir>/.embeddings_checkpoint.json`
+    :type checkpoint_path: Optional[str], optional
+    :param text_splitter: splitter passed to `chunk_document`
+    :param reduce: "pca" or "random" to store reduced embeddings, defaults to
+        the full dimension
+    :type reduce: Optional[str], optional
+    :param reduce_dim: dimension of the reduced embeddings
+    :type reduce_dim: int, optional
+    :param reduce_fit_samples: chunks the reduction is fitted on
+    :type reduce_fit_samples: int, optional
+    :param dedup: "exact" or "near" to drop duplicate chunks, defaults to
+        keeping every chunk
+    :type dedup: Optional[str], optional
+    :param dedup_threshold: similarity from which "near" chunks are dropped
+    :type dedup_threshold: float, optional
+    :param options: embedding and storage options, defaults to
+        `EmbeddingOptions()`
+    :type options: Optional[EmbeddingOptions], optional
+    """
+    if options is None:
+        options = EmbeddingOptions()
+    if options.local_store is not None and reduce is not None:
+        raise ValueError("A local store is written without reduction")
+
+    collection_name = "embeddings"
+    if checkpoint_path is None:
+        checkpoint_path = os.path.join(doc_dir, f".{collection_name}_checkpoint.json")
+
+    doc_paths = sorted(glob.glob(f"{doc_dir}/*.pdf"))
+    start = (
+        load_checkpoint(checkpoint_path, collection_name, doc_paths) if resume else None
+    )
+    if start is not None:
+        print(f"Resuming at file {start[0]} of {len(doc_paths)}, chunk {start[1]}.")
+
+    rebuild = not add_docs and start is None
+    embedding_function = options.embedding_function(collection_name, rebuild)
+    start_time = time.time()
+    n_embedded = 0
+    stream = iter_positioned_chunks(
+        doc_paths, workers=workers, start=start or (0, 0), text_splitter=text_splitter
+    )
+    deduplicator = None
+    if dedup is not None:
+        deduplicator = ChunkDeduplicator(
+            threshold=1.0 if dedup == "exact" else dedup_threshold
+        )
+        stream = deduplicator.filter(stream)
+    reducer = None
+    if reduce is not None and rebuild:
+        # fitted before the collection is replaced, so that a reduction that
+        # cannot be fitted (e.g. PCA on too few chunks) leaves it as it was;
+        # the sample is embedded once more when written, for free with a cache
+        sample = list(islice(stream, reduce_fit_samples))
+        vectors = embedding_function.embed_documents(
+            [chunk.page_content for chunk, _ in sample]
+        )
+        reducer = Reducer.fit(vectors, reduce, reduce_dim)
+        print(
+            f"Fitted {reduce} from {reducer.input_dim} to {reducer.dim} dimensions "
+            f"on {len(sample)} chunks."
+        )
+        stream = chain(sample, stream)
+
+    db = options.open_collection(collection_name, embedding_function, rebuild)
+    if reducer is not None:
+        save_reducer(CONNECTION_STRING, collection_name, reducer)
+        db.embedding_function = ReducedEmbeddings(embedding_function, reducer)
+    if rebuild and options.local_store is None:
+        prepare_embedding_column(db.embedding_function)
+    n_seeded = 0
+    if deduplicator is not None and start is not None:
+        # the interrupted run kept these, their copies must still be dropped
+        n_seeded = deduplicator.seed(
+            db.iter_texts()
+            if options.local_store is not None
+            else committed_chunks(CONNECTION_STRING, collection_name)
+        )
+        print(f"Deduplicating against the {n_seeded} chunks committed before.")
+    lexical_index = options.open_lexical_index(rebuild)
+
+    # indexes a killed load deferred are rebuilt after this load instead
+    writer = options.open_writer(collection_name, restore_indexes=add_docs)
+    deferred_indexes = nullcontext()
+    if writer is not None and not add_docs:
+        deferred_indexes = writer.deferred_indexes()
+
+    with deferred_indexes:
+        for batch in batched(stream, batch_size):
+            chunks = [chunk for chunk, _ in batch]
+            # survivors get content ids, to find them again for their duplicates
+            ids = (
+                [chunk_id(chunk) for chunk in chunks]
+                if deduplicator is not None
+                else None
+            )
+            write_chunks(db, writer, chunks, ids, lexical_index)
+            n_embedded += len(batch)
+            if deduplicator is not None:
+                # survivors are committed in the order they were kept, so the
+                # duplicates of the first n_seeded + n_embedded can be written
+                write_duplicates(
+                    db, deduplicator.take_duplicates(n_seeded + n_embedded)
+                )
+            save_checkpoint(
+                checkpoint_path, collection_name, doc_paths, batch[-1][1], n_embedded
+            )
+
+    if deduplicator is not None:
+        print(
+            f"Dropped {deduplicator.n_exact} exact and {deduplicator.n_near} near "
+            "duplicate chunks."
+        )
+
+    publish_collection(db)
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    if writer is not None:
+        print(
+            f"COPY wrote {writer.n_rows} rows at {writer.rows_per_second():.0f} rows/s."
+        )
+        writer.close()
+    print(f"Ingested {n_embedded} chunks in {time.time() - start_time:.1f}s.")
+    print_index_build(lexical_index)
+
+    if rebuild:
+        print(f"Created new database with {n_embedded} embeddings.")
+    else:
+        print(f"Added {n_embedded} embeddings.")
+
+
+def sync_documents(
+    doc_dir: str,
+    manifest_path: Optional[str] = None,
+    workers: int = 1,
+    collection_name: str = "embeddings",
+    text_splitter=None,
+    options: Optional[EmbeddingOptions] = None,
+):
+    """Incrementally sync a collection with the PDFs in `doc_dir`.
+
+    A manifest of file and chunk hashes records what is already embedded.
+    Unchanged files are not even parsed, only chunks that are new are
+    embedded, and rows for edited or removed files are deleted. Without a
+    manifest the collection is rebuilt from scratch so the two agree.
+
+    :param doc_dir: directory of PDFs
+    :type doc_dir: str
+    :param manifest_path: manifest location, defaults to
+        `<doc_dir>/.<collection_name>_manifest.json`
+    :type manifest_path: Optional[str], optional
+    :param workers: number of processes used to parse and chunk documents
+    :type workers: int, optional
+    :param collection_name: collection to sync, defaults to "embeddings"
+    :type collection_name: str, optional
+    :param text_splitter: splitter passed to `chunk_document`
+    :param options: embedding and storage options, defaults to
+        `EmbeddingOptions()`
+    :type options: Optional[EmbeddingOptions], optional
+    """
+    if options is None:
+        options = EmbeddingOptions()
+    if manifest_path is None:
+        manifest_path = os.path.join(doc_dir, f".{collection_name}_manifest.json")
+    is_new = not os.path.exists(manifest_path)
+    manifest = load_manifest(manifest_path, collection_name)
+
+    # a file chunked differently than last time has to be re-chunked too
+    chunking = splitter_signature(text_splitter)
+    doc_paths = sorted(glob.glob(f"{doc_dir}/*.pdf"))
+    file_hashes = {doc_path: hash_file(doc_path) for doc_path in doc_paths}
+    changed = [
+        doc_path
+        for doc_path in doc_paths
+        if manifest["files"].get(doc_path, {}).get("sha256") != file_hashes[doc_path]
+        or manifest["files"][doc_path].get("chunking") != chunking
+    ]
+    removed = [source for source in manifest["files"] if source not in file_hashes]
+
+    embedding_function = options.embedding_function(collection_name, is_new)
+    db = options.open_collection(collection_name, embedding_function, is_new)
+    if is_new and options.local_store is None:
+        prepare_embedding_column(embedding_function)
+    lexical_index = options.open_lexical_index(is_new)
+    writer = options.open_writer(collection_name)
+
+    n_added = n_deleted = 0
+    chunked = iter_document_chunks(
+        changed, workers=workers, text_splitter=text_splitter
+    )
+    for doc_path, chunks in chunked:
+        chunks_by_id = {chunk_id(chunk): chunk for chunk in chunks}
+        old_ids = set(manifest["files"].get(doc_path, {}).get("chunks", []))
+        new_ids = [cid for cid in chunks_by_id if cid not in old_ids]
+        stale_ids = [cid for cid in old_ids if cid not in chunks_by_id]
+
+        # deleting the ids about to be added keeps a re-run after a crash
+        # (rows written, manifest not yet saved) from duplicating them
+        if stale_ids or new_ids:
+            db.delete(ids=stale_ids + new_ids)
+            if lexical_index is not None:
+                lexical_index.delete(stale_ids)
+        if new_ids:
+            write_chunks(
+                db,
+                writer,
+                [chunks_by_id[cid] for cid in new_ids],
+                new_ids,
+                lexical_index,
+            )
+
+        manifest["files"][doc_path] = {
+            "sha256": file_hashes[doc_path],
+            "chunking": chunking,
+            "chunks": list(chunks_by_id),
+        }
+        save_manifest(manifest, manifest_path)
+        n_added += len(new_ids)
+        n_deleted += len(stale_ids)
+
+    removed_ids = stale_chunk_ids(manifest, doc_paths)
+    if removed_ids:
+        db.delete(ids=removed_ids)
+        if lexical_index is not None:
+            lexical_index.delete(removed_ids)
+    for source in removed:
+        del manifest["files"][source]
+    save_manifest(manifest, manifest_path)
+    n_deleted += len(removed_ids)
+    if writer is not None:
+        writer.close()
+    publish_collection(db)
+
+    print(
+        f"Synced {len(doc_paths)} files ({len(changed)} new or changed, "
+        f"{len(removed)} removed): added {n_added}, deleted {n_deleted} embeddings."
+    )
+    print_index_build(lexical_index)
+
+
+def embed_tables(
+    doc_dir: str,
+    add_docs: bool = False,
+    template: Optional[str] = None,
+    group_by: Optional[List[str]] = None,
+    group_template: Optional[str] = None,
+    metadata_columns: Optional[List[str]] = None,
+    batch_size: int = 1024,
+    options: Optional[EmbeddingOptions] = None,
+):
+    """Embed the rows of every CSV and Excel file in `doc_dir`.
+
+    Tables are read in chunks of rows and rendered to text with `template`
+    (see `tabular.render_table`), without going through a PDF. Rows are
+    streamed to the collection in batches of `batch_size`.
+
+    :param doc_dir: directory of .csv, .xlsx and .xls files
+    :type doc_dir: str
+    :param add_docs: add to the existing collection instead of replacing it
+    :type add_docs: bool, optional
+    :param template: row template over the column names, defaults to a
+        `column: value` line per column
+    :type template: Optional[str], optional
+    :param group_by: columns whose runs of equal values form one chunk
+    :type group_by: Optional[List[str]], optional
+    :param group_template: header rendered with the first row of a group
+    :type group_template: Optional[str], optional
+    :param metadata_columns: columns kept as filterable metadata
+    :type metadata_columns: Optional[List[str]], optional
+    :param batch_size: rows embedded and committed at a time
+    :type batch_size: int, optional
+    :param options: embedding and storage options, defaults to
+        `EmbeddingOptions()`
+    :type options: Optional[EmbeddingOptions], optional
+    """
+    if options is None:
+        options = EmbeddingOptions()
+
+    table_paths = sorted(
+        path
+        for path in glob.glob(f"{doc_dir}/*")
+        if path.lower().endswith(TABLE_EXTENSIONS)
+    )
+
+    embedding_function = options.embedding_function("embeddings", not add_docs)
+    db = options.open_collection("embeddings", embedding_function, not add_docs)
+    if not add_docs and options.local_store is None:
+        prepare_embedding_column(embedding_function)
+    lexical_index = options.open_lexical_index(not add_docs)
+    writer = options.open_writer("embeddings")
+
+    start_time = time.time()
+    n_embedded = 0
+    for table_path in table_paths:
+        rows = render_table(
+            table_path,
+            template=template,
+            group_by=group_by,
+            group_template=group_template,
+            metadata_columns=metadata_columns,
+        )
+        for batch in batched(rows, batch_size):
+            write_chunks(db, writer, batch, lexical_index=lexical_index)
+            n_embedded += len(batch)
+        print(f"Embedded {table_path}")
+
+    if writer is not None:
+        writer.close()
+    publish_collection(db)
+    print(
+        f"Added {n_embedded} embeddings from {len(table_paths)} tables "
+        f"in {time.time() - start_time:.1f}s."
+    )
+    print_index_build(lexical_index)
+
+
+if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--doc_dir", type=str, required=True, help="path to document to embed"
     )
     parser.add_argument("--add", action="store_true", help="add to existing collection")
+    parser.add_argument(
+        "--chunker",
+        type=str,
+        default="token",
+        choices=["token", "character"],
+        help="split pages by embedding model tokens or with CharacterTextSplitter",
+    )
+    parser.add_argument(
+        "--chunk_tokens",
+        type=int,
+        default=None,
+        help="token budget of a chunk, defaults to the embedding model's max length",
+    )
+    parser.add_argument(
+        "--chunk_overlap_tokens",
+        type=int,
+        default=0,
+        help="tokens of whole sentences repeated between consecutive chunks",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=256,
+        help="chunks embedded and committed at a time",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="resume an interrupted run from its last committed batch",
+    )
+    parser.add_argument(
+        "--sync",
+        action="store_true",
+        help="only embed new or changed files and delete removed ones",
+    )
+    parser.add_argument(
+        "--manifest",
+        type=str,
+        default=None,
+        help="path to the --sync manifest, defaults to a file in DOC_DIR",
+    )
+    parser.add_argument(
+        "--tables",
+        action="store_true",
+        help="embed the rows of the CSV and Excel files in DOC_DIR instead of PDFs",
+    )
+    parser.add_argument(
+        "--template",
+        type=str,
+        default=None,
+        help="--tables row template, e.g. '{Table Name}: {Table Description}'",
+    )
+    parser.add_argument(
+        "--group_by",
+        type=str,
+        nargs="+",
+        default=None,
+        help="--tables columns whose consecutive equal values form one chunk",
+    )
+    parser.add_argument(
+        "--group_template",
+        type=str,
+        default=None,
+        help="--tables header of each group, rendered with its first row",
+    )
+    parser.add_argument(
+        "--metadata_columns",
+        type=str,
+        nargs="+",
+        default=None,
+        help="--tables columns kept as filterable metadata",
+    )
+    parser.add_argument(
+        "--reduce",
+        type=str,
+        default=None,
+        choices=["pca", "random"],
+        help="store embeddings reduced by PCA or a random projection",
+    )
+    parser.add_argument(
+        "--reduce_dim",
+        type=int,
+        default=256,
+        help="dimension of the reduced embeddings",
+    )
+    parser.add_argument(
+        "--reduce_fit_samples",
+        type=int,
+        default=10000,
+        help="number of chunks the reduction is fitted on",
+    )
+    parser.add_argument(
+        "--dedup",
+        type=str,
+        default=None,
+        choices=["exact", "near"],
+        help="drop chunks repeating an earlier chunk exactly or nearly",
+    )
+    parser.add_argument(
+        "--dedup_threshold",
+        type=float,
+        default=0.9,
+        help="MinHash Jaccard similarity from which --dedup near drops a chunk",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of processes used to parse and chunk documents",
+    )
+
+    add_embedding_arguments(parser)
 
     args = parser.parse_args()
+    options = EmbeddingOptions.from_args(args)
+    text_splitter = get_text_splitter(
+        args.chunker, args.chunk_tokens, args.chunk_overlap_tokens
+    )
 
-    embed_documents(args.doc_dir, args.add)
+    if args.tables:
+        embed_tables(
+            args.doc_dir,
+            args.add,
+            template=args.template,
+            group_by=args.group_by,
+            group_template=args.group_template,
+            metadata_columns=args.metadata_columns,
+            batch_size=args.batch_size,
+            options=options,
+        )
+    elif args.sync:
+        sync_documents(
+            args.doc_dir,
+            manifest_path=args.manifest,
+            workers=args.workers,
+            text_splitter=text_splitter,
+            options=options,
+        )
+    else:
+        embed_documents(
+            args.doc_dir,
+            args.add,
+            workers=args.workers,
+            batch_size=args.batch_size,
+            resume=args.resume,
+            text_splitter=text_splitter,
+            reduce=args.reduce,
+            reduce_dim=args.reduce_dim,
+            reduce_fit_samples=args.reduce_fit_samples,
+            dedup=args.dedup,
+            dedup_threshold=args.dedup_threshold,
+            options=options,
+        )
@@ -0,0 +1,229 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+DEFAULT_MAX_BYTES = 2 << 30  # 2GiB of float32 vectors
+
+
+class EmbeddingCache:
+    """Content-addressed, on-disk cache of embedding vectors.
+
+    Each (model name, normalize flag) pair gets its own directory under
+    `cache_dir`. Vectors live in a fixed-capacity float32 memory-mapped
+    `vectors.npy`, one row per cached text, and a sqlite index maps the
+    sha256 of each text to its row along with its last access time. Once
+    the file holds `max_bytes` of vectors, the least recently used rows are
+    overwritten.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str,
+        model_name: str,
+        normalize: bool = True,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+    ):
+        namespace = hashlib.sha256(f"{model_name}\0{normalize}".encode()).hexdigest()
+        self.path = os.path.join(cache_dir, namespace[:16])
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.path, exist_ok=True)
+
+        # record what the directory holds, the name is only a hash
+        with open(os.path.join(self.path, "model.json"), "w") as f:
+            json.dump({"model_name": model_name, "normalize": normalize}, f)
+
+        self._lock = threading.Lock()
+        self._vectors: Optional[np.memmap] = None
+        self._db = sqlite3.connect(
+            os.path.join(self.path, "index.sqlite"),
+            timeout=60,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, "
+            "slot INTEGER UNIQUE NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)"
+        )
+
+    @staticmethod
+    def key(text: str, kind: str = "document") -> str:
+        """Cache key of a text; queries and documents are kept apart since some
+        models embed them differently."""
+        return hashlib.sha256(f"{kind}\0{text}".encode()).hexdigest()
+
+    def _open_vectors(self, dim: Optional[int] = None) -> Optional[np.memmap]:
+        if self._vectors is None:
+            path = os.path.join(self.path, "vectors.npy")
+            if os.path.exists(path):
+                self._vectors = np.lib.format.open_memmap(path, mode="r+")
+            elif dim is not None:
+                # the file is sparse, so preallocating the full capacity is cheap
+                capacity = max(1, self.max_bytes // (dim * 4))
+                self._vectors = np.lib.format.open_memmap(
+                    path, mode="w+", dtype=np.float32, shape=(capacity, dim)
+                )
+        return self._vectors
+
+    def _lookup(self, keys: List[str]) -> Dict[str, int]:
+        slots = {}
+        # stay under sqlite's limit on bound parameters
+        for i in range(0, len(keys), 500):
+            part = keys[i : i + 500]
+            placeholders = ",".join("?" * len(part))
+            rows = self._db.execute(
+                f"SELECT key, slot FROM entries WHERE key IN ({placeholders})", part
+            )
+            slots.update(rows)
+        return slots
+
+    def get_many(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        """Fetch the cached vectors of `keys`, refreshing their access time.
+
+        :param keys: keys from `EmbeddingCache.key`
+        :type keys: List[str]
+        :return: vectors of the keys that are cached
+        :rtype: Dict[str, np.ndarray]
+        """
+        with self._lock:
+            vectors = self._open_vectors()
+            slots = self._lookup(list(set(keys))) if vectors is not None else {}
+            found = {key: np.array(vectors[slot]) for key, slot in slots.items()}
+            if slots:
+                now = time.time()
+                self._db.executemany(
+                    "UPDATE entries SET last_used = ? WHERE key = ?",
+                    [(now, key) for key in slots],
+                )
+            self.hits += sum(key in found for key in keys)
+            self.misses += sum(key not in found for key in keys)
+        return found
+
+    def put_many(self, keys: List[str], vectors: np.ndarray) -> None:
+        """Store vectors, evicting the least recently used ones if full.
+
+        :param keys: keys from `EmbeddingCache.key`, without duplicates
+        :type keys: List[str]
+        :param vectors: one vector per key
+        :type vectors: np.ndarray
+        :raises ValueError: if the vectors don't match the cached dimension
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with self._lock:
+            store = self._open_vectors(dim=vectors.shape[1])
+            if store.shape[1] != vectors.shape[1]:
+                raise ValueError(
+                    f"Cache at {self.path} holds {store.shape[1]}-d vectors, "
+                    f"got {vectors.shape[1]}-d"
+                )
+            capacity = store.shape[0]
+
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                existing = self._lookup(keys)
+                new = [i for i, key in enumerate(keys) if key not in existing]
+                new = new[-capacity:]
+
+                # slots are filled in order and only ever reused, so the used
+                # slots are always 0..n_used-1
+                n_used = self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+                slots = list(range(n_used, min(capacity, n_used + len(new))))
+                n_evict = len(new) - len(slots)
+                if n_evict > 0:
+                    evicted = self._db.execute(
+                        "SELECT key, slot FROM entries ORDER BY last_used LIMIT ?",
+                        (n_evict,),
+                    ).fetchall()
+                    self._db.executemany(
+                        "DELETE FROM entries WHERE key = ?", [(k,) for k, _ in evicted]
+                    )
+                    slots += [slot for _, slot in evicted]
+
+                # write the vectors before the index points at them
+                store[slots] = vectors[new]
+                store.flush()
+                now = time.time()
+                self._db.executemany(
+                    "INSERT INTO entries (key, slot, last_used) VALUES (?, ?, ?)",
+                    [(keys[i], slot, now) for i, slot in zip(new, slots)],
+                )
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses}
+
+
+class CachedEmbeddings(Embeddings):
+    """Wraps an `Embeddings` so vectors are read from an `EmbeddingCache` when
+    possible and only the missing texts are sent to the model."""
+
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingCache):
+        self.embeddings = embeddings
+        self.cache = cache
+
+    def _embed(
+        self,
+        texts: List[str],
+        kind: str,
+        compute: Callable[[List[str]], List[List[float]]],
+    ) -> List[List[float]]:
+        keys = [self.cache.key(text, kind) for text in texts]
+        found = self.cache.get_many(keys)
+
+        # embed each missing text once, even if it is repeated in `texts`
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found:
+                missing.setdefault(key, text)
+        if missing:
+            computed = np.asarray(compute(list(missing.values())), dtype=np.float32)
+            self.cache.put_many(list(missing), computed)
+            found.update(zip(missing, computed))
+
+        return [found[key].tolist() for key in keys]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed(texts, "document", self.embeddings.embed_documents)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(
+            [text], "query", lambda texts: [self.embeddings.embed_query(texts[0])]
+        )[0]
+
+
+def with_embedding_cache(
+    embeddings: Embeddings,
+    cache_dir: Optional[str],
+    max_bytes: int = DEFAULT_MAX_BYTES,
+) -> Embeddings:
+    """Put an on-disk cache in front of a sentence-transformers embedding function.
+
+    :param embeddings: embedding function with `model_name` and `encode_kwargs`
+    :type embeddings: Embeddings
+    :param cache_dir: cache directory, None to leave `embeddings` uncached
+    :type cache_dir: Optional[str]
+    :param max_bytes: size cap of the cached vectors, defaults to 2GiB
+    :type max_bytes: int, optional
+    :return: the embedding function to use
+    :rtype: Embeddings
+    """
+    if cache_dir is None:
+        return embeddings
+
+    normalize = embeddings.encode_kwargs.get("normalize_embeddings", False)
+    cache = EmbeddingCache(cache_dir, embeddings.model_name, normalize, max_bytes)
+    return CachedEmbeddings(embeddings, cache)
@@ -0,0 +1,299 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+
+import numpy as np
+import torch
+from langchain.embeddings.sentence_transformer import SentenceTransformerEmbeddings
+from langchain_core.embeddings import Embeddings
+from sentence_transformers import SentenceTransformer
+
+from devices import (
+    available_cores,
+    default_encode_processes,
+    resolve_device,
+    split_cores,
+)
+
+# the model loaded by each process of an encoding pool
+_worker_model = None
+
+
+def _init_worker(model_name: str, core_sets, encode_kwargs: Dict) -> None:
+    global _worker_model
+    # each process takes its own set of cores and runs one torch thread per
+    # core on it, instead of every process spawning a thread per machine core
+    cores = core_sets.get()
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    _worker_model = (SentenceTransformer(model_name, device="cpu"), encode_kwargs)
+
+
+def _encode_in_worker(texts: List[str]) -> np.ndarray:
+    model, encode_kwargs = _worker_model
+    return model.encode(
+        texts,
+        batch_size=len(texts),
+        convert_to_numpy=True,
+        show_progress_bar=False,
+        **encode_kwargs,
+    )
+
+
+class BucketedEmbeddings(Embeddings):
+    """Sentence-transformer embeddings encoded in length-sorted batches sized
+    by a token budget instead of a fixed count.
+
+    A transformer pads every text of a batch to the longest one, so with a
+    fixed batch size a few long chunks make most of a batch padding. Here
+    texts are tokenized once, sorted by token length and cut into batches
+    whose padded size, `len(batch) * longest`, stays under `max_batch_tokens`:
+    short texts go in large batches, long texts in small ones. Vectors are
+    returned in the original order.
+
+    The device defaults to the best one available. On CPU, batches are
+    sharded across `processes` worker processes, each loading the model once
+    and pinned to its own share of the cores, which scales with the core
+    count where a single PyTorch process mostly contends with itself.
+    """
+
+    def __init__(
+        self,
+        model_name: str = "BAAI/bge-large-en-v1.5",
+        device: Optional[str] = None,
+        normalize_embeddings: bool = True,
+        max_batch_tokens: int = 16384,
+        max_batch_size: int = 512,
+        processes: Optional[int] = None,
+    ):
+        self.model_name = model_name
+        self.device = resolve_device(device)
+        self.encode_kwargs = {"normalize_embeddings": normalize_embeddings}
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        # the in-process model tokenizes, and encodes single queries
+        self.model = SentenceTransformer(model_name, device=self.device)
+        if self.device != "cpu":
+            processes = 1
+        elif processes is None:
+            processes = default_encode_processes(self.device)
+        # a worker per set of cores: `split_cores` gives at most one per core,
+        # and a worker without one would wait for it forever
+        self.processes = max(1, min(processes, len(available_cores())))
+        self._pool = None
+
+    @property
+    def pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # spawn rather than fork: forking after torch has started its
+            # thread pools can deadlock the children
+            context = multiprocessing.get_context("spawn")
+            core_sets = context.Queue()
+            for cores in split_cores(self.processes):
+                core_sets.put(cores)
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.processes,
+                mp_context=context,
+                initializer=_init_worker,
+                initargs=(self.model_name, core_sets, self.encode_kwargs),
+            )
+        return self._pool
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def token_lengths(self, texts: List[str]) -> List[int]:
+        """Number of tokens the model sees for each text, after truncation.
+
+        :param texts: texts to measure
+        :type texts: List[str]
+        :return: token counts, special tokens included
+        :rtype: List[int]
+        """
+        input_ids = self.model.tokenizer(
+            texts, truncation=True, max_length=self.model.max_seq_length
+        )["input_ids"]
+        return [len(ids) for ids in input_ids]
+
+    def plan_batches(self, lengths: List[int]) -> List[List[int]]:
+        """Group text indexes into batches under the padded token budget.
+
+        :param lengths: token length of each text
+        :type lengths: List[int]
+        :return: batches of indexes into `lengths`
+        :rtype: List[List[int]]
+        """
+        order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+        batches = []
+        batch = []
+        for i in order:
+            # sorted longest first, so the first text sets the padded length
+            longest = lengths[batch[0]] if batch else lengths[i]
+            if batch and (
+                (len(batch) + 1) * longest > self.max_batch_tokens
+                or len(batch) == self.max_batch_size
+            ):
+                batches.append(batch)
+                batch = []
+            batch.append(i)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """Embed texts batch by batch, in their original order.
+
+        :param texts: texts to embed
+        :type texts: List[str]
+        :return: one embedding per row
+        :rtype: np.ndarray
+        """
+        batches = self.plan_batches(self.token_lengths(texts))
+        batch_texts = ([texts[i] for i in batch] for batch in batches)
+        if self.processes > 1 and len(batches) > 1:
+            encoded = self.pool.map(_encode_in_worker, batch_texts)
+        else:
+            encoded = (
+                self.model.encode(
+                    sub_batch,
+                    batch_size=len(sub_batch),
+                    convert_to_numpy=True,
+                    show_progress_bar=False,
+                    **self.encode_kwargs,
+                )
+                for sub_batch in batch_texts
+            )
+
+        embeddings = None
+        for batch, vectors in zip(batches, encoded):
+            if embeddings is None:
+                embeddings = np.empty((len(texts), vectors.shape[1]), vectors.dtype)
+            embeddings[batch] = vectors
+        if embeddings is None:
+            return np.empty((0, self.model.get_sentence_embedding_dimension()))
+        return embeddings
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        texts = [text.replace("\n", " ") for text in texts]
+        return self.encode(texts).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+def benchmark(
+    texts: List[str],
+    model_name: str,
+    device: Optional[str],
+    max_batch_tokens: int,
+    processes: Optional[int] = None,
+):
+    """Compare chunks/sec of `SentenceTransformerEmbeddings` and
+    `BucketedEmbeddings` on the same texts.
+
+    :param texts: texts to embed
+    :type texts: List[str]
+    :param model_name: sentence-transformers model
+    :type model_name: str
+    :param device: device to run on, autodetected if None
+    :type device: Optional[str]
+    :param max_batch_tokens: padded token budget of a bucketed batch
+    :type max_batch_tokens: int
+    :param processes: CPU encoding processes of the bucketed embeddings,
+        defaults to one per 4 cores
+    :type processes: Optional[int], optional
+    """
+    device = resolve_device(device)
+    baseline = SentenceTransformerEmbeddings(
+        model_name=model_name,
+        model_kwargs={"device": device},
+        encode_kwargs={"normalize_embeddings": True},
+    )
+    bucketed = BucketedEmbeddings(
+        model_name,
+        device=device,
+        max_batch_tokens=max_batch_tokens,
+        processes=processes,
+    )
+
+    # warm up both so model loading (and starting the pool) isn't timed
+    baseline.embed_documents(texts[:8])
+    bucketed.embed_documents(texts[: 8 * bucketed.processes])
+
+    start = time.time()
+    expected = np.asarray(baseline.embed_documents(texts))
+    baseline_seconds = time.time() - start
+
+    start = time.time()
+    actual = np.asarray(bucketed.embed_documents(texts))
+    bucketed_seconds = time.time() - start
+    bucketed.close()
+
+    lengths = bucketed.token_lengths(texts)
+    n_batches = len(bucketed.plan_batches(lengths))
+    print(f"{len(texts)} chunks, mean {np.mean(lengths):.0f} tokens, on {device}")
+    print(f"default batching:  {len(texts) / baseline_seconds:8.1f} chunks/s")
+    print(
+        f"bucketed batching: {len(texts) / bucketed_seconds:8.1f} chunks/s "
+        f"({n_batches} batches of <= {max_batch_tokens} tokens, "
+        f"{bucketed.processes} processes)"
+    )
+    print(f"speedup: {baseline_seconds / bucketed_seconds:.2f}x")
+    print(f"max abs difference: {np.abs(expected - actual).max():.2e}")
+
+
+if __name__ == "__main__":
+    import argparse
+    import glob
+
+    from embed_documents import chunk_document
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--doc_dir", type=str, required=True, help="path to documents to embed"
+    )
+    parser.add_argument(
+        "--model_name",
+        type=str,
+        default="BAAI/bge-large-en-v1.5",
+        help="sentence-transformers model to benchmark",
+    )
+    parser.add_argument(
+        "--device", type=str, default=None, help="device to run on, autodetected"
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=None,
+        help="CPU encoding processes, defaults to one per 4 cores",
+    )
+    parser.add_argument(
+        "--max_batch_tokens",
+        type=int,
+        default=16384,
+        help="padded token budget of a bucketed batch",
+    )
+    parser.add_argument(
+        "--limit", type=int, default=1000, help="maximum number of chunks to embed"
+    )
+
+    args = parser.parse_args()
+
+    texts = []
+    for doc_path in sorted(glob.glob(f"{args.doc_dir}/*.pdf")):
+        texts += [chunk.page_content for chunk in chunk_document(doc_path)]
+        if len(texts) >= args.limit:
+            break
+
+    benchmark(
+        texts[: args.limit],
+        args.model_name,
+        args.device,
+        args.max_batch_tokens,
+        args.processes,
+    )
@@ -0,0 +1,140 @@
+import time
+from typing import Dict, List, Optional, Tuple
+
+from langchain_core.documents import Document
+from langchain_core.runnables import RunnableLambda
+
+from bm25_index import BM25Index
+from latency import LatencyWindow
+from manifest import chunk_id
+
+# the usual RRF constant, damping the weight of the very first ranks
+RRF_K = 60
+
+
+def stored_chunk_id(chunk: Document) -> str:
+    """Id a retrieved chunk was written under, in the vector store and the
+    BM25 index alike: its `chunk_id`, without the `duplicates` list
+    deduplication later adds to the stored metadata."""
+    if "duplicates" not in chunk.metadata:
+        return chunk_id(chunk)
+    metadata = {k: v for k, v in chunk.metadata.items() if k != "duplicates"}
+    return chunk_id(Document(page_content=chunk.page_content, metadata=metadata))
+
+
+def reciprocal_rank_fusion(
+    rankings: List[List[Document]], k: int = 4, rrf_k: int = RRF_K
+) -> List[Tuple[Document, float]]:
+    """Merge rankings of chunks by reciprocal rank fusion.
+
+    A chunk scores the sum of 1 / (`rrf_k` + rank) over the rankings it
+    appears in, so chunks found by several retrievers rise to the top
+    whatever the scale of each retriever's own scores. Chunks are matched by
+    `stored_chunk_id`, so the same text from two sources stays two chunks.
+
+    :param rankings: chunks of each retriever, best first
+    :type rankings: List[List[Document]]
+    :param k: number of chunks to return
+    :type k: int, optional
+    :param rrf_k: rank offset
+    :type rrf_k: int, optional
+    :return: (chunk, fused score) pairs, best first
+    :rtype: List[Tuple[Document, float]]
+    """
+    scores: Dict[str, float] = {}
+    documents: Dict[str, Document] = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking, 1):
+            id_ = stored_chunk_id(doc)
+            scores[id_] = scores.get(id_, 0.0) + 1 / (rrf_k + rank)
+            documents.setdefault(id_, doc)
+    best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+    return [(documents[id_], score) for id_, score in best]
+
+
+class HybridSearch:
+    """Dense and BM25 retrieval merged by reciprocal rank fusion.
+
+    Each search takes the `candidates` best chunks of the vector store and
+    of the BM25 index and keeps the `k` best fused ones, so chunks that only
+    match on an exact token (a table name, an acronym) are found without
+    raising `k`. The latency of each side is recorded separately.
+
+    :param vectorstore: `PGVector`, `LocalVectorStore`, `RetrievalService` or
+        anything else with `similarity_search_with_score`
+    :param index: BM25 index of the same chunks
+    :type index: BM25Index
+    :param candidates: chunks taken from each side, defaults to 20 or 4 * k
+    :type candidates: Optional[int], optional
+    :param rrf_k: rank offset of the fusion
+    :type rrf_k: int, optional
+    """
+
+    def __init__(
+        self,
+        vectorstore,
+        index: BM25Index,
+        candidates: Optional[int] = None,
+        rrf_k: int = RRF_K,
+    ):
+        self.vectorstore = vectorstore
+        self.index = index
+        self.candidates = candidates
+        self.rrf_k = rrf_k
+        self.latencies = {"dense": LatencyWindow(), "lexical": LatencyWindow()}
+
+    def similarity_search_with_score(
+        self, query: str, k: int = 4, filter: Optional[dict] = None
+    ) -> List[Tuple[Document, float]]:
+        """The `k` best chunks for `query` with their fused scores.
+
+        Unlike the vector stores' cosine distances, a higher score is better.
+
+        :param query: search text
+        :type query: str
+        :param k: number of chunks to return
+        :type k: int, optional
+        :param filter: metadata filter, applied to both sides
+        :type filter: Optional[dict], optional
+        :return: (chunk, fused score) pairs, best first
+        :rtype: List[Tuple[Document, float]]
+        """
+        candidates = self.candidates or max(20, 4 * k)
+
+        start = time.perf_counter()
+        # not every store takes a filter
+        kwargs = {"filter": filter} if filter else {}
+        dense = self.vectorstore.similarity_search_with_score(
+            query, k=candidates, **kwargs
+        )
+        self.latencies["dense"].record(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        lexical = self.index.search(query, candidates, filter)
+        self.latencies["lexical"].record(time.perf_counter() - start)
+
+        return reciprocal_rank_fusion(
+            [[doc for doc, _ in dense], [doc for doc, _ in lexical]], k, self.rrf_k
+        )
+
+    def similarity_search(
+        self, query: str, k: int = 4, filter: Optional[dict] = None
+    ) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, filter)]
+
+    def as_retriever(self, search_kwargs: Optional[dict] = None) -> RunnableLambda:
+        """A runnable from a query to its chunks, usable in a chain like a
+        vector store retriever."""
+        search_kwargs = search_kwargs or {}
+        return RunnableLambda(
+            lambda query: self.similarity_search(query, **search_kwargs)
+        )
+
+    def stats(self) -> Dict:
+        """p50/p99 latency in ms of each side over the last (up to) 10000
+        searches.
+
+        :return: {"dense": {...}, "lexical": {...}}
+        :rtype: Dict
+        """
+        return {side: window.stats() for side, window in self.latencies.items()}
@@ -0,0 +1,38 @@
+import threading
+from collections import deque
+from typing import Dict
+
+import numpy as np
+
+
+class LatencyWindow:
+    """Latencies of the last `maxlen` searches, recorded and summarized from
+    any number of threads (e.g. a Flask server's) without either seeing the
+    window change under it.
+
+    :param maxlen: searches kept
+    :type maxlen: int, optional
+    """
+
+    def __init__(self, maxlen: int = 10000):
+        self._latencies = deque(maxlen=maxlen)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def stats(self) -> Dict:
+        """Searches in the window and their p50/p99 latency in ms.
+
+        :return: {"n_queries": int, "p50_ms": float, "p99_ms": float}, without
+            the percentiles before the first search
+        :rtype: Dict
+        """
+        with self._lock:
+            latencies = np.array(self._latencies)
+        stats = {"n_queries": len(latencies)}
+        if len(latencies):
+            p50, p99 = np.percentile(latencies * 1000, [50, 99])
+            stats["p50_ms"], stats["p99_ms"] = p50, p99
+        return stats
@@ -0,0 +1,485 @@
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import uuid
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from manifest import metadata_json
+from metadata_filter import matches
+
+# rows scored at a time by an exact search, bounding its memory
+SCAN_BLOCK = 65536
+
+
+class LocalVectorStore(VectorStore):
+    """A vector store kept in a local directory, searched in-process.
+
+    For corpora small enough to search on one machine, this skips the
+    Postgres round trip and SQL parsing of `PGVector` while keeping its
+    search surface (`similarity_search_with_score`, `as_retriever`,
+    `add_documents`, `delete`), cosine distances included, so scripts can
+    switch to it with a single flag.
+
+    Each collection is a directory under `path`: the vectors are float32
+    rows of a memory-mapped `vectors.npy`, and a sqlite file maps each row
+    to its id, text and metadata. Searches scan the vectors exactly, or
+    with `hnsw` walk an HNSW graph (from the optional `hnswlib` package)
+    saved next to them by `persist`. Rows added since the graph was last
+    saved are added to it again when the store is opened.
+
+    :param path: directory of the store
+    :type path: str
+    :param embedding_function: embeddings of the texts and queries
+    :type embedding_function: Embeddings
+    :param collection_name: collection to open, defaults to "embeddings"
+    :type collection_name: str, optional
+    :param pre_delete_collection: start the collection over
+    :type pre_delete_collection: bool, optional
+    :param hnsw: search with an HNSW graph, defaults to what the collection
+        was created with (exact search for a new one)
+    :type hnsw: Optional[bool], optional
+    :param m: neighbours per node of a new graph
+    :type m: int, optional
+    :param ef_construction: candidate list size when building the graph
+    :type ef_construction: int, optional
+    :param ef_search: candidate list size when searching the graph
+    :type ef_search: int, optional
+    """
+
+    def __init__(
+        self,
+        path: str,
+        embedding_function: Embeddings,
+        collection_name: str = "embeddings",
+        pre_delete_collection: bool = False,
+        hnsw: Optional[bool] = None,
+        m: int = 16,
+        ef_construction: int = 200,
+        ef_search: int = 64,
+    ):
+        self.embedding_function = embedding_function
+        self.collection_name = collection_name
+        self.path = os.path.join(path, collection_name)
+        if pre_delete_collection and os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.makedirs(self.path, exist_ok=True)
+
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(
+            os.path.join(self.path, "documents.sqlite"),
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS documents (row INTEGER PRIMARY KEY, "
+            "id TEXT UNIQUE NOT NULL, document TEXT NOT NULL, cmetadata TEXT, "
+            "deleted INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)"
+        )
+        self.settings = dict(self._db.execute("SELECT key, value FROM settings"))
+        if hnsw is not None:
+            self._set("hnsw", json.dumps(hnsw))
+        self.hnsw = hnsw if hnsw is not None else self._get("hnsw", False)
+        self.m, self.ef_construction = m, ef_construction
+        self.ef_search = ef_search
+
+        self.n_rows = self._db.execute(
+            "SELECT coalesce(max(row) + 1, 0) FROM documents"
+        ).fetchone()[0]
+        self.deleted = np.zeros(self.n_rows, dtype=bool)
+        deleted_rows = self._db.execute("SELECT row FROM documents WHERE deleted = 1")
+        self.deleted[[row for row, in deleted_rows]] = True
+        self._vectors: Optional[np.memmap] = None
+        self._graph = None
+        self._graph_dirty = False
+        if self.n_rows:
+            self._open_vectors()
+            if self.hnsw:
+                self._open_graph()
+
+    def _get(self, key: str, default: Any = None) -> Any:
+        value = self.settings.get(key)
+        return default if value is None else json.loads(value)
+
+    def _set(self, key: str, value: str) -> None:
+        self._db.execute(
+            "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, value)
+        )
+        self.settings[key] = value
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self.embedding_function
+
+    def _open_vectors(self, dim: Optional[int] = None, n_rows: int = 0) -> np.memmap:
+        """The vectors file, grown to hold at least `n_rows` rows."""
+        path = os.path.join(self.path, "vectors.npy")
+        if self._vectors is None and os.path.exists(path):
+            self._vectors = np.lib.format.open_memmap(path, mode="r+")
+        if self._vectors is None or self._vectors.shape[0] < n_rows:
+            # capacity doubles, so rows are copied O(1) times on average
+            capacity = max(1024, n_rows, 2 * self.n_rows)
+            dim = dim if self._vectors is None else self._vectors.shape[1]
+            grown_path = path + ".tmp"
+            grown = np.lib.format.open_memmap(
+                grown_path, mode="w+", dtype=np.float32, shape=(capacity, dim)
+            )
+            if self._vectors is not None:
+                grown[: self.n_rows] = self._vectors[: self.n_rows]
+            grown.flush()
+            del grown
+            os.replace(grown_path, path)
+            self._vectors = np.lib.format.open_memmap(path, mode="r+")
+        return self._vectors
+
+    def _open_graph(self):
+        """The HNSW graph over the vectors, loaded or built as needed."""
+        if self._graph is not None:
+            return self._graph
+        try:
+            import hnswlib
+        except ImportError as e:
+            raise ImportError(
+                "Searching a local store with HNSW needs `pip install hnswlib`"
+            ) from e
+
+        dim = self._vectors.shape[1]
+        graph = hnswlib.Index(space="cosine", dim=dim)
+        graph_path = os.path.join(self.path, "hnsw.bin")
+        if os.path.exists(graph_path):
+            graph.load_index(graph_path, max_elements=max(self.n_rows, 1))
+        else:
+            graph.init_index(
+                max_elements=max(self.n_rows, 1024),
+                ef_construction=self._get("ef_construction", self.ef_construction),
+                M=self._get("m", self.m),
+            )
+            self._set("m", json.dumps(self.m))
+            self._set("ef_construction", json.dumps(self.ef_construction))
+        self._graph = graph
+
+        # rows written after the graph was last persisted
+        n_indexed = graph.get_current_count()
+        if n_indexed < self.n_rows:
+            self._index_rows(n_indexed, self.n_rows)
+        for row in np.flatnonzero(self.deleted[:n_indexed]):
+            try:
+                graph.mark_deleted(int(row))
+            except RuntimeError:
+                pass  # already deleted when the graph was saved
+        return graph
+
+    def _index_rows(self, start: int, stop: int) -> None:
+        graph = self._graph
+        if graph.get_max_elements() < stop:
+            graph.resize_index(max(stop, 2 * graph.get_max_elements()))
+        graph.add_items(self._vectors[start:stop], np.arange(start, stop))
+        self._graph_dirty = True
+
+    def add_embeddings(
+        self,
+        texts: List[str],
+        embeddings: List[List[float]],
+        metadatas: Optional[List[Dict]] = None,
+        ids: Optional[List[str]] = None,
+    ) -> List[str]:
+        """Store texts with their precomputed embeddings.
+
+        :param texts: chunk texts
+        :type texts: List[str]
+        :param embeddings: one embedding per text
+        :type embeddings: List[List[float]]
+        :param metadatas: one metadata dict per text
+        :type metadatas: Optional[List[Dict]], optional
+        :param ids: one id per text, defaults to random ones; an existing id
+            is replaced
+        :type ids: Optional[List[str]], optional
+        :return: the ids
+        :rtype: List[str]
+        """
+        if not texts:
+            return []
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        metadatas = metadatas or [{} for _ in texts]
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        with self._lock:
+            self.delete(ids)
+            start, stop = self.n_rows, self.n_rows + len(texts)
+            store = self._open_vectors(vectors.shape[1], stop)
+            if store.shape[1] != vectors.shape[1]:
+                raise ValueError(
+                    f"Store at {self.path} holds {store.shape[1]}-d vectors, "
+                    f"got {vectors.shape[1]}-d"
+                )
+            # write the vectors before the rows point at them
+            store[start:stop] = vectors
+            store.flush()
+            self._db.execute("BEGIN")
+            self._db.executemany(
+                "INSERT INTO documents (row, id, document, cmetadata) "
+                "VALUES (?, ?, ?, ?)",
+                [
+                    (start + i, id_, text, metadata_json(metadata))
+                    for i, (id_, text, metadata) in enumerate(
+                        zip(ids, texts, metadatas)
+                    )
+                ],
+            )
+            self._db.execute("COMMIT")
+            self.n_rows = stop
+            self.deleted = np.concatenate(
+                [self.deleted, np.zeros(len(texts), dtype=bool)]
+            )
+            if self.hnsw:
+                self._open_graph()
+                if self._graph.get_current_count() < stop:
+                    self._index_rows(start, stop)
+        return ids
+
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: Optional[List[Dict]] = None,
+        ids: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> List[str]:
+        texts = list(texts)
+        embeddings = self.embedding_function.embed_documents(texts)
+        return self.add_embeddings(texts, embeddings, metadatas, ids)
+
+    def delete(self, ids: Optional[List[str]] = None, **kwargs: Any) -> None:
+        """Delete rows by id. Rows are only marked deleted, their space is
+        not reclaimed."""
+        if not ids:
+            return
+        with self._lock:
+            rows = []
+            for i in range(0, len(ids), 500):
+                part = ids[i : i + 500]
+                placeholders = ",".join("?" * len(part))
+                rows += [
+                    row
+                    for row, in self._db.execute(
+                        f"SELECT row FROM documents WHERE id IN ({placeholders})",
+                        part,
+                    )
+                ]
+            if not rows:
+                return
+            self._db.execute("BEGIN")
+            # freed ids can be added again
+            self._db.executemany(
+                "UPDATE documents SET deleted = 1, id = ? WHERE row = ?",
+                [(f"deleted:{row}", row) for row in rows],
+            )
+            self._db.execute("COMMIT")
+            self.deleted[rows] = True
+            if self._graph is not None:
+                for row in rows:
+                    self._graph.mark_deleted(row)
+                self._graph_dirty = True
+
+    def extend_metadata(self, lists_by_id: Dict[str, Dict[str, List]]) -> None:
+        """Append items to list keys of the metadata of stored rows, creating
+        the lists that don't exist yet.
+
+        :param lists_by_id: items to append, by key and row id
+        :type lists_by_id: Dict[str, Dict[str, List]]
+        """
+        with self._lock:
+            self._db.execute("BEGIN")
+            for id_, lists in lists_by_id.items():
+                row = self._db.execute(
+                    "SELECT cmetadata FROM documents WHERE id = ?", (id_,)
+                ).fetchone()
+                if row is not None:
+                    metadata = json.loads(row[0] or "{}")
+                    for key, items in lists.items():
+                        metadata[key] = metadata.get(key, []) + items
+                    self._db.execute(
+                        "UPDATE documents SET cmetadata = ? WHERE id = ?",
+                        (metadata_json(metadata), id_),
+                    )
+            self._db.execute("COMMIT")
+
+    def iter_texts(self) -> Iterator[Tuple[str, str]]:
+        """(text, id) of every stored row, in the order they were added."""
+        last_row = -1
+        while True:
+            # a page at a time, not holding the lock while the caller works
+            with self._lock:
+                rows = self._db.execute(
+                    "SELECT row, document, id FROM documents "
+                    "WHERE deleted = 0 AND row > ? ORDER BY row LIMIT 10000",
+                    (last_row,),
+                ).fetchall()
+            if not rows:
+                return
+            for _, text, id_ in rows:
+                yield text, id_
+            last_row = rows[-1][0]
+
+    def persist(self) -> None:
+        """Save the HNSW graph, if it changed. Vectors and documents are
+        written as they are added."""
+        with self._lock:
+            if self._graph is not None and self._graph_dirty:
+                graph_path = os.path.join(self.path, "hnsw.bin")
+                self._graph.save_index(graph_path + ".tmp")
+                os.replace(graph_path + ".tmp", graph_path)
+                self._graph_dirty = False
+
+    def version(self) -> int:
+        """Changes whenever documents are added, deleted or updated, by this
+        or any other process, e.g. to drop cached answers built on them.
+
+        :return: modification time of the documents, in ns
+        :rtype: int
+        """
+        return os.stat(os.path.join(self.path, "documents.sqlite")).st_mtime_ns
+
+    def _documents(self, rows: List[int]) -> Dict[int, Document]:
+        documents = {}
+        for i in range(0, len(rows), 500):
+            part = rows[i : i + 500]
+            placeholders = ",".join("?" * len(part))
+            for row, document, metadata in self._db.execute(
+                "SELECT row, document, cmetadata FROM documents "
+                f"WHERE row IN ({placeholders})",
+                part,
+            ):
+                documents[row] = Document(
+                    page_content=document, metadata=json.loads(metadata or "{}")
+                )
+        return documents
+
+    def _filtered_rows(self, filter: Dict) -> np.ndarray:
+        return np.array(
+            [
+                row
+                for row, metadata in self._db.execute(
+                    "SELECT row, cmetadata FROM documents WHERE deleted = 0"
+                )
+                if matches(json.loads(metadata or "{}"), filter)
+            ],
+            dtype=np.int64,
+        )
+
+    def _exact_search(
+        self, query: np.ndarray, k: int, rows: Optional[np.ndarray] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """The `k` nearest rows by cosine distance, scanning every live row
+        (or only `rows`) a block at a time."""
+        query = query / (np.linalg.norm(query) or 1.0)
+        best_rows = np.empty(0, dtype=np.int64)
+        best_distances = np.empty(0, dtype=np.float32)
+        n = self.n_rows if rows is None else len(rows)
+        for start in range(0, n, SCAN_BLOCK):
+            if rows is None:
+                stop = min(n, start + SCAN_BLOCK)
+                live = ~self.deleted[start:stop]
+                block_rows = np.arange(start, stop)[live]
+                vectors = self._vectors[start:stop][live]
+            else:
+                block_rows = rows[start : start + SCAN_BLOCK]
+                vectors = self._vectors[block_rows]
+            norms = np.linalg.norm(vectors, axis=1)
+            distances = 1 - (vectors @ query) / np.where(norms > 0, norms, 1.0)
+            best_rows = np.concatenate([best_rows, block_rows])
+            best_distances = np.concatenate([best_distances, distances])
+            if len(best_rows) > k:
+                keep = np.argpartition(best_distances, k)[:k]
+                best_rows, best_distances = best_rows[keep], best_distances[keep]
+        order = np.argsort(best_distances, kind="stable")
+        return best_rows[order], best_distances[order]
+
+    def similarity_search_with_score_by_vector(
+        self, embedding: List[float], k: int = 4, filter: Optional[Dict] = None
+    ) -> List[Tuple[Document, float]]:
+        """Nearest chunks to an embedding, with their cosine distances.
+
+        :param embedding: query embedding
+        :type embedding: List[float]
+        :param k: number of chunks to return
+        :type k: int, optional
+        :param filter: metadata filter, see `metadata_filter`
+        :type filter: Optional[Dict], optional
+        :return: (chunk, distance) pairs, closest first
+        :rtype: List[Tuple[Document, float]]
+        """
+        query = np.asarray(embedding, dtype=np.float32)
+        with self._lock:
+            n_live = self.n_rows - int(self.deleted.sum())
+            k = min(k, n_live)
+            if k <= 0:
+                return []
+            if filter:
+                # exact over the matching rows, a graph walk could miss them
+                rows, distances = self._exact_search(
+                    query, k, self._filtered_rows(filter)
+                )
+            elif self.hnsw:
+                graph = self._open_graph()
+                graph.set_ef(max(self.ef_search, k))
+                rows, distances = graph.knn_query(query, k=k)
+                rows, distances = rows[0].astype(np.int64), distances[0]
+            else:
+                rows, distances = self._exact_search(query, k)
+            documents = self._documents(rows.tolist())
+        return [
+            (documents[row], float(distance))
+            for row, distance in zip(rows.tolist(), distances)
+        ]
+
+    def similarity_search_with_score(
+        self, query: str, k: int = 4, filter: Optional[Dict] = None
+    ) -> List[Tuple[Document, float]]:
+        embedding = self.embedding_function.embed_query(query)
+        return self.similarity_search_with_score_by_vector(embedding, k, filter)
+
+    def similarity_search_by_vector(
+        self,
+        embedding: List[float],
+        k: int = 4,
+        filter: Optional[Dict] = None,
+        **kwargs: Any,
+    ) -> List[Document]:
+        return [
+            doc
+            for doc, _ in self.similarity_search_with_score_by_vector(
+                embedding, k, filter
+            )
+        ]
+
+    def similarity_search(
+        self, query: str, k: int = 4, filter: Optional[Dict] = None, **kwargs: Any
+    ) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, filter)]
+
+    def _select_relevance_score_fn(self) -> Callable[[float], float]:
+        # cosine distances, like PGVector's default
+        return self._cosine_relevance_score_fn
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: List[str],
+        embedding: Embeddings,
+        metadatas: Optional[List[Dict]] = None,
+        path: str = "local_store",
+        ids: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> "LocalVectorStore":
+        store = cls(path, embedding, **kwargs)
+        store.add_texts(texts, metadatas, ids)
+        store.persist()
+        return store
@@ -0,0 +1,447 @@
+import time
+from typing import Dict, List, Optional
+from urllib.parse import quote
+
+import numpy as np
+import psycopg2
+
+from bulk_writer import COLLECTION_TABLE, DEFERRED_INDEX_TABLE, EMBEDDING_TABLE
+from db_config import CONNECTION_STRING, psycopg2_dsn
+
+# PGVector's default distance strategy is cosine
+OPERATOR_CLASS = "vector_cosine_ops"
+
+
+def index_name(method: str) -> str:
+    return f"{EMBEDDING_TABLE}_{method}_idx"
+
+
+def with_search_params(
+    connection_string: str,
+    ef_search: Optional[int] = None,
+    probes: Optional[int] = None,
+) -> str:
+    """Add query-time index settings to a connection string.
+
+    The settings are passed as libpq `options`, so they apply to every
+    session `PGVector` opens without touching its queries.
+
+    :param connection_string: database url
+    :type connection_string: str
+    :param ef_search: `hnsw.ef_search`, candidates kept while searching HNSW
+    :type ef_search: Optional[int], optional
+    :param probes: `ivfflat.probes`, lists scanned by an IVFFlat search
+    :type probes: Optional[int], optional
+    :return: the url with the settings applied
+    :rtype: str
+    """
+    settings = []
+    if ef_search is not None:
+        settings.append(f"-c hnsw.ef_search={ef_search}")
+    if probes is not None:
+        settings.append(f"-c ivfflat.probes={probes}")
+    if not settings:
+        return connection_string
+    separator = "&" if "?" in connection_string else "?"
+    return f"{connection_string}{separator}options={quote(' '.join(settings))}"
+
+
+def index_options(
+    method: str, m: int = 16, ef_construction: int = 64, lists: int = 100
+) -> Dict[str, int]:
+    """The build parameters an index of `method` takes, with their values."""
+    if method == "hnsw":
+        return {"m": int(m), "ef_construction": int(ef_construction)}
+    if method == "ivfflat":
+        return {"lists": int(lists)}
+    raise ValueError(f"Unknown index method {method!r}")
+
+
+def _create_index(cur, method: str, options: Dict[str, int]) -> None:
+    params = ", ".join(f"{name} = {value}" for name, value in options.items())
+    cur.execute(
+        f"CREATE INDEX {index_name(method)} ON {EMBEDDING_TABLE} "
+        f"USING {method} (embedding {OPERATOR_CLASS}) WITH ({params})"
+    )
+
+
+def ensure_fixed_dimensions(conn) -> int:
+    """Give the embedding column a fixed dimension, which pgvector requires
+    to index it.
+
+    LangChain creates the column as a plain `vector`. Every stored vector
+    must have the same length for this to work.
+
+    :param conn: psycopg2 connection
+    :return: the dimension of the column
+    :rtype: int
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT atttypmod FROM pg_attribute "
+            "WHERE attrelid = %s::regclass AND attname = 'embedding'",
+            (EMBEDDING_TABLE,),
+        )
+        dim = cur.fetchone()[0]
+        if dim > 0:
+            return dim
+
+        cur.execute(f"SELECT DISTINCT vector_dims(embedding) FROM {EMBEDDING_TABLE}")
+        dims = [row[0] for row in cur.fetchall()]
+        if len(dims) != 1:
+            raise ValueError(f"Cannot index embeddings of mixed dimensions {dims}")
+
+        print(f"Setting the embedding column to vector({dims[0]})")
+        cur.execute(
+            f"ALTER TABLE {EMBEDDING_TABLE} "
+            f"ALTER COLUMN embedding TYPE vector({dims[0]})"
+        )
+    conn.commit()
+    return dims[0]
+
+
+def release_fixed_dimensions(conn, dim: int) -> List[str]:
+    """Let the embedding column take vectors of `dim` dimensions again, e.g.
+    before a collection is rebuilt with `--reduce` (or without it).
+
+    A column fixed to another dimension by `ensure_fixed_dimensions` is
+    turned back into a plain `vector`, dropping the indexes on it first:
+    they can only be built again once every stored vector has the same
+    dimension.
+
+    :param conn: psycopg2 connection
+    :param dim: dimension of the vectors about to be written
+    :type dim: int
+    :return: names of the dropped indexes
+    :rtype: List[str]
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT atttypmod FROM pg_attribute "
+            "WHERE attrelid = %s::regclass AND attname = 'embedding'",
+            (EMBEDDING_TABLE,),
+        )
+        fixed = cur.fetchone()[0]
+        if fixed <= 0 or fixed == dim:
+            return []
+
+        # vector indexes, and the halfvec and binary expression indexes
+        cur.execute(
+            "SELECT c.relname FROM pg_index x "
+            "JOIN pg_class c ON c.oid = x.indexrelid "
+            "WHERE x.indrelid = %s::regclass "
+            "AND pg_get_indexdef(x.indexrelid) ~ '\\membedding\\M'",
+            (EMBEDDING_TABLE,),
+        )
+        dropped = [row[0] for row in cur.fetchall()]
+        for name in dropped:
+            cur.execute(f'DROP INDEX IF EXISTS "{name}"')
+        # nor should a killed bulk load rebuild them
+        cur.execute("SELECT to_regclass(%s)", (DEFERRED_INDEX_TABLE,))
+        if cur.fetchone()[0] is not None:
+            cur.execute(
+                f"DELETE FROM {DEFERRED_INDEX_TABLE} "
+                "WHERE indexdef ~ '\\membedding\\M'"
+            )
+        cur.execute(f"ALTER TABLE {EMBEDDING_TABLE} ALTER COLUMN embedding TYPE vector")
+    conn.commit()
+    print(
+        f"Released the embedding column from vector({fixed}) for {dim} dimensions"
+        + (f", dropped indexes {', '.join(dropped)}" if dropped else "")
+    )
+    return dropped
+
+
+def build_index(
+    conn,
+    method: str = "hnsw",
+    m: int = 16,
+    ef_construction: int = 64,
+    lists: int = 100,
+    maintenance_work_mem: Optional[str] = None,
+) -> float:
+    """Create an HNSW or IVFFlat index over the embeddings.
+
+    :param conn: psycopg2 connection
+    :param method: "hnsw" or "ivfflat"
+    :type method: str, optional
+    :param m: HNSW links per node
+    :type m: int, optional
+    :param ef_construction: HNSW candidate list size while building
+    :type ef_construction: int, optional
+    :param lists: IVFFlat number of lists, roughly rows / 1000 is a good start
+    :type lists: int, optional
+    :param maintenance_work_mem: memory for the build, e.g. "2GB"; a build
+        that fits in memory is much faster
+    :type maintenance_work_mem: Optional[str], optional
+    :return: seconds spent building
+    :rtype: float
+    """
+    options = index_options(method, m, ef_construction, lists)
+
+    ensure_fixed_dimensions(conn)
+    start = time.time()
+    with conn.cursor() as cur:
+        if maintenance_work_mem is not None:
+            cur.execute("SET maintenance_work_mem = %s", (maintenance_work_mem,))
+        _create_index(cur, method, options)
+    conn.commit()
+    return time.time() - start
+
+
+def rebuild_index(
+    conn,
+    method: str = "hnsw",
+    m: Optional[int] = None,
+    ef_construction: Optional[int] = None,
+    lists: Optional[int] = None,
+    maintenance_work_mem: Optional[str] = None,
+) -> float:
+    """Rebuild an index, e.g. after a large load (IVFFlat lists are only
+    fitted to the data present at build time).
+
+    Without parameters the index is rebuilt with its current ones. Given
+    parameters replace those the index was built with, the others are kept;
+    the index is then dropped and created again in one transaction.
+
+    :param conn: psycopg2 connection
+    :param method: "hnsw" or "ivfflat"
+    :type method: str, optional
+    :param m: new HNSW links per node
+    :type m: Optional[int], optional
+    :param ef_construction: new HNSW candidate list size while building
+    :type ef_construction: Optional[int], optional
+    :param lists: new IVFFlat number of lists
+    :type lists: Optional[int], optional
+    :param maintenance_work_mem: memory for the build, e.g. "2GB"
+    :type maintenance_work_mem: Optional[str], optional
+    :raises ValueError: a parameter `method` does not take, or no index to
+        change the parameters of
+    :return: seconds spent rebuilding
+    :rtype: float
+    """
+    changed = {
+        name: value
+        for name, value in (
+            ("m", m),
+            ("ef_construction", ef_construction),
+            ("lists", lists),
+        )
+        if value is not None
+    }
+    unknown = sorted(set(changed) - set(index_options(method)))
+    if unknown:
+        raise ValueError(f"{method} indexes take no {', '.join(unknown)}")
+
+    start = time.time()
+    with conn.cursor() as cur:
+        if maintenance_work_mem is not None:
+            cur.execute("SET maintenance_work_mem = %s", (maintenance_work_mem,))
+        if not changed:
+            cur.execute(f"REINDEX INDEX {index_name(method)}")
+        else:
+            cur.execute(
+                "SELECT reloptions FROM pg_class WHERE relname = %s",
+                (index_name(method),),
+            )
+            row = cur.fetchone()
+            if row is None:
+                raise ValueError(f"No {index_name(method)} to rebuild, build it first")
+            # reloptions reads e.g. {m=16,ef_construction=64}
+            current = dict(option.split("=", 1) for option in row[0] or [])
+            options = index_options(method, **{**current, **changed})
+            cur.execute(f"DROP INDEX {index_name(method)}")
+            _create_index(cur, method, options)
+    conn.commit()
+    return time.time() - start
+
+
+def drop_index(conn, method: str = "hnsw") -> None:
+    with conn.cursor() as cur:
+        cur.execute(f"DROP INDEX IF EXISTS {index_name(method)}")
+    conn.commit()
+
+
+def _search(cur, collection_id: str, query: str, k: int) -> List[str]:
+    cur.execute(
+        f"SELECT custom_id FROM {EMBEDDING_TABLE} WHERE collection_id = %s "
+        "ORDER BY embedding <=> %s::vector LIMIT %s",
+        (collection_id, query, k),
+    )
+    return [row[0] for row in cur.fetchall()]
+
+
+def recall_report(
+    conn,
+    collection_name: str = "embeddings",
+    method: str = "hnsw",
+    search_values: Optional[List[int]] = None,
+    k: int = 10,
+    n_queries: int = 100,
+) -> List[Dict]:
+    """Measure recall@k and latency of the index against exact search.
+
+    Stored embeddings of the collection, sampled at random, are used as the
+    queries. Exact results come from the same query with index scans
+    disabled.
+
+    :param conn: psycopg2 connection
+    :param collection_name: collection to search
+    :type collection_name: str, optional
+    :param method: index method, "hnsw" or "ivfflat"
+    :type method: str, optional
+    :param search_values: `hnsw.ef_search` or `ivfflat.probes` values to try
+    :type search_values: Optional[List[int]], optional
+    :param k: number of neighbours retrieved
+    :type k: int, optional
+    :param n_queries: number of queries
+    :type n_queries: int, optional
+    :return: one row of results per setting, exact search first
+    :rtype: List[Dict]
+    """
+    setting = "hnsw.ef_search" if method == "hnsw" else "ivfflat.probes"
+    if search_values is None:
+        search_values = [10, 40, 100, 200] if method == "hnsw" else [1, 5, 10, 20]
+
+    with conn.cursor() as cur:
+        cur.execute(
+            f"SELECT uuid FROM {COLLECTION_TABLE} WHERE name = %s", (collection_name,)
+        )
+        collection_id = cur.fetchone()[0]
+        cur.execute(
+            f"SELECT embedding::text FROM {EMBEDDING_TABLE} "
+            "WHERE collection_id = %s ORDER BY random() LIMIT %s",
+            (collection_id, n_queries),
+        )
+        queries = [row[0] for row in cur.fetchall()]
+
+        def run(settings: Dict[str, str]):
+            for name, value in settings.items():
+                cur.execute(f"SET {name} = {value}")
+            results, latencies = [], []
+            for query in queries:
+                start = time.perf_counter()
+                results.append(_search(cur, collection_id, query, k))
+                latencies.append(time.perf_counter() - start)
+            cur.execute("RESET ALL")
+            return results, np.array(latencies) * 1000
+
+        exact, latencies = run({"enable_indexscan": "off"})
+        rows = [{"setting": "exact", "recall": 1.0, "latencies": latencies}]
+        for value in search_values:
+            approx, latencies = run({setting: str(int(value))})
+            recall = np.mean(
+                [len(set(a) & set(e)) / max(len(e), 1) for a, e in zip(approx, exact)]
+            )
+            rows.append(
+                {
+                    "setting": f"{setting}={value}",
+                    "recall": recall,
+                    "latencies": latencies,
+                }
+            )
+    conn.rollback()
+
+    print(f"recall@{k} over {len(queries)} queries")
+    print(f"{'setting':<22}{'recall':>8}{'p50 ms':>10}{'p95 ms':>10}{'QPS':>10}")
+    for row in rows:
+        p50, p95 = np.percentile(row["latencies"], [50, 95])
+        qps = len(row["latencies"]) / (row["latencies"].sum() / 1000)
+        print(
+            f"{row['setting']:<22}{row['recall']:>8.3f}{p50:>10.2f}{p95:>10.2f}{qps:>10.1f}"
+        )
+    return rows
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "command",
+        choices=["build", "rebuild", "drop", "report"],
+        help="what to do with the index",
+    )
+    parser.add_argument(
+        "--method", type=str, default="hnsw", choices=["hnsw", "ivfflat"]
+    )
+    parser.add_argument(
+        "--m",
+        type=int,
+        default=None,
+        help="HNSW links per node, defaults to 16 for build and to the current "
+        "value for rebuild",
+    )
+    parser.add_argument(
+        "--ef_construction",
+        type=int,
+        default=None,
+        help="HNSW candidate list size while building, defaults to 64 for build "
+        "and to the current value for rebuild",
+    )
+    parser.add_argument(
+        "--lists",
+        type=int,
+        default=None,
+        help="IVFFlat lists, defaults to 100 for build and to the current "
+        "value for rebuild",
+    )
+    parser.add_argument(
+        "--maintenance_work_mem",
+        type=str,
+        default=None,
+        help="memory for building the index, e.g. 2GB",
+    )
+    parser.add_argument(
+        "--search_values",
+        type=int,
+        nargs="+",
+        default=None,
+        help="ef_search (HNSW) or probes (IVFFlat) values to report on",
+    )
+    parser.add_argument("--k", type=int, default=10, help="neighbours per query")
+    parser.add_argument(
+        "--n_queries", type=int, default=100, help="queries used by the report"
+    )
+    parser.add_argument(
+        "--collection_name", type=str, default="embeddings", help="collection"
+    )
+
+    args = parser.parse_args()
+
+    # only the parameters given, the others keep their defaults or values
+    options = {
+        name: getattr(args, name)
+        for name in ("m", "ef_construction", "lists")
+        if getattr(args, name) is not None
+    }
+    conn = psycopg2.connect(psycopg2_dsn(CONNECTION_STRING))
+    if args.command == "build":
+        seconds = build_index(
+            conn,
+            args.method,
+            maintenance_work_mem=args.maintenance_work_mem,
+            **options,
+        )
+        print(f"Built {index_name(args.method)} in {seconds:.1f}s.")
+    elif args.command == "rebuild":
+        seconds = rebuild_index(
+            conn,
+            args.method,
+            maintenance_work_mem=args.maintenance_work_mem,
+            **options,
+        )
+        print(f"Rebuilt {index_name(args.method)} in {seconds:.1f}s.")
+    elif args.command == "drop":
+        drop_index(conn, args.method)
+        print(f"Dropped {index_name(args.method)}.")
+    else:
+        recall_report(
+            conn,
+            args.collection_name,
+            args.method,
+            search_values=args.search_values,
+            k=args.k,
+            n_queries=args.n_queries,
+        )
+    conn.close()
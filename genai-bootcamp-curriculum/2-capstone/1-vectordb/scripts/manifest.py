@@ -0,0 +1,108 @@
+import hashlib
+import json
+import os
+from typing import Dict, List
+
+from langchain_core.documents import Document
+
+MANIFEST_VERSION = 1
+
+
+def hash_file(path: str, block_size: int = 1 << 20) -> str:
+    """Hash the raw bytes of a file.
+
+    :param path: path to file
+    :type path: str
+    :param block_size: bytes read at a time, defaults to 1MiB
+    :type block_size: int, optional
+    :return: hex sha256 digest
+    :rtype: str
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def metadata_json(metadata: Dict, sort_keys: bool = False) -> str:
+    """Serialize chunk metadata the same way wherever it is written, with
+    values json has no type for (dates, Decimals from tables) as strings."""
+    return json.dumps(metadata, sort_keys=sort_keys, default=str)
+
+
+def chunk_id(chunk: Document) -> str:
+    """Content hash of a chunk, used as its id in the collection.
+
+    The metadata (source, page) is part of the hash so the same text on two
+    pages, or in two files, are kept as separate rows.
+
+    :param chunk: document chunk
+    :type chunk: Document
+    :return: hex sha256 digest
+    :rtype: str
+    """
+    digest = hashlib.sha256()
+    digest.update(metadata_json(chunk.metadata, sort_keys=True).encode())
+    digest.update(b"\0")
+    digest.update(chunk.page_content.encode())
+    return digest.hexdigest()
+
+
+def load_manifest(path: str, collection_name: str) -> Dict:
+    """Load the manifest for a collection, or an empty one if none exists.
+
+    :param path: path to manifest json
+    :type path: str
+    :param collection_name: collection the manifest describes
+    :type collection_name: str
+    :raises ValueError: if the manifest belongs to another collection
+    :return: manifest with a `files` mapping of source path to
+        `{"sha256": ..., "chunks": [...]}`
+    :rtype: Dict
+    """
+    if not os.path.exists(path):
+        return {"version": MANIFEST_VERSION, "collection": collection_name, "files": {}}
+
+    with open(path) as f:
+        manifest = json.load(f)
+
+    if manifest.get("collection") != collection_name:
+        raise ValueError(
+            f"Manifest {path} is for collection {manifest.get('collection')!r}, "
+            f"not {collection_name!r}"
+        )
+    return manifest
+
+
+def save_manifest(manifest: Dict, path: str) -> None:
+    """Atomically write the manifest so a crash never leaves a partial file.
+
+    :param manifest: manifest to write
+    :type manifest: Dict
+    :param path: path to manifest json
+    :type path: str
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def stale_chunk_ids(manifest: Dict, sources: List[str]) -> List[str]:
+    """Chunk ids of every manifest file that is no longer in `sources`.
+
+    :param manifest: loaded manifest
+    :type manifest: Dict
+    :param sources: source paths currently on disk
+    :type sources: List[str]
+    :return: ids to delete from the collection
+    :rtype: List[str]
+    """
+    current = set(sources)
+    return [
+        cid
+        for source, entry in manifest["files"].items()
+        if source not in current
+        for cid in entry["chunks"]
+    ]
@@ -0,0 +1,508 @@
+import re
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import psycopg2
+from langchain.vectorstores.pgvector import PGVector
+from langchain_core.documents import Document
+
+from bulk_writer import COLLECTION_TABLE, EMBEDDING_TABLE
+from db_config import CONNECTION_STRING, psycopg2_dsn
+
+# Filters are dicts like PGVector's:
+#   {"source": "a.pdf"}                          equality
+#   {"page": {"$gte": 3, "$lt": 10}}             comparisons, ANDed
+#   {"source": {"$in": ["a.pdf", "b.pdf"]}}      membership
+#   {"$or": [{...}, {...}]}, {"$and": [...]}     combinations
+# The "$" is optional and operators are case insensitive. Numbers are
+# compared as numbers, anything else as the text of the metadata value.
+COMPARISONS = {"eq": "=", "ne": "<>", "gt": ">", "gte": ">=", "lt": "<", "lte": "<="}
+OPERATORS = set(COMPARISONS) | {"in", "nin", "between"}
+METADATA_TYPES = ("text", "numeric")
+
+# text read as a number by a numeric filter: json numbers and numeric
+# strings, whose ->> text Postgres casts to numeric
+NUMERIC_TEXT = r"^\s*[-+]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?\s*$"
+
+# the key of a generated column, from its generation expression
+GENERATED_KEY = re.compile(r"->> '((?:[^']|'')*)'")
+
+
+def _op(name: str) -> str:
+    op = name.lower().lstrip("$")
+    if op not in OPERATORS:
+        raise ValueError(f"Unsupported filter operator {name!r}")
+    return op
+
+
+def _is_number(value: Any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _text(value: Any) -> str:
+    # the text of a json value, as ->> returns it
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value)
+
+
+def _literal(text: str) -> str:
+    return "'" + text.replace("'", "''") + "'"
+
+
+def metadata_expression(key: str, metadata_type: str = "text") -> str:
+    """SQL expression of a metadata key. Indexes are built on the same
+    expressions, so the planner matches filters to them.
+
+    A numeric key is NULL where its value is not a number (e.g. text in a
+    column of numbers), rather than failing the query, or with a generated
+    column every insert.
+
+    :param key: metadata key
+    :type key: str
+    :param metadata_type: "text" or "numeric"
+    :type metadata_type: str, optional
+    :return: SQL expression
+    :rtype: str
+    """
+    expression = f"(cmetadata ->> {_literal(key)})"
+    if metadata_type == "numeric":
+        return (
+            f"(CASE WHEN {expression} ~ {_literal(NUMERIC_TEXT)} "
+            f"THEN {expression}::numeric END)"
+        )
+    return expression
+
+
+def column_name(key: str, metadata_type: str = "text") -> str:
+    """Name of the generated column holding a metadata key."""
+    slug = re.sub(r"\W+", "_", key.lower()).strip("_")
+    return f"meta_{slug}" if metadata_type == "text" else f"meta_{slug}_num"
+
+
+def index_name(key: str, metadata_type: str = "text") -> str:
+    return f"{EMBEDDING_TABLE}_{column_name(key, metadata_type)}_idx"
+
+
+def compile_filter(
+    filter: Dict,
+    columns: Optional[Dict[Tuple[str, str], str]] = None,
+    prefix: str = "filter",
+) -> Tuple[str, Dict]:
+    """Compile a metadata filter to a SQL predicate over the embedding table.
+
+    Keys are read through the same expressions `index_metadata` indexes, or
+    through their generated columns, so the predicate can use those indexes
+    in the query that orders by vector distance.
+
+    :param filter: metadata filter (see the top of this module)
+    :type filter: Dict
+    :param columns: generated column of each (key, type), from
+        `generated_columns`
+    :type columns: Optional[Dict[Tuple[str, str], str]], optional
+    :param prefix: prefix of the parameter names
+    :type prefix: str, optional
+    :return: the predicate and its `%(name)s` parameters
+    :rtype: Tuple[str, Dict]
+    """
+    columns = columns or {}
+    params: Dict[str, Any] = {}
+
+    def param(value: Any) -> str:
+        name = f"{prefix}_{len(params)}"
+        params[name] = value
+        return f"%({name})s"
+
+    def expression(key: str, numeric: bool) -> str:
+        metadata_type = "numeric" if numeric else "text"
+        column = columns.get((key, metadata_type))
+        return column if column else metadata_expression(key, metadata_type)
+
+    def condition(key: str, op: str, operand: Any) -> str:
+        if op in ("in", "nin"):
+            numeric = bool(operand) and all(_is_number(v) for v in operand)
+            values = list(operand) if numeric else [_text(v) for v in operand]
+            sql = f"{expression(key, numeric)} = ANY({param(values)})"
+            # a missing key is not in any list
+            return sql if op == "in" else f"NOT coalesce({sql}, false)"
+        if op == "between":
+            low, high = operand
+            numeric = _is_number(low) and _is_number(high)
+            if not numeric:
+                low, high = _text(low), _text(high)
+            return f"{expression(key, numeric)} BETWEEN {param(low)} AND {param(high)}"
+        numeric = _is_number(operand)
+        value = operand if numeric else _text(operand)
+        return f"{expression(key, numeric)} {COMPARISONS[op]} {param(value)}"
+
+    def compile_(filter: Dict) -> str:
+        clauses = []
+        for key, value in filter.items():
+            if key.lower() in ("$and", "$or"):
+                parts = [compile_(part) for part in value]
+                joiner = " AND " if key.lower() == "$and" else " OR "
+                clauses.append("(" + joiner.join(parts or ["true"]) + ")")
+            elif isinstance(value, dict):
+                clauses += [condition(key, _op(op), v) for op, v in value.items()]
+            else:
+                clauses.append(condition(key, "eq", value))
+        return "(" + " AND ".join(clauses or ["true"]) + ")"
+
+    return compile_(filter), params
+
+
+def matches(metadata: Dict, filter: Optional[Dict]) -> bool:
+    """Whether `metadata` passes a filter, evaluated in Python like
+    `compile_filter` does in SQL.
+
+    :param metadata: metadata of a chunk
+    :type metadata: Dict
+    :param filter: metadata filter, None to keep every chunk
+    :type filter: Optional[Dict]
+    :return: whether the chunk is kept
+    :rtype: bool
+    """
+
+    def value_of(key: str, numeric: bool) -> Any:
+        if metadata.get(key) is None:
+            return None
+        text = _text(metadata[key])
+        if not numeric:
+            return text
+        # numbers as the SQL expression reads them, NULL otherwise
+        return float(text) if re.match(NUMERIC_TEXT, text) else None
+
+    def condition(key: str, op: str, operand: Any) -> bool:
+        if op in ("in", "nin"):
+            numeric = bool(operand) and all(_is_number(v) for v in operand)
+            value = value_of(key, numeric)
+            values = list(operand) if numeric else [_text(v) for v in operand]
+            return (value in values) if op == "in" else (value not in values)
+        if op == "between":
+            low, high = operand
+            numeric = _is_number(low) and _is_number(high)
+            value = value_of(key, numeric)
+            if not numeric:
+                low, high = _text(low), _text(high)
+            return value is not None and low <= value <= high
+        numeric = _is_number(operand)
+        value = value_of(key, numeric)
+        operand = operand if numeric else _text(operand)
+        if value is None:
+            return False
+        return {
+            "eq": value == operand,
+            "ne": value != operand,
+            "gt": value > operand,
+            "gte": value >= operand,
+            "lt": value < operand,
+            "lte": value <= operand,
+        }[op]
+
+    def evaluate(filter: Dict) -> bool:
+        for key, value in filter.items():
+            if key.lower() == "$and":
+                passed = all(evaluate(part) for part in value)
+            elif key.lower() == "$or":
+                passed = any(evaluate(part) for part in value)
+            elif isinstance(value, dict):
+                passed = all(condition(key, _op(op), v) for op, v in value.items())
+            else:
+                passed = condition(key, "eq", value)
+            if not passed:
+                return False
+        return True
+
+    return evaluate(filter or {})
+
+
+def search_sql(where: str = "", collection: str = "%(collection_id)s") -> str:
+    """Exact cosine search of a collection, restricted by a compiled filter.
+
+    :param where: predicate from `compile_filter`, none by default
+    :type where: str, optional
+    :param collection: SQL of the collection uuid
+    :type collection: str, optional
+    :return: query with `%(query)s` and `%(k)s` parameters
+    :rtype: str
+    """
+    where = f" AND {where}" if where else ""
+    return (
+        "SELECT custom_id, document, cmetadata, "
+        "embedding <=> %(query)s::vector AS distance "
+        f"FROM {EMBEDDING_TABLE} WHERE collection_id = {collection}{where} "
+        "ORDER BY embedding <=> %(query)s::vector LIMIT %(k)s"
+    )
+
+
+def generated_columns(conn) -> Dict[Tuple[str, str], str]:
+    """Generated metadata columns of the embedding table.
+
+    :param conn: psycopg2 connection
+    :return: column name by (key, "text" or "numeric")
+    :rtype: Dict[Tuple[str, str], str]
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT column_name, generation_expression, data_type "
+            "FROM information_schema.columns WHERE table_name = %s "
+            "AND is_generated = 'ALWAYS' AND column_name LIKE 'meta\\_%%'",
+            (EMBEDDING_TABLE,),
+        )
+        rows = cur.fetchall()
+    columns = {}
+    for column, expression, data_type in rows:
+        match = GENERATED_KEY.search(expression or "")
+        if match:
+            key = match.group(1).replace("''", "'")
+            metadata_type = "numeric" if data_type == "numeric" else "text"
+            columns[(key, metadata_type)] = column
+    return columns
+
+
+def index_metadata(conn, keys: List[Tuple[str, str]], generated: bool = False) -> float:
+    """Index metadata keys for filtered searches.
+
+    Each key gets a btree index on (collection_id, value), so a filtered
+    search only reads the matching rows of its collection. With `generated`
+    the value is first stored in a generated column of its own, which costs
+    space but spares parsing the json when filtering.
+
+    :param conn: psycopg2 connection
+    :param keys: (key, "text" or "numeric") pairs
+    :type keys: List[Tuple[str, str]]
+    :param generated: index stored generated columns instead of expressions
+    :type generated: bool, optional
+    :return: seconds spent building
+    :rtype: float
+    """
+    start = time.time()
+    with conn.cursor() as cur:
+        for key, metadata_type in keys:
+            expression = metadata_expression(key, metadata_type)
+            if generated:
+                column = column_name(key, metadata_type)
+                cur.execute(
+                    f"ALTER TABLE {EMBEDDING_TABLE} ADD COLUMN IF NOT EXISTS "
+                    f"{column} {metadata_type} GENERATED ALWAYS AS {expression} STORED"
+                )
+                expression = column
+            cur.execute(
+                f"CREATE INDEX IF NOT EXISTS {index_name(key, metadata_type)} "
+                f"ON {EMBEDDING_TABLE} (collection_id, {expression})"
+            )
+        cur.execute(f"ANALYZE {EMBEDDING_TABLE}")
+    conn.commit()
+    return time.time() - start
+
+
+def drop_metadata_index(conn, keys: List[Tuple[str, str]]) -> None:
+    """Drop the indexes, and generated columns, of metadata keys."""
+    with conn.cursor() as cur:
+        for key, metadata_type in keys:
+            cur.execute(f"DROP INDEX IF EXISTS {index_name(key, metadata_type)}")
+            cur.execute(
+                f"ALTER TABLE {EMBEDDING_TABLE} DROP COLUMN IF EXISTS "
+                f"{column_name(key, metadata_type)}"
+            )
+    conn.commit()
+
+
+class FilteredPGVector(PGVector):
+    """`PGVector` whose searches run as a single SQL query, with the metadata
+    filter compiled by `compile_filter` so that it can use the indexes of
+    `index_metadata`.
+
+    `as_retriever(search_kwargs={"k": k, "filter": {...}})` and the
+    similarity searches all take the filter; scores are cosine distances.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._conn = None
+        self._columns = None
+        self._conn_lock = threading.Lock()
+
+    def similarity_search_with_score_by_vector(
+        self, embedding: List[float], k: int = 4, filter: Optional[dict] = None
+    ) -> List[Tuple[Document, float]]:
+        with self._conn_lock:
+            if self._conn is None or self._conn.closed:
+                self._conn = psycopg2.connect(psycopg2_dsn(self.connection_string))
+                self._columns = generated_columns(self._conn)
+            where, params = (
+                compile_filter(filter, self._columns) if filter else ("", {})
+            )
+            sql = search_sql(
+                where,
+                collection=f"(SELECT uuid FROM {COLLECTION_TABLE} "
+                "WHERE name = %(collection_name)s)",
+            )
+            params.update(
+                query=str(list(embedding)),
+                k=k,
+                collection_name=self.collection_name,
+            )
+            with self._conn.cursor() as cur:
+                cur.execute(sql, params)
+                rows = cur.fetchall()
+            self._conn.rollback()
+        return [
+            (Document(page_content=document, metadata=metadata or {}), distance)
+            for _, document, metadata, distance in rows
+        ]
+
+
+def filter_report(
+    conn,
+    filter: Dict,
+    collection_name: str = "embeddings",
+    k: int = 4,
+    n_queries: int = 100,
+) -> Dict:
+    """Latency of filtered searches against unfiltered ones, with the plan
+    of a filtered search.
+
+    Stored embeddings, sampled at random, are used as queries.
+
+    :param conn: psycopg2 connection
+    :param filter: metadata filter to time
+    :type filter: Dict
+    :param collection_name: collection to search
+    :type collection_name: str, optional
+    :param k: number of neighbours retrieved
+    :type k: int, optional
+    :param n_queries: number of queries
+    :type n_queries: int, optional
+    :return: p50/p95 ms of both searches, matching rows and the plan
+    :rtype: Dict
+    """
+    where, filter_params = compile_filter(filter, generated_columns(conn))
+    with conn.cursor() as cur:
+        cur.execute(
+            f"SELECT uuid FROM {COLLECTION_TABLE} WHERE name = %s", (collection_name,)
+        )
+        collection_id = cur.fetchone()[0]
+        cur.execute(
+            f"SELECT embedding::text FROM {EMBEDDING_TABLE} "
+            "WHERE collection_id = %s ORDER BY random() LIMIT %s",
+            (collection_id, n_queries),
+        )
+        queries = [row[0] for row in cur.fetchall()]
+        cur.execute(
+            f"SELECT count(*) FROM {EMBEDDING_TABLE} "
+            f"WHERE collection_id = %(collection_id)s AND {where}",
+            {"collection_id": collection_id, **filter_params},
+        )
+        n_matching = cur.fetchone()[0]
+
+        def run(sql: str, params: Dict) -> np.ndarray:
+            latencies = []
+            for query in queries:
+                start = time.perf_counter()
+                cur.execute(
+                    sql,
+                    {"query": query, "collection_id": collection_id, "k": k, **params},
+                )
+                cur.fetchall()
+                latencies.append(time.perf_counter() - start)
+            return np.array(latencies) * 1000
+
+        full = run(search_sql(), {})
+        scoped = run(search_sql(where), filter_params)
+        cur.execute(
+            "EXPLAIN " + search_sql(where),
+            {
+                "query": queries[0],
+                "collection_id": collection_id,
+                "k": k,
+                **filter_params,
+            },
+        )
+        plan = "\n".join(row[0] for row in cur.fetchall())
+    conn.rollback()
+
+    report = {"n_matching": n_matching, "plan": plan}
+    for name, latencies in (("full", full), ("filtered", scoped)):
+        report[f"{name}_p50_ms"], report[f"{name}_p95_ms"] = np.percentile(
+            latencies, [50, 95]
+        )
+    print(f"{n_matching} chunks match {filter}")
+    print(f"{'search':<12}{'p50 ms':>10}{'p95 ms':>10}")
+    for name in ("full", "filtered"):
+        print(
+            f"{name:<12}{report[f'{name}_p50_ms']:>10.2f}"
+            f"{report[f'{name}_p95_ms']:>10.2f}"
+        )
+    print(plan)
+    return report
+
+
+def parse_keys(specs: List[str]) -> List[Tuple[str, str]]:
+    """Parse `key` or `key:numeric` arguments."""
+    keys = []
+    for spec in specs:
+        key, _, metadata_type = spec.rpartition(":")
+        if not key or metadata_type not in METADATA_TYPES:
+            key, metadata_type = spec, "text"
+        keys.append((key, metadata_type))
+    return keys
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "command",
+        choices=["index", "drop", "report"],
+        help="what to do with the metadata indexes",
+    )
+    parser.add_argument(
+        "--keys",
+        type=str,
+        nargs="+",
+        default=["source", "page:numeric"],
+        help="metadata keys to index, as key or key:numeric",
+    )
+    parser.add_argument(
+        "--generated",
+        action="store_true",
+        help="index stored generated columns instead of json expressions",
+    )
+    parser.add_argument(
+        "--filter",
+        type=str,
+        default=None,
+        help='filter to report on, as JSON, e.g. \'{"source": "doc.pdf"}\'',
+    )
+    parser.add_argument("--k", type=int, default=4, help="number of neighbours")
+    parser.add_argument(
+        "--n_queries", type=int, default=100, help="number of queries to time"
+    )
+    parser.add_argument(
+        "--collection_name", type=str, default="embeddings", help="collection"
+    )
+
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(psycopg2_dsn(CONNECTION_STRING))
+    if args.command == "index":
+        seconds = index_metadata(conn, parse_keys(args.keys), args.generated)
+        print(f"Indexed {args.keys} in {seconds:.1f}s.")
+    elif args.command == "drop":
+        drop_metadata_index(conn, parse_keys(args.keys))
+    else:
+        if args.filter is None:
+            parser.error("report needs a --filter")
+        filter_report(
+            conn,
+            json.loads(args.filter),
+            collection_name=args.collection_name,
+            k=args.k,
+            n_queries=args.n_queries,
+        )
+    conn.close()
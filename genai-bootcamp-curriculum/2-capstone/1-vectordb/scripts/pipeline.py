@@ -0,0 +1,127 @@
+import hashlib
+import json
+import os
+from collections import deque
+from concurrent.futures import Executor
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+def bounded_map(
+    executor: Executor, fn: Callable[[T], R], items: Iterable[T], max_pending: int
+) -> Iterator[R]:
+    """Like `executor.map`, but with at most `max_pending` tasks in flight.
+
+    `executor.map` submits every item up front, so results pile up in memory
+    whenever the consumer is slower than the workers. Here a new task is only
+    submitted once the oldest result has been taken, which keeps memory
+    bounded and lets a slow downstream stage (embedding) throttle parsing.
+
+    :param executor: executor to run `fn` in
+    :type executor: Executor
+    :param fn: function applied to every item
+    :type fn: Callable[[T], R]
+    :param items: inputs, consumed lazily
+    :type items: Iterable[T]
+    :param max_pending: maximum number of submitted but unconsumed tasks
+    :type max_pending: int
+    :return: results in input order
+    :rtype: Iterator[R]
+    """
+    pending = deque()
+    for item in items:
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+        pending.append(executor.submit(fn, item))
+    while pending:
+        yield pending.popleft().result()
+
+
+def batched(items: Iterable[T], batch_size: int) -> Iterator[List[T]]:
+    """Group an iterable into lists of `batch_size` (the last may be shorter).
+
+    :param items: items to group
+    :type items: Iterable[T]
+    :param batch_size: size of each batch
+    :type batch_size: int
+    :return: iterator of batches
+    :rtype: Iterator[List[T]]
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _listing_hash(doc_paths: List[str]) -> str:
+    return hashlib.sha256("\n".join(doc_paths).encode()).hexdigest()
+
+
+def load_checkpoint(
+    path: str, collection_name: str, doc_paths: List[str]
+) -> Optional[Tuple[int, int]]:
+    """Position to resume an interrupted run from, if there is one.
+
+    A checkpoint only applies to the same collection and the same list of
+    files, since positions are indexes into that list.
+
+    :param path: path to checkpoint json
+    :type path: str
+    :param collection_name: collection being written
+    :type collection_name: str
+    :param doc_paths: sorted document paths of this run
+    :type doc_paths: List[str]
+    :return: (file index, chunk index) of the first chunk not yet committed,
+        or None to start from the beginning
+    :rtype: Optional[Tuple[int, int]]
+    """
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as f:
+        checkpoint = json.load(f)
+
+    expected = {"collection": collection_name, "listing": _listing_hash(doc_paths)}
+    if any(checkpoint.get(key) != value for key, value in expected.items()):
+        print(f"Ignoring checkpoint {path}, it was written for a different run.")
+        return None
+    return checkpoint["file_index"], checkpoint["chunk_index"]
+
+
+def save_checkpoint(
+    path: str,
+    collection_name: str,
+    doc_paths: List[str],
+    position: Tuple[int, int],
+    n_committed: int,
+) -> None:
+    """Record the position after the last committed batch.
+
+    :param path: path to checkpoint json
+    :type path: str
+    :param collection_name: collection being written
+    :type collection_name: str
+    :param doc_paths: sorted document paths of this run
+    :type doc_paths: List[str]
+    :param position: (file index, chunk index) of the next chunk to write
+    :type position: Tuple[int, int]
+    :param n_committed: chunks committed so far, for reporting
+    :type n_committed: int
+    """
+    checkpoint: Dict = {
+        "collection": collection_name,
+        "listing": _listing_hash(doc_paths),
+        "file_index": position[0],
+        "chunk_index": position[1],
+        "n_committed": n_committed,
+    }
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
@@ -0,0 +1,406 @@
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import psycopg2
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from bulk_writer import COLLECTION_TABLE, EMBEDDING_TABLE
+from db_config import CONNECTION_STRING, psycopg2_dsn
+from manage_index import index_name as float32_index_name
+from metadata_filter import compile_filter, generated_columns
+
+# Compact codes of the float32 embedding column (pgvector >= 0.7). The
+# codes only live in an HNSW expression index, the table keeps the float32
+# vectors that candidates are rescored with: what shrinks is the index, in
+# place of a float32 HNSW index, not the table.
+#   halfvec: float16, half the size, distances barely change
+#   binary: one sign bit per dimension, 32x smaller, needs rescoring
+KINDS = {
+    "halfvec": {
+        "expression": "(embedding::halfvec({dim}))",
+        "query": "%(query)s::vector::halfvec({dim})",
+        "distance": "<=>",
+        "ops": "halfvec_cosine_ops",
+    },
+    "binary": {
+        "expression": "(binary_quantize(embedding)::bit({dim}))",
+        "query": "binary_quantize(%(query)s::vector)::bit({dim})",
+        "distance": "<~>",
+        "ops": "bit_hamming_ops",
+    },
+}
+
+
+def index_name(kind: str) -> str:
+    return f"{EMBEDDING_TABLE}_{kind}_idx"
+
+
+def embedding_dim(conn, collection_id: Optional[str] = None) -> int:
+    """Dimension of the stored embeddings, of a collection if given (the
+    table is shared by every collection, whose dimensions may differ)."""
+    with conn.cursor() as cur:
+        if collection_id is None:
+            cur.execute(f"SELECT vector_dims(embedding) FROM {EMBEDDING_TABLE} LIMIT 1")
+        else:
+            cur.execute(
+                f"SELECT vector_dims(embedding) FROM {EMBEDDING_TABLE} "
+                "WHERE collection_id = %s LIMIT 1",
+                (collection_id,),
+            )
+        return cur.fetchone()[0]
+
+
+def build_quantized_index(
+    conn,
+    kind: str = "binary",
+    m: int = 16,
+    ef_construction: int = 64,
+    maintenance_work_mem: Optional[str] = None,
+) -> float:
+    """Build an HNSW index over compact codes of the embeddings.
+
+    :param conn: psycopg2 connection
+    :param kind: "halfvec" (float16) or "binary" (sign bits)
+    :type kind: str, optional
+    :param m: HNSW links per node
+    :type m: int, optional
+    :param ef_construction: HNSW candidate list size while building
+    :type ef_construction: int, optional
+    :param maintenance_work_mem: memory for the build, e.g. "2GB"
+    :type maintenance_work_mem: Optional[str], optional
+    :return: seconds spent building
+    :rtype: float
+    """
+    spec = KINDS[kind]
+    expression = spec["expression"].format(dim=embedding_dim(conn))
+    start = time.time()
+    with conn.cursor() as cur:
+        if maintenance_work_mem is not None:
+            cur.execute("SET maintenance_work_mem = %s", (maintenance_work_mem,))
+        cur.execute(
+            f"CREATE INDEX {index_name(kind)} ON {EMBEDDING_TABLE} "
+            f"USING hnsw ({expression} {spec['ops']}) "
+            f"WITH (m = {int(m)}, ef_construction = {int(ef_construction)})"
+        )
+    conn.commit()
+    return time.time() - start
+
+
+def drop_quantized_index(conn, kind: str = "binary") -> None:
+    with conn.cursor() as cur:
+        cur.execute(f"DROP INDEX IF EXISTS {index_name(kind)}")
+    conn.commit()
+
+
+def quantized_search_sql(kind: str, dim: int, where: str = "") -> str:
+    """Two-stage search: `%(candidates)s` nearest neighbours by compact code,
+    reordered by the full precision cosine distance. `where` is a predicate
+    from `metadata_filter.compile_filter` restricting the candidates."""
+    spec = KINDS[kind]
+    where = f" AND {where}" if where else ""
+    expression = spec["expression"].format(dim=dim)
+    query = spec["query"].format(dim=dim)
+    return (
+        "SELECT custom_id, document, cmetadata, distance FROM ("
+        "SELECT custom_id, document, cmetadata, "
+        "embedding <=> %(query)s::vector AS distance "
+        f"FROM {EMBEDDING_TABLE} WHERE collection_id = %(collection_id)s{where} "
+        f"ORDER BY {expression} {spec['distance']} {query} "
+        "LIMIT %(candidates)s) AS candidates "
+        "ORDER BY distance LIMIT %(k)s"
+    )
+
+
+def set_candidate_list(cur, candidates: int) -> None:
+    # an HNSW scan returns at most hnsw.ef_search rows, so the candidate
+    # pass needs a list at least as long as the candidates it asks for
+    cur.execute(f"SET LOCAL hnsw.ef_search = {max(int(candidates), 40)}")
+
+
+class QuantizedPGSearch:
+    """Searches a PGVector collection through a compact-code index, then
+    rescores the candidates with the stored float32 embeddings.
+
+    Exposes `similarity_search_with_score` like `PGVector`, scores being
+    cosine distances.
+    """
+
+    def __init__(
+        self,
+        connection_string: str,
+        embedding_function: Embeddings,
+        collection_name: str = "embeddings",
+        kind: str = "binary",
+        candidates_per_result: int = 10,
+        ef_search: Optional[int] = None,
+    ):
+        self.embedding_function = embedding_function
+        self.candidates_per_result = candidates_per_result
+        self.ef_search = ef_search or 0
+        self.conn = psycopg2.connect(psycopg2_dsn(connection_string))
+        with self.conn.cursor() as cur:
+            cur.execute(
+                f"SELECT uuid FROM {COLLECTION_TABLE} WHERE name = %s",
+                (collection_name,),
+            )
+            self.collection_id = cur.fetchone()[0]
+        self.kind = kind
+        self.dim = embedding_dim(self.conn, self.collection_id)
+        self.columns = generated_columns(self.conn)
+        self.conn.commit()
+
+    def search_by_vector(
+        self, embedding: List[float], k: int = 4, filter: Optional[dict] = None
+    ) -> List[Tuple]:
+        candidates = k * self.candidates_per_result
+        where, params = compile_filter(filter, self.columns) if filter else ("", {})
+        params.update(
+            query=str(list(embedding)),
+            collection_id=self.collection_id,
+            candidates=candidates,
+            k=k,
+        )
+        with self.conn.cursor() as cur:
+            set_candidate_list(cur, max(candidates, self.ef_search))
+            cur.execute(quantized_search_sql(self.kind, self.dim, where), params)
+            rows = cur.fetchall()
+        self.conn.rollback()
+        return rows
+
+    def similarity_search_with_score(
+        self, query: str, k: int = 4, filter: Optional[dict] = None
+    ) -> List[Tuple[Document, float]]:
+        embedding = self.embedding_function.embed_query(query)
+        rows = self.search_by_vector(embedding, k, filter)
+        return [
+            (Document(page_content=document, metadata=metadata or {}), distance)
+            for _, document, metadata, distance in rows
+        ]
+
+
+def quantization_report(
+    conn,
+    collection_name: str = "embeddings",
+    kinds: Optional[List[str]] = None,
+    candidates_per_result: Optional[List[int]] = None,
+    k: int = 10,
+    n_queries: int = 100,
+) -> List[Dict]:
+    """Recall@k, latency and index size of quantized search against the
+    exact float32 scan, and against the float32 HNSW index of
+    `manage_index.py` if there is one.
+
+    The quantized indexes are built over the float32 table, which they leave
+    as it is: the report prints its size, and the size of each index next to
+    the float32 HNSW index it would replace. Stored embeddings, sampled at
+    random, are used as queries.
+
+    :param conn: psycopg2 connection
+    :param collection_name: collection to search
+    :type collection_name: str, optional
+    :param kinds: quantized indexes to evaluate, defaults to those that exist
+    :type kinds: Optional[List[str]], optional
+    :param candidates_per_result: rescoring depths (candidates per result)
+    :type candidates_per_result: Optional[List[int]], optional
+    :param k: number of neighbours retrieved
+    :type k: int, optional
+    :param n_queries: number of queries
+    :type n_queries: int, optional
+    :return: one row of results per setting, exact search first
+    :rtype: List[Dict]
+    """
+    candidates_per_result = candidates_per_result or [1, 4, 10]
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT indexname FROM pg_indexes WHERE tablename = %s",
+            (EMBEDDING_TABLE,),
+        )
+        existing = {row[0] for row in cur.fetchall()}
+        if kinds is None:
+            kinds = [kind for kind in KINDS if index_name(kind) in existing]
+
+        cur.execute(
+            f"SELECT uuid FROM {COLLECTION_TABLE} WHERE name = %s", (collection_name,)
+        )
+        collection_id = cur.fetchone()[0]
+        dim = embedding_dim(conn, collection_id)
+        cur.execute(
+            f"SELECT embedding::text FROM {EMBEDDING_TABLE} "
+            "WHERE collection_id = %s ORDER BY random() LIMIT %s",
+            (collection_id, n_queries),
+        )
+        queries = [row[0] for row in cur.fetchall()]
+
+        def run(sql: str, candidates: int):
+            results, latencies = [], []
+            for query in queries:
+                params = {
+                    "query": query,
+                    "collection_id": collection_id,
+                    "candidates": candidates,
+                    "k": k,
+                }
+                start = time.perf_counter()
+                set_candidate_list(cur, candidates)
+                cur.execute(sql, params)
+                results.append([row[0] for row in cur.fetchall()])
+                latencies.append(time.perf_counter() - start)
+            return results, np.array(latencies) * 1000
+
+        def index_size(name: str) -> Optional[int]:
+            cur.execute("SELECT pg_relation_size(to_regclass(%s))", (name,))
+            return cur.fetchone()[0]
+
+        def recall_of(approx: List[List[str]]) -> float:
+            return np.mean(
+                [len(set(a) & set(e)) / max(len(e), 1) for a, e in zip(approx, exact)]
+            )
+
+        # the float32 path: no index, an exact scan of the collection
+        cur.execute("SET enable_indexscan = off")
+        exact_sql = (
+            f"SELECT custom_id FROM {EMBEDDING_TABLE} "
+            "WHERE collection_id = %(collection_id)s "
+            "ORDER BY embedding <=> %(query)s::vector LIMIT %(k)s"
+        )
+        exact, latencies = run(exact_sql, 0)
+        cur.execute("RESET enable_indexscan")
+        rows = [
+            {
+                "setting": "float32 exact",
+                "recall": 1.0,
+                "latencies": latencies,
+                "size": None,
+            }
+        ]
+        # the index the quantized ones would replace, searched with the
+        # same candidate list as the first rescoring depth
+        float32_size = None
+        if float32_index_name("hnsw") in existing:
+            float32_size = index_size(float32_index_name("hnsw"))
+            approx, latencies = run(exact_sql, candidates_per_result[0] * k)
+            rows.append(
+                {
+                    "setting": "float32 hnsw",
+                    "recall": recall_of(approx),
+                    "latencies": latencies,
+                    "size": float32_size,
+                }
+            )
+        cur.execute("SELECT pg_table_size(%s)", (EMBEDDING_TABLE,))
+        table_size = cur.fetchone()[0]
+
+        for kind in kinds:
+            sql = quantized_search_sql(kind, dim)
+            size = index_size(index_name(kind))
+            for n in candidates_per_result:
+                approx, latencies = run(sql, n * k)
+                rows.append(
+                    {
+                        "setting": f"{kind} x{n} rescored",
+                        "recall": recall_of(approx),
+                        "latencies": latencies,
+                        "size": size,
+                    }
+                )
+    conn.rollback()
+
+    print(f"recall@{k} over {len(queries)} queries")
+    print(
+        f"{'setting':<24}{'recall':>8}{'p50 ms':>10}{'p95 ms':>10}{'index MB':>10}"
+        f"{'vs hnsw':>10}"
+    )
+    for row in rows:
+        p50, p95 = np.percentile(row["latencies"], [50, 95])
+        size = f"{row['size'] / 2**20:.1f}" if row["size"] else "-"
+        ratio = (
+            f"{row['size'] / float32_size:.2f}x"
+            if row["size"] and float32_size
+            else "-"
+        )
+        print(
+            f"{row['setting']:<24}{row['recall']:>8.3f}"
+            f"{p50:>10.2f}{p95:>10.2f}{size:>10}{ratio:>10}"
+        )
+    if float32_size is None:
+        print(
+            "No float32 HNSW index to compare sizes with, "
+            "build one with manage_index.py build."
+        )
+    print(
+        f"Table: {table_size / 2**20:.1f} MB of float32 embeddings for every "
+        "collection, unchanged by the quantized indexes."
+    )
+    return rows
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "command",
+        choices=["build", "drop", "report"],
+        help="what to do with the quantized index",
+    )
+    parser.add_argument(
+        "--kind",
+        type=str,
+        nargs="+",
+        default=None,
+        choices=list(KINDS),
+        help="compact code: halfvec (float16) or binary (sign bits)",
+    )
+    parser.add_argument("--m", type=int, default=16, help="HNSW links per node")
+    parser.add_argument(
+        "--ef_construction",
+        type=int,
+        default=64,
+        help="HNSW candidate list size while building",
+    )
+    parser.add_argument(
+        "--maintenance_work_mem",
+        type=str,
+        default=None,
+        help="memory for building the index, e.g. 2GB",
+    )
+    parser.add_argument(
+        "--candidates_per_result",
+        type=int,
+        nargs="+",
+        default=None,
+        help="rescoring depths to report on, as candidates per result",
+    )
+    parser.add_argument("--k", type=int, default=10, help="neighbours per query")
+    parser.add_argument(
+        "--n_queries", type=int, default=100, help="queries used by the report"
+    )
+    parser.add_argument(
+        "--collection_name", type=str, default="embeddings", help="collection"
+    )
+
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(psycopg2_dsn(CONNECTION_STRING))
+    if args.command == "report":
+        quantization_report(
+            conn,
+            args.collection_name,
+            kinds=args.kind,
+            candidates_per_result=args.candidates_per_result,
+            k=args.k,
+            n_queries=args.n_queries,
+        )
+    else:
+        for kind in args.kind or ["binary"]:
+            if args.command == "build":
+                seconds = build_quantized_index(
+                    conn, kind, args.m, args.ef_construction, args.maintenance_work_mem
+                )
+                print(f"Built {index_name(kind)} in {seconds:.1f}s.")
+            else:
+                drop_quantized_index(conn, kind)
+                print(f"Dropped {index_name(kind)}.")
+    conn.close()
@@ -0,0 +1,386 @@
+import copy
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+import numpy as np
+import psycopg2
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from bulk_writer import COLLECTION_TABLE
+from db_config import psycopg2_dsn
+from metadata_filter import FilteredPGVector
+
+_MISSING = object()
+
+
+class LRUCache:
+    """A thread-safe in-memory LRU map with hit and miss counters."""
+
+    def __init__(self, max_size: int = 1000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Any:
+        """The value of `key`, or `_MISSING`."""
+        with self.lock:
+            value = self.entries.get(key, _MISSING)
+            if value is _MISSING:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+class LRUEmbeddings(Embeddings):
+    """Keeps the embeddings of recent queries in memory, so repeated
+    questions skip the model. Documents go straight to `embeddings`.
+
+    Every cached embedding is dropped when `version` changes, e.g. when a
+    rebuild of the collection changes how queries are reduced.
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        max_size: int = 10000,
+        version: Optional[Callable[[], Hashable]] = None,
+    ):
+        self.embeddings = embeddings
+        self.cache = LRUCache(max_size)
+        self.version = version
+        self.cached_version = _MISSING
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        if self.version is not None:
+            version = self.version()
+            if version != self.cached_version:
+                self.cache.clear()
+                self.cached_version = version
+        embedding = self.cache.get(text)
+        if embedding is _MISSING:
+            embedding = self.embeddings.embed_query(text)
+            self.cache.put(text, embedding)
+        return embedding
+
+
+def bump_collection_version(connection_string: str, collection_name: str) -> int:
+    """Increment the version in a collection's metadata, telling query caches
+    that its contents changed.
+
+    :param connection_string: database url
+    :type connection_string: str
+    :param collection_name: collection that was written to
+    :type collection_name: str
+    :return: the new version
+    :rtype: int
+    """
+    conn = psycopg2.connect(psycopg2_dsn(connection_string))
+    with conn.cursor() as cur:
+        cur.execute(
+            f"SELECT cmetadata FROM {COLLECTION_TABLE} WHERE name = %s FOR UPDATE",
+            (collection_name,),
+        )
+        metadata = cur.fetchone()[0] or {}
+        metadata["version"] = metadata.get("version", 0) + 1
+        cur.execute(
+            f"UPDATE {COLLECTION_TABLE} SET cmetadata = %s WHERE name = %s",
+            (json.dumps(metadata), collection_name),
+        )
+    conn.commit()
+    conn.close()
+    return metadata["version"]
+
+
+class CollectionVersion:
+    """Reads the version of a collection, at most once every `check_interval`
+    seconds.
+
+    The version is the collection's uuid, which changes when it is rebuilt,
+    with the counter `bump_collection_version` increments when it is added
+    to or synced.
+    """
+
+    def __init__(
+        self, connection_string: str, collection_name: str, check_interval: float = 1.0
+    ):
+        self.connection_string = connection_string
+        self.collection_name = collection_name
+        self.check_interval = check_interval
+        self.conn = None
+        self.checked_at = float("-inf")
+        self.version = None
+        self.lock = threading.Lock()
+
+    def current(self) -> Optional[Tuple[str, int]]:
+        with self.lock:
+            if time.monotonic() - self.checked_at < self.check_interval:
+                return self.version
+            if self.conn is None or self.conn.closed:
+                self.conn = psycopg2.connect(psycopg2_dsn(self.connection_string))
+            with self.conn.cursor() as cur:
+                cur.execute(
+                    f"SELECT uuid, cmetadata FROM {COLLECTION_TABLE} WHERE name = %s",
+                    (self.collection_name,),
+                )
+                row = cur.fetchone()
+            self.conn.rollback()
+            if row is None:
+                self.version = None
+            else:
+                self.version = (str(row[0]), (row[1] or {}).get("version", 0))
+            self.checked_at = time.monotonic()
+            return self.version
+
+
+class SemanticCache:
+    """Values (e.g. answers) of recent questions, found again for questions
+    worded differently but meaning the same.
+
+    Questions are looked up by embedding: the most similar cached question
+    under the same `key` (e.g. the prompt and generation settings) is a hit
+    if its cosine similarity reaches `threshold`. The cache is a matrix of
+    at most `max_size` normalized embeddings searched exactly, which costs
+    well under a millisecond at the sizes it is meant for. Entries older
+    than `ttl` seconds expire, the least recently hit are dropped past
+    `max_size`, and every entry is dropped when `version` changes, e.g. when
+    the collection the answers were retrieved from is rebuilt or synced.
+
+    :param threshold: cosine similarity from which a cached question matches
+    :type threshold: float, optional
+    :param max_size: entries kept
+    :type max_size: int, optional
+    :param ttl: seconds an entry is kept, forever if not set
+    :type ttl: Optional[float], optional
+    :param version: returns the version of the data behind the values, see
+        `CollectionVersion.current`
+    :type version: Optional[Callable[[], Hashable]], optional
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.95,
+        max_size: int = 1000,
+        ttl: Optional[float] = None,
+        version: Optional[Callable[[], Hashable]] = None,
+    ):
+        self.threshold = threshold
+        self.max_size = max_size
+        self.ttl = ttl
+        self.version = version
+        self.cached_version = _MISSING
+        # id -> (embedding, key, value, created), least recently hit first
+        self.entries = OrderedDict()
+        self.next_id = 0
+        self.hits = self.misses = self.expired = self.evicted = 0
+        self.invalidations = 0
+        self.lock = threading.Lock()
+        self._index = None
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        return vector / max(np.linalg.norm(vector), 1e-12)
+
+    def _check(self) -> None:
+        # drop everything on a new version, and the expired entries
+        if self.version is not None:
+            version = self.version()
+            if version != self.cached_version:
+                if self.cached_version is not _MISSING and self.entries:
+                    self.invalidations += 1
+                self.entries.clear()
+                self._index = None
+                self.cached_version = version
+        if self.ttl is None or not self.entries:
+            return
+        expired_before = time.monotonic() - self.ttl
+        expired = [
+            id_ for id_, entry in self.entries.items() if entry[3] < expired_before
+        ]
+        for id_ in expired:
+            del self.entries[id_]
+        if expired:
+            self.expired += len(expired)
+            self._index = None
+
+    def _search(self) -> Tuple[List[int], np.ndarray, np.ndarray]:
+        # ids, embeddings and key hashes of the entries, rebuilt after changes
+        if self._index is None:
+            ids = list(self.entries)
+            entries = self.entries.values()
+            self._index = (
+                ids,
+                np.stack([entry[0] for entry in entries]),
+                np.array([hash(entry[1]) for entry in entries]),
+            )
+        return self._index
+
+    def get(
+        self, embedding: List[float], key: Hashable = None
+    ) -> Optional[Tuple[Any, float]]:
+        """The value of the most similar cached question, if similar enough.
+
+        :param embedding: embedding of the question
+        :type embedding: List[float]
+        :param key: settings the value depends on, only entries put with the
+            same key match
+        :type key: Hashable, optional
+        :return: the value and the similarity of its question, or None
+        :rtype: Optional[Tuple[Any, float]]
+        """
+        vector = self._normalize(embedding)
+        with self.lock:
+            self._check()
+            if self.entries:
+                ids, vectors, key_hashes = self._search()
+                similarities = np.where(key_hashes == hash(key), vectors @ vector, -1)
+                best = int(np.argmax(similarities))
+                entry = self.entries[ids[best]]
+                if similarities[best] >= self.threshold and entry[1] == key:
+                    self.hits += 1
+                    self.entries.move_to_end(ids[best])
+                    return entry[2], float(similarities[best])
+            self.misses += 1
+            return None
+
+    def put(self, embedding: List[float], value: Any, key: Hashable = None) -> None:
+        """Cache the value of a question.
+
+        :param embedding: embedding of the question
+        :type embedding: List[float]
+        :param value: value to return for it and similar questions
+        :type value: Any
+        :param key: settings the value depends on
+        :type key: Hashable, optional
+        """
+        vector = self._normalize(embedding)
+        with self.lock:
+            self._check()
+            self.entries[self.next_id] = (vector, key, value, time.monotonic())
+            self.next_id += 1
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evicted += 1
+            self._index = None
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self._index = None
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "expired": self.expired,
+                "evicted": self.evicted,
+                "invalidations": self.invalidations,
+            }
+
+
+class CachedPGVector(FilteredPGVector):
+    """`FilteredPGVector` with two in-memory LRU caches in front of its
+    searches: the embeddings of recent queries and the results of recent
+    (query, k, filter) searches.
+
+    Cached results and embeddings are dropped as soon as the collection's
+    version changes, i.e. once `embed_documents.py` has rebuilt, added to or
+    synced it.
+    `as_retriever` and the similarity searches all go through the caches.
+
+    :param max_results: searches whose results are kept
+    :type max_results: int, optional
+    :param max_embeddings: query embeddings kept
+    :type max_embeddings: int, optional
+    :param check_interval: seconds between checks of the collection version
+    :type check_interval: float, optional
+    """
+
+    def __init__(
+        self,
+        *args,
+        max_results: int = 1000,
+        max_embeddings: int = 10000,
+        check_interval: float = 1.0,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self.result_cache = LRUCache(max_results)
+        self.collection_version = CollectionVersion(
+            self.connection_string, self.collection_name, check_interval
+        )
+        self.embedding_function = LRUEmbeddings(
+            self.embedding_function, max_embeddings, self.collection_version.current
+        )
+        self.cached_version = None
+
+    def similarity_search_with_score(
+        self, query: str, k: int = 4, filter: Optional[dict] = None
+    ) -> List[Tuple[Document, float]]:
+        version = self.collection_version.current()
+        if version != self.cached_version:
+            self.result_cache.clear()
+            self.cached_version = version
+
+        key = (query, k, json.dumps(filter, sort_keys=True, default=str))
+        results = self.result_cache.get(key)
+        if results is _MISSING:
+            results = super().similarity_search_with_score(query, k=k, filter=filter)
+            self.result_cache.put(key, results)
+        # copies, so that a caller editing its documents leaves the cache intact
+        return [
+            (
+                Document(
+                    page_content=doc.page_content, metadata=copy.deepcopy(doc.metadata)
+                ),
+                score,
+            )
+            for doc, score in results
+        ]
+
+    def similarity_search(
+        self, query: str, k: int = 4, filter: Optional[dict] = None, **kwargs
+    ) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, filter)]
+
+    def cache_stats(self) -> Dict:
+        """Entries, hits and misses of both caches.
+
+        :return: {"embeddings": {...}, "results": {...}}
+        :rtype: Dict
+        """
+        return {
+            "embeddings": self.embedding_function.cache.stats(),
+            "results": self.result_cache.stats(),
+        }
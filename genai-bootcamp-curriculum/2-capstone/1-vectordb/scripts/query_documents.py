@@ -1,36 +1,98 @@
-from langchain.vectorstores.pgvector import PGVector
+import csv
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, Optional
 
 from langchain.embeddings.sentence_transformer import SentenceTransformerEmbeddings
 
-# The connection to the database
-CONNECTION_STRING = PGVector.connection_string_from_db_params(
-    driver="psycopg2",
-    host="localhost",
-    port="5432",
-    database="postgres",
-    user="username",
-    password="password",
-)
+from bm25_index import BM25Index
+from db_config import CONNECTION_STRING
+from devices import resolve_device
+from embedding_cache import with_embedding_cache
+from hybrid_search import HybridSearch
+from local_store import LocalVectorStore
+from manage_index import with_search_params
+from metadata_filter import FilteredPGVector
+from pipeline import batched
+from quantization import KINDS, QuantizedPGSearch
+from reduction import with_collection_reducer
+from retrieval_service import RetrievalService, results_to_json
 
 
-def make_query(query, top_k):
+def make_query(
+    query,
+    top_k,
+    embedding_cache_dir=None,
+    ef_search=None,
+    probes=None,
+    quantized=None,
+    candidates_per_result=10,
+    device=None,
+    local_store=None,
+    bm25_index=None,
+    search_filter=None,
+):
     # The embedding function that will be used to store into the database
     embedding_function = SentenceTransformerEmbeddings(
         model_name="BAAI/bge-large-en-v1.5",
-        model_kwargs={"device": "cuda"},
+        model_kwargs={"device": resolve_device(device)},
         encode_kwargs={"normalize_embeddings": True},
     )
+    embedding_function = with_embedding_cache(embedding_function, embedding_cache_dir)
 
-    # Creates the database connection to our existing DB
-    db = PGVector(
-        connection_string=CONNECTION_STRING,
-        collection_name="embeddings",
-        embedding_function=embedding_function,
+    if local_store is not None:
+        # searched in-process, no database involved
+        db = LocalVectorStore(
+            local_store, embedding_function, ef_search=ef_search or 64
+        )
+        run_search(db, query, top_k, bm25_index, search_filter)
+        return
+
+    # project queries like the stored embeddings, if they were reduced
+    embedding_function = with_collection_reducer(embedding_function, CONNECTION_STRING)
+
+    if quantized is not None:
+        # candidates from the compact-code index, rescored at full precision
+        db = QuantizedPGSearch(
+            CONNECTION_STRING,
+            embedding_function,
+            kind=quantized,
+            candidates_per_result=candidates_per_result,
+            ef_search=ef_search,
+        )
+    else:
+        # Creates the database connection to our existing DB, filters are
+        # compiled to (indexed) SQL predicates of the same query
+        db = FilteredPGVector(
+            connection_string=with_search_params(CONNECTION_STRING, ef_search, probes),
+            collection_name="embeddings",
+            embedding_function=embedding_function,
+        )
+
+    run_search(db, query, top_k, bm25_index, search_filter)
+
+
+def run_search(db, query, top_k, bm25_index=None, search_filter=None):
+    """Search `db` and print the results, fused with the results of a BM25
+    index if one is given. A metadata filter is only passed on if set, as
+    not every store takes one."""
+    kwargs = {"filter": search_filter} if search_filter else {}
+    if bm25_index is None:
+        print_results(db.similarity_search_with_score(query, k=top_k, **kwargs))
+        return
+
+    hybrid = HybridSearch(db, BM25Index(bm25_index))
+    print_results(hybrid.similarity_search_with_score(query, k=top_k, **kwargs))
+    timings = hybrid.stats()
+    print(
+        f"dense {timings['dense']['p50_ms']:.1f}ms, "
+        f"BM25 {timings['lexical']['p50_ms']:.1f}ms"
     )
 
-    docs_with_scores = db.similarity_search_with_score(query, k=top_k)
 
-    # print results
+def print_results(docs_with_scores):
     for doc, score in docs_with_scores:
         print("-" * 80)
         print("Score: ", score)
@@ -38,15 +100,212 @@ def make_query(query, top_k):
         print("-" * 80)
 
 
+def read_queries(path: str) -> Iterator[Dict]:
+    """Read queries from a JSONL or CSV file.
+
+    A JSONL line is either a string or an object with a "query" field; a CSV
+    needs a "query" column. Any other fields (e.g. an "id") are kept and
+    written back with the results.
+
+    :param path: .jsonl or .csv file
+    :type path: str
+    :return: iterator of records with a "query" field
+    :rtype: Iterator[Dict]
+    """
+    with open(path, newline="") as f:
+        if path.endswith(".csv"):
+            yield from csv.DictReader(f)
+            return
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                yield record if isinstance(record, dict) else {"query": record}
+
+
+def run_queries_file(
+    queries_file: str,
+    output: str = "-",
+    top_k: int = 2,
+    batch_size: int = 256,
+    concurrency: int = 8,
+    search_filter: Optional[Dict] = None,
+    **service_kwargs,
+):
+    """Search every query of a file, writing the results as JSONL.
+
+    Queries are read and embedded `batch_size` at a time, and the searches
+    of a batch run on `concurrency` threads over as many pooled
+    connections. Each batch is written as soon as it is searched, in input
+    order.
+
+    :param queries_file: .jsonl or .csv file of queries
+    :type queries_file: str
+    :param output: JSONL file to write, "-" for stdout
+    :type output: str, optional
+    :param top_k: results per query
+    :type top_k: int, optional
+    :param batch_size: queries embedded at a time
+    :type batch_size: int, optional
+    :param concurrency: searches run at once
+    :type concurrency: int, optional
+    :param search_filter: metadata filter of every query
+    :type search_filter: Optional[Dict], optional
+    :param service_kwargs: passed on to `RetrievalService`
+    """
+    service = RetrievalService(pool_size=concurrency, **service_kwargs)
+    out = sys.stdout if output == "-" else open(output, "w")
+
+    start_time = time.time()
+    n_queries = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for records in batched(read_queries(queries_file), batch_size):
+            queries = [record["query"] for record in records]
+            results = service.search_batch(
+                queries, top_k, executor, filter=search_filter
+            )
+            for record, query_results in zip(records, results):
+                record["results"] = results_to_json(query_results)
+                out.write(json.dumps(record) + "\n")
+            out.flush()
+            n_queries += len(records)
+    seconds = time.time() - start_time
+
+    if out is not sys.stdout:
+        out.close()
+    service.close()
+    # stdout may be the results, so report on stderr
+    print(
+        f"Searched {n_queries} queries in {seconds:.1f}s: "
+        f"{n_queries / seconds:.1f} queries/s "
+        f"(startup {service.stats()['startup_seconds']:.1f}s not included).",
+        file=sys.stderr,
+    )
+
+
 if __name__ == "__main__":
     import argparse
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("--query", type=str, required=True, help="query")
+    queries = parser.add_mutually_exclusive_group(required=True)
+    queries.add_argument("--query", type=str, help="query")
+    queries.add_argument(
+        "--queries_file",
+        "--queries-file",
+        type=str,
+        help="JSONL or CSV file of queries to search in batches",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default="-",
+        help="JSONL file the --queries_file results are written to, - for stdout",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=256,
+        help="--queries_file queries embedded at a time",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=8,
+        help="--queries_file searches run at once, over as many connections",
+    )
     parser.add_argument(
         "--top_k", type=int, default=2, help="how many similar entries to return"
     )
+    parser.add_argument(
+        "--device",
+        type=str,
+        default=None,
+        help="device to embed the query on, autodetected by default",
+    )
+    parser.add_argument(
+        "--embedding_cache_dir",
+        type=str,
+        default=None,
+        help="directory of the on-disk embedding cache, disabled if not set",
+    )
+    parser.add_argument(
+        "--ef_search",
+        type=int,
+        default=None,
+        help="HNSW candidate list size at query time (hnsw.ef_search)",
+    )
+    parser.add_argument(
+        "--probes",
+        type=int,
+        default=None,
+        help="IVFFlat lists scanned at query time (ivfflat.probes)",
+    )
+    parser.add_argument(
+        "--quantized",
+        type=str,
+        default=None,
+        choices=list(KINDS),
+        help="search the halfvec or binary index built by quantization.py",
+    )
+    parser.add_argument(
+        "--candidates_per_result",
+        type=int,
+        default=10,
+        help="candidates rescored at full precision per result with --quantized",
+    )
+
+    parser.add_argument(
+        "--local_store",
+        type=str,
+        default=None,
+        help="search the in-process store in this directory instead of Postgres",
+    )
+
+    parser.add_argument(
+        "--bm25_index",
+        type=str,
+        default=None,
+        help="BM25 index built by embed_documents.py, to fuse lexical results "
+        "with the vector ones",
+    )
+
+    parser.add_argument(
+        "--filter",
+        type=json.loads,
+        default=None,
+        help='metadata filter as JSON, e.g. \'{"source": {"in": ["a.pdf"]}, '
+        '"page": {"lt": 10}}\', see metadata_filter.py',
+    )
 
     args = parser.parse_args()
+    if args.queries_file is not None and (args.local_store or args.bm25_index):
+        parser.error("--local_store and --bm25_index search --query only")
 
-    make_query(query=args.query, top_k=args.top_k)
+    if args.queries_file is not None:
+        run_queries_file(
+            args.queries_file,
+            output=args.output,
+            top_k=args.top_k,
+            batch_size=args.batch_size,
+            concurrency=args.concurrency,
+            embedding_cache_dir=args.embedding_cache_dir,
+            device=args.device,
+            ef_search=args.ef_search,
+            probes=args.probes,
+            quantized=args.quantized,
+            candidates_per_result=args.candidates_per_result,
+            search_filter=args.filter,
+        )
+    else:
+        make_query(
+            query=args.query,
+            top_k=args.top_k,
+            embedding_cache_dir=args.embedding_cache_dir,
+            ef_search=args.ef_search,
+            probes=args.probes,
+            quantized=args.quantized,
+            candidates_per_result=args.candidates_per_result,
+            device=args.device,
+            local_store=args.local_store,
+            bm25_index=args.bm25_index,
+            search_filter=args.filter,
+        )
@@ -0,0 +1,390 @@
+import base64
+import json
+import threading
+import time
+from typing import Callable, Dict, Hashable, List, Optional
+
+import numpy as np
+import psycopg2
+from langchain_core.embeddings import Embeddings
+
+from bulk_writer import COLLECTION_TABLE
+from db_config import psycopg2_dsn
+
+REDUCTION_METHODS = ("pca", "random")
+
+
+def _encode(array: np.ndarray) -> str:
+    return base64.b64encode(array.astype(np.float32).tobytes()).decode("ascii")
+
+
+def _decode(data: str, shape: List[int]) -> np.ndarray:
+    return np.frombuffer(base64.b64decode(data), dtype=np.float32).reshape(shape)
+
+
+class Reducer:
+    """Linear projection of embeddings to fewer dimensions.
+
+    `transform` computes `(x - mean) @ components.T` and renormalizes the
+    result, so reduced vectors can be compared by cosine distance like the
+    originals.
+    """
+
+    def __init__(self, method: str, components: np.ndarray, mean: np.ndarray):
+        self.method = method
+        self.components = components.astype(np.float32)
+        self.mean = mean.astype(np.float32)
+
+    @property
+    def dim(self) -> int:
+        return self.components.shape[0]
+
+    @property
+    def input_dim(self) -> int:
+        return self.components.shape[1]
+
+    @classmethod
+    def fit(
+        cls, vectors: np.ndarray, method: str = "pca", dim: int = 256, seed: int = 0
+    ) -> "Reducer":
+        """Fit a projection to `dim` dimensions on a sample of the corpus.
+
+        :param vectors: embeddings of the sample, one per row
+        :type vectors: np.ndarray
+        :param method: "pca" keeps the directions of largest variance of the
+            sample, "random" is a Gaussian random projection that only uses
+            the sample for its dimension
+        :type method: str, optional
+        :param dim: target dimension
+        :type dim: int, optional
+        :param seed: seed of the random projection
+        :type seed: int, optional
+        :return: the fitted reducer
+        :rtype: Reducer
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        n, input_dim = vectors.shape
+        if dim >= input_dim:
+            raise ValueError(f"Cannot reduce {input_dim} dimensions to {dim}")
+        if method == "pca":
+            if n < dim:
+                raise ValueError(
+                    f"PCA to {dim} dimensions needs at least {dim} samples"
+                )
+            mean = vectors.mean(axis=0)
+            _, _, vt = np.linalg.svd(vectors - mean, full_matrices=False)
+            components = vt[:dim]
+        elif method == "random":
+            rng = np.random.default_rng(seed)
+            components = rng.standard_normal((dim, input_dim)) / np.sqrt(dim)
+            mean = np.zeros(input_dim)
+        else:
+            raise ValueError(f"Unknown reduction method {method!r}")
+        return cls(method, components, mean)
+
+    def transform(self, vectors: np.ndarray) -> np.ndarray:
+        centered = np.asarray(vectors, dtype=np.float32) - self.mean
+        reduced = centered @ self.components.T
+        norms = np.linalg.norm(reduced, axis=-1, keepdims=True)
+        return reduced / np.maximum(norms, 1e-12)
+
+    def to_dict(self) -> Dict:
+        return {
+            "method": self.method,
+            "shape": list(self.components.shape),
+            "components": _encode(self.components),
+            "mean": _encode(self.mean),
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "Reducer":
+        shape = data["shape"]
+        return cls(
+            data["method"],
+            _decode(data["components"], shape),
+            _decode(data["mean"], shape[1:]),
+        )
+
+
+class ReducedEmbeddings(Embeddings):
+    """Embeddings projected by a `Reducer`, for documents and queries alike."""
+
+    def __init__(self, embeddings: Embeddings, reducer: Reducer):
+        self.embeddings = embeddings
+        self.reducer = reducer
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors = np.asarray(self.embeddings.embed_documents(texts))
+        if not len(vectors):
+            return []
+        return self.reducer.transform(vectors).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.reducer.transform(self.embeddings.embed_query(text)).tolist()
+
+
+class CollectionReducedEmbeddings(Embeddings):
+    """Embeddings projected by the reducer stored with a collection, loaded
+    again whenever `version` changes, so that a long running process follows
+    rebuilds that change or drop the reduction.
+
+    :param embeddings: full dimension embedding function
+    :type embeddings: Embeddings
+    :param connection_string: database url
+    :type connection_string: str
+    :param collection_name: collection searched
+    :type collection_name: str, optional
+    :param version: returns the version of the collection, see
+        `query_cache.CollectionVersion.current`
+    :type version: Callable[[], Hashable]
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        connection_string: str,
+        collection_name: str = "embeddings",
+        version: Optional[Callable[[], Hashable]] = None,
+    ):
+        self.embeddings = embeddings
+        self.connection_string = connection_string
+        self.collection_name = collection_name
+        self.version = version
+        self.loaded = False
+        self.loaded_version = None
+        self.reducer = None
+        self.lock = threading.Lock()
+
+    def _reducer(self) -> Optional[Reducer]:
+        version = self.version() if self.version is not None else None
+        with self.lock:
+            if not self.loaded or version != self.loaded_version:
+                self.reducer = load_reducer(
+                    self.connection_string, self.collection_name
+                )
+                self.loaded, self.loaded_version = True, version
+            return self.reducer
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        reducer = self._reducer()
+        if reducer is None:
+            return self.embeddings.embed_documents(texts)
+        return ReducedEmbeddings(self.embeddings, reducer).embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        reducer = self._reducer()
+        if reducer is None:
+            return self.embeddings.embed_query(text)
+        return ReducedEmbeddings(self.embeddings, reducer).embed_query(text)
+
+
+def save_reducer(
+    connection_string: str, collection_name: str, reducer: Optional[Reducer]
+) -> None:
+    """Store the reducer in the collection's metadata, or remove it if None.
+
+    :param connection_string: database url
+    :type connection_string: str
+    :param collection_name: collection the reducer was fitted for
+    :type collection_name: str
+    :param reducer: the fitted reducer
+    :type reducer: Optional[Reducer]
+    """
+    conn = psycopg2.connect(psycopg2_dsn(connection_string))
+    with conn.cursor() as cur:
+        cur.execute(
+            f"SELECT cmetadata FROM {COLLECTION_TABLE} WHERE name = %s FOR UPDATE",
+            (collection_name,),
+        )
+        metadata = cur.fetchone()[0] or {}
+        metadata.pop("reduction", None)
+        if reducer is not None:
+            metadata["reduction"] = reducer.to_dict()
+        cur.execute(
+            f"UPDATE {COLLECTION_TABLE} SET cmetadata = %s WHERE name = %s",
+            (json.dumps(metadata), collection_name),
+        )
+    conn.commit()
+    conn.close()
+
+
+def load_reducer(connection_string: str, collection_name: str) -> Optional[Reducer]:
+    """The reducer stored with a collection, None if its embeddings are not
+    reduced or the collection doesn't exist.
+
+    :param connection_string: database url
+    :type connection_string: str
+    :param collection_name: collection to look up
+    :type collection_name: str
+    :return: the stored reducer
+    :rtype: Optional[Reducer]
+    """
+    conn = psycopg2.connect(psycopg2_dsn(connection_string))
+    with conn.cursor() as cur:
+        cur.execute(
+            f"SELECT cmetadata FROM {COLLECTION_TABLE} WHERE name = %s",
+            (collection_name,),
+        )
+        row = cur.fetchone()
+    conn.close()
+    if row is None or not row[0] or "reduction" not in row[0]:
+        return None
+    return Reducer.from_dict(row[0]["reduction"])
+
+
+def with_collection_reducer(
+    embeddings: Embeddings,
+    connection_string: str,
+    collection_name: str = "embeddings",
+    version: Optional[Callable[[], Hashable]] = None,
+) -> Embeddings:
+    """Project `embeddings` the way the collection's stored vectors were, if
+    they were reduced.
+
+    The reducer is read once, which suits a script; a process serving
+    queries across rebuilds passes `version` to have it read again
+    whenever the collection changes.
+
+    :param embeddings: full dimension embedding function
+    :type embeddings: Embeddings
+    :param connection_string: database url
+    :type connection_string: str
+    :param collection_name: collection that will be searched or added to
+    :type collection_name: str, optional
+    :param version: returns the version of the collection, see
+        `query_cache.CollectionVersion.current`
+    :type version: Optional[Callable[[], Hashable]], optional
+    :return: `embeddings`, wrapped in `ReducedEmbeddings` if needed, or in
+        `CollectionReducedEmbeddings` with `version`
+    :rtype: Embeddings
+    """
+    if version is not None:
+        return CollectionReducedEmbeddings(
+            embeddings, connection_string, collection_name, version
+        )
+    reducer = load_reducer(connection_string, collection_name)
+    if reducer is None:
+        return embeddings
+    return ReducedEmbeddings(embeddings, reducer)
+
+
+def _top_k(corpus: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    scores = queries @ corpus.T
+    return np.argpartition(-scores, k, axis=1)[:, :k]
+
+
+def reduction_report(
+    vectors: np.ndarray,
+    dims: List[int],
+    methods: List[str],
+    k: int = 10,
+    n_queries: int = 200,
+) -> List[Dict]:
+    """Recall@k of reduced embeddings against the full dimension ones.
+
+    The last `n_queries` vectors are held out as queries, the reducers are
+    fitted on the rest, which is also the corpus searched.
+
+    :param vectors: normalized embeddings of a sample of chunks
+    :type vectors: np.ndarray
+    :param dims: target dimensions to try
+    :type dims: List[int]
+    :param methods: reduction methods to try
+    :type methods: List[str]
+    :param k: number of neighbours retrieved
+    :type k: int, optional
+    :param n_queries: number of held-out chunks used as queries
+    :type n_queries: int, optional
+    :return: one row per method and dimension
+    :rtype: List[Dict]
+    """
+    corpus, queries = vectors[:-n_queries], vectors[-n_queries:]
+    exact = _top_k(corpus, queries, k)
+
+    rows = []
+    for method in methods:
+        for dim in dims:
+            start = time.time()
+            reducer = Reducer.fit(corpus, method, dim)
+            fit_seconds = time.time() - start
+            approx = _top_k(reducer.transform(corpus), reducer.transform(queries), k)
+            recall = np.mean([len(set(a) & set(e)) / k for a, e in zip(approx, exact)])
+            rows.append(
+                {
+                    "method": method,
+                    "dim": dim,
+                    "recall": recall,
+                    "bytes": dim * 4,
+                    "fit_seconds": fit_seconds,
+                }
+            )
+
+    print(
+        f"recall@{k} of {len(queries)} held-out chunks over {len(corpus)} chunks, "
+        f"full dimension {vectors.shape[1]} ({vectors.shape[1] * 4} bytes)"
+    )
+    print(f"{'method':<10}{'dim':>6}{'recall':>8}{'bytes':>8}{'fit s':>8}")
+    for row in rows:
+        print(
+            f"{row['method']:<10}{row['dim']:>6}{row['recall']:>8.3f}"
+            f"{row['bytes']:>8}{row['fit_seconds']:>8.2f}"
+        )
+    return rows
+
+
+if __name__ == "__main__":
+    import argparse
+    import glob
+
+    from embed_documents import chunk_document
+    from embedding_cache import with_embedding_cache
+    from encoding import BucketedEmbeddings
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--doc_dir", type=str, required=True, help="path to documents to sample"
+    )
+    parser.add_argument(
+        "--dims",
+        type=int,
+        nargs="+",
+        default=[64, 128, 256, 512],
+        help="target dimensions to report on",
+    )
+    parser.add_argument(
+        "--methods",
+        type=str,
+        nargs="+",
+        default=list(REDUCTION_METHODS),
+        choices=REDUCTION_METHODS,
+        help="reduction methods to report on",
+    )
+    parser.add_argument("--k", type=int, default=10, help="neighbours per query")
+    parser.add_argument(
+        "--n_queries", type=int, default=200, help="held-out chunks used as queries"
+    )
+    parser.add_argument(
+        "--limit", type=int, default=5000, help="maximum number of chunks to embed"
+    )
+    parser.add_argument("--device", type=str, default="cpu", help="device to run on")
+    parser.add_argument(
+        "--embedding_cache_dir",
+        type=str,
+        default=None,
+        help="directory of the on-disk embedding cache, disabled if not set",
+    )
+
+    args = parser.parse_args()
+
+    texts = []
+    for doc_path in sorted(glob.glob(f"{args.doc_dir}/*.pdf")):
+        texts += [chunk.page_content for chunk in chunk_document(doc_path)]
+        if len(texts) >= args.limit:
+            break
+
+    embedding_function = with_embedding_cache(
+        BucketedEmbeddings("BAAI/bge-large-en-v1.5", device=args.device),
+        args.embedding_cache_dir,
+    )
+    vectors = np.asarray(embedding_function.embed_documents(texts[: args.limit]))
+    reduction_report(vectors, args.dims, args.methods, args.k, args.n_queries)
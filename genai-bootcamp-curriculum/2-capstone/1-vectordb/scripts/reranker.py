@@ -0,0 +1,210 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.runnables import RunnableLambda
+from sentence_transformers import CrossEncoder
+
+from devices import resolve_device
+from latency import LatencyWindow
+
+# 22M parameters, scores a few dozen (question, chunk) pairs in tens of ms on CPU
+DEFAULT_RERANKER = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+
+
+class CrossEncoderReranker:
+    """A cross-encoder scoring how well chunks answer a question.
+
+    Unlike the bi-encoder of the vector search, which embeds the question
+    and the chunks separately, a cross-encoder reads each (question, chunk)
+    pair together, which ranks far better but costs one forward pass per
+    pair, so it is only run on the few candidates of a vector search.
+
+    :param model_name: sentence-transformers cross-encoder
+    :type model_name: str, optional
+    :param device: device to score on, autodetected by default
+    :type device: Optional[str], optional
+    :param max_length: tokens of a pair, longer chunks are truncated
+    :type max_length: int, optional
+    """
+
+    def __init__(
+        self,
+        model_name: str = DEFAULT_RERANKER,
+        device: Optional[str] = None,
+        max_length: int = 512,
+    ):
+        self.model_name = model_name
+        self.model = CrossEncoder(
+            model_name, device=resolve_device(device), max_length=max_length
+        )
+        # the first call through the model is much slower than the next ones
+        self.score("warmup", ["warmup"])
+
+    def score(self, query: str, texts: List[str]) -> List[float]:
+        """Relevance of each text to `query`, in one batch.
+
+        :param query: question
+        :type query: str
+        :param texts: candidate chunks
+        :type texts: List[str]
+        :return: a score per text, higher is more relevant
+        :rtype: List[float]
+        """
+        if not texts:
+            return []
+        scores = self.model.predict(
+            [(query, text) for text in texts],
+            batch_size=len(texts),
+            show_progress_bar=False,
+        )
+        return [float(score) for score in scores]
+
+
+class RerankedSearch:
+    """Two-stage retrieval: over-fetch `candidates` chunks from a vector
+    store, rescore them with a cross-encoder and keep the best `k`.
+
+    A small `k` then holds the right chunk more often than the raw top `k`
+    of the vector search would, without paying for a large `k` in prompt
+    tokens. With `max_rerank_ms`, reranking never holds a search up for
+    longer: only as many of the best candidates as the cost of the previous
+    batches says fit in the time are rescored, and a batch still being
+    scored when the time is up gives way to the vector order. The time
+    spent in each stage is recorded.
+
+    :param vectorstore: `PGVector`, `LocalVectorStore`, `HybridSearch` or
+        anything else with `similarity_search_with_score`
+    :param reranker: cross-encoder scoring the candidates
+    :type reranker: CrossEncoderReranker
+    :param candidates: chunks fetched from the vector store and rescored
+    :type candidates: int, optional
+    :param max_rerank_ms: time reranking may take, unlimited by default
+    :type max_rerank_ms: Optional[float], optional
+    """
+
+    def __init__(
+        self,
+        vectorstore,
+        reranker: CrossEncoderReranker,
+        candidates: int = 20,
+        max_rerank_ms: Optional[float] = None,
+    ):
+        self.vectorstore = vectorstore
+        self.reranker = reranker
+        self.candidates = candidates
+        self.max_rerank_ms = max_rerank_ms
+        # scoring runs on its own thread so that a search can stop waiting
+        # for it; one batch at a time, on CPU more would only contend
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._busy = threading.Lock()
+        self._lock = threading.Lock()
+        self.ms_per_pair = None
+        self.fallbacks = 0
+        self.latencies = {"retrieve": LatencyWindow(), "rerank": LatencyWindow()}
+
+    def _score(self, query: str, texts: List[str]) -> List[float]:
+        try:
+            start = time.perf_counter()
+            scores = self.reranker.score(query, texts)
+            ms = (time.perf_counter() - start) * 1000
+            with self._lock:
+                # moving average of the cost of a pair, for the next budgets
+                per_pair = ms / len(texts)
+                if self.ms_per_pair is None:
+                    self.ms_per_pair = per_pair
+                else:
+                    self.ms_per_pair = 0.8 * self.ms_per_pair + 0.2 * per_pair
+            return scores
+        finally:
+            self._busy.release()
+
+    def _rerank(self, query: str, texts: List[str]) -> Optional[List[float]]:
+        # the scores of the first texts, or None to keep the vector order
+        if self.max_rerank_ms is None:
+            self._busy.acquire()
+            return self._score(query, texts)
+        if self.ms_per_pair is not None:
+            # at least two, so that the cost keeps being measured
+            fits = max(2, int(self.max_rerank_ms / self.ms_per_pair))
+            texts = texts[:fits]
+        # a batch that ran out of time may still be scoring
+        if not self._busy.acquire(blocking=False):
+            return None
+        future = self._executor.submit(self._score, query, texts)
+        try:
+            return future.result(timeout=self.max_rerank_ms / 1000)
+        except FutureTimeoutError:
+            return None
+
+    def similarity_search_with_score(
+        self, query: str, k: int = 4, filter: Optional[dict] = None
+    ) -> List[Tuple[Document, Optional[float]]]:
+        """The `k` best chunks for `query` by cross-encoder score.
+
+        Scores are always the cross-encoder's, higher is better. Chunks that
+        were not rescored, because reranking gave way to the vector order or
+        ran out of time before them, follow in vector order with a score of
+        None rather than the vector store's own, whose scale (and direction)
+        differs.
+
+        :param query: search text
+        :type query: str
+        :param k: number of chunks to return
+        :type k: int, optional
+        :param filter: metadata filter, passed on to the vector store
+        :type filter: Optional[dict], optional
+        :return: (chunk, cross-encoder score or None) pairs, best first
+        :rtype: List[Tuple[Document, Optional[float]]]
+        """
+        start = time.perf_counter()
+        # not every store takes a filter
+        kwargs = {"filter": filter} if filter else {}
+        candidates = self.vectorstore.similarity_search_with_score(
+            query, k=max(k, self.candidates), **kwargs
+        )
+        self.latencies["retrieve"].record(time.perf_counter() - start)
+        if not candidates:
+            return []
+
+        start = time.perf_counter()
+        scores = self._rerank(query, [doc.page_content for doc, _ in candidates])
+        self.latencies["rerank"].record(time.perf_counter() - start)
+        if scores is None:
+            with self._lock:
+                self.fallbacks += 1
+            scores = []
+
+        # candidates left out for lack of time follow in vector order
+        order = np.argsort(scores)[::-1]
+        reranked = [(candidates[i][0], scores[i]) for i in order]
+        unscored = [(doc, None) for doc, _ in candidates[len(scores) :]]
+        return (reranked + unscored)[:k]
+
+    def similarity_search(
+        self, query: str, k: int = 4, filter: Optional[dict] = None
+    ) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, filter)]
+
+    def as_retriever(self, search_kwargs: Optional[dict] = None) -> RunnableLambda:
+        """A runnable from a query to its chunks, usable in a chain like a
+        vector store retriever."""
+        search_kwargs = search_kwargs or {}
+        return RunnableLambda(
+            lambda query: self.similarity_search(query, **search_kwargs)
+        )
+
+    def stats(self) -> Dict:
+        """p50/p99 latency in ms of each stage over the last (up to) 10000
+        searches, and how many kept the vector order.
+
+        :return: {"retrieve": {...}, "rerank": {...}, "fallbacks": int}
+        :rtype: Dict
+        """
+        stats = {stage: window.stats() for stage, window in self.latencies.items()}
+        stats["fallbacks"] = self.fallbacks
+        return stats
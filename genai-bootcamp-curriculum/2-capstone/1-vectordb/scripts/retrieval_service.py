@@ -0,0 +1,352 @@
+import threading
+import time
+from concurrent.futures import Executor
+from functools import partial
+from typing import Dict, List, Optional, Tuple
+
+from langchain.embeddings.sentence_transformer import SentenceTransformerEmbeddings
+from langchain_core.documents import Document
+from psycopg2.pool import ThreadedConnectionPool
+
+from db_config import CONNECTION_STRING, psycopg2_dsn
+from devices import resolve_device
+from embedding_cache import with_embedding_cache
+from latency import LatencyWindow
+from manage_index import with_search_params
+from metadata_filter import compile_filter, generated_columns, search_sql
+from quantization import embedding_dim, quantized_search_sql, set_candidate_list
+from query_cache import CollectionVersion
+from reduction import with_collection_reducer
+
+SEARCH_SQL = search_sql()
+
+
+class RetrievalService:
+    """A resident retriever: the embedding model is loaded once and searches
+    run over a pool of open database connections.
+
+    Building one takes seconds (loading bge-large, opening connections),
+    after which a search costs one query embedding and one SQL query. Use
+    a single instance for the lifetime of a process, from any number of
+    threads. The collection is looked up again (at most once a second)
+    before searching, so that the service follows it across rebuilds, along
+    with its reduction and dimension.
+
+    :param connection_string: database url
+    :type connection_string: str, optional
+    :param collection_name: collection to search
+    :type collection_name: str, optional
+    :param embedding_cache_dir: on-disk embedding cache, defaults to no cache
+    :type embedding_cache_dir: Optional[str], optional
+    :param device: device to embed queries on, autodetected by default
+    :type device: Optional[str], optional
+    :param ef_search: `hnsw.ef_search` of every connection
+    :type ef_search: Optional[int], optional
+    :param probes: `ivfflat.probes` of every connection
+    :type probes: Optional[int], optional
+    :param quantized: "halfvec" or "binary" to search the quantized index and
+        rescore (see quantization.py)
+    :type quantized: Optional[str], optional
+    :param candidates_per_result: candidates rescored per result with
+        `quantized`
+    :type candidates_per_result: int, optional
+    :param pool_size: maximum number of open connections
+    :type pool_size: int, optional
+    """
+
+    def __init__(
+        self,
+        connection_string: str = CONNECTION_STRING,
+        collection_name: str = "embeddings",
+        embedding_cache_dir: Optional[str] = None,
+        device: Optional[str] = None,
+        ef_search: Optional[int] = None,
+        probes: Optional[int] = None,
+        quantized: Optional[str] = None,
+        candidates_per_result: int = 10,
+        pool_size: int = 8,
+    ):
+        self.startup = {}
+        start = time.perf_counter()
+        self.embedding_function = SentenceTransformerEmbeddings(
+            model_name="BAAI/bge-large-en-v1.5",
+            model_kwargs={"device": resolve_device(device)},
+            encode_kwargs={"normalize_embeddings": True},
+        )
+        self.embedding_function = with_embedding_cache(
+            self.embedding_function, embedding_cache_dir
+        )
+        # a rebuild changes the collection's uuid, and may its reduction
+        self.collection_name = collection_name
+        self.collection_version = CollectionVersion(connection_string, collection_name)
+        # project queries like the stored embeddings, if they were reduced
+        self.embedding_function = with_collection_reducer(
+            self.embedding_function,
+            connection_string,
+            collection_name,
+            version=self.collection_version.current,
+        )
+        self.startup["model_seconds"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self.pool = ThreadedConnectionPool(
+            1,
+            pool_size,
+            psycopg2_dsn(with_search_params(connection_string, ef_search, probes)),
+        )
+        self.quantized = quantized
+        # (uuid, embedding dimension with `quantized`) of the collection
+        self._collection = None
+        conn = self.pool.getconn()
+        try:
+            self._current_collection(conn)
+            # filters compare the indexed generated columns where there are some
+            self.columns = generated_columns(conn)
+            conn.rollback()
+        finally:
+            self.pool.putconn(conn)
+        self.candidates_per_result = candidates_per_result
+        self.ef_search = ef_search or 0
+        self.startup["connect_seconds"] = time.perf_counter() - start
+
+        # the first call through the model is much slower than the next ones
+        start = time.perf_counter()
+        self._embed_lock = threading.Lock()
+        self.embed_queries(["warmup"])
+        self.startup["warmup_seconds"] = time.perf_counter() - start
+
+        # Flask serves searches on several threads while stats() reads
+        self.latencies = LatencyWindow()
+
+    def embed_queries(self, queries: List[str]) -> List[List[float]]:
+        """Embed queries in one batch.
+
+        :param queries: queries to embed
+        :type queries: List[str]
+        :return: their embeddings
+        :rtype: List[List[float]]
+        """
+        # one forward pass at a time on the shared model
+        with self._embed_lock:
+            if len(queries) == 1:
+                return [self.embedding_function.embed_query(queries[0])]
+            return self.embedding_function.embed_documents(queries)
+
+    def _current_collection(self, conn) -> Tuple[str, Optional[int]]:
+        version = self.collection_version.current()
+        if version is None:
+            raise ValueError(f"No collection {self.collection_name!r}")
+        # swapped whole, so that concurrent searches never mix two collections
+        collection = self._collection
+        if collection is None or collection[0] != version[0]:
+            dim = None
+            if self.quantized is not None:
+                dim = embedding_dim(conn, version[0])
+            collection = self._collection = (version[0], dim)
+        return collection
+
+    def _sql(self, where: str, dim: Optional[int]) -> str:
+        if self.quantized is not None:
+            return quantized_search_sql(self.quantized, dim, where)
+        return search_sql(where) if where else SEARCH_SQL
+
+    def search_by_vector(
+        self, embedding: List[float], k: int = 4, filter: Optional[dict] = None
+    ) -> List[Tuple[Document, float]]:
+        """Nearest chunks to an embedding, with their cosine distances.
+
+        :param embedding: query embedding
+        :type embedding: List[float]
+        :param k: number of chunks to return
+        :type k: int, optional
+        :param filter: metadata filter (see `metadata_filter.compile_filter`),
+            applied in the same query as the vector ordering
+        :type filter: Optional[dict], optional
+        :return: (chunk, distance) pairs, closest first
+        :rtype: List[Tuple[Document, float]]
+        """
+        candidates = k * self.candidates_per_result
+        where, params = compile_filter(filter, self.columns) if filter else ("", {})
+        params.update(query=str(list(embedding)), candidates=candidates, k=k)
+        # the pool raises rather than waits when every connection is taken
+        with self._slots:
+            conn = self.pool.getconn()
+            try:
+                collection_id, dim = self._current_collection(conn)
+                params["collection_id"] = collection_id
+                with conn.cursor() as cur:
+                    if self.quantized is not None:
+                        set_candidate_list(cur, max(candidates, self.ef_search))
+                    cur.execute(self._sql(where, dim), params)
+                    rows = cur.fetchall()
+                conn.rollback()
+            finally:
+                self.pool.putconn(conn)
+        return [
+            (Document(page_content=document, metadata=metadata or {}), distance)
+            for _, document, metadata, distance in rows
+        ]
+
+    def search_batch(
+        self,
+        queries: List[str],
+        k: int = 4,
+        executor: Optional[Executor] = None,
+        filter: Optional[dict] = None,
+    ) -> List[List[Tuple[Document, float]]]:
+        """Embed queries in one batch and search them, concurrently over the
+        pooled connections if an executor is given.
+
+        :param queries: queries to search
+        :type queries: List[str]
+        :param k: number of chunks per query
+        :type k: int, optional
+        :param executor: thread pool to run the searches on, at most
+            `pool_size` searches run at once whatever its size
+        :type executor: Optional[Executor], optional
+        :param filter: metadata filter of every query
+        :type filter: Optional[dict], optional
+        :return: the (chunk, distance) pairs of each query, in query order
+        :rtype: List[List[Tuple[Document, float]]]
+        """
+        embeddings = self.embed_queries(queries)
+        search = partial(self.search_by_vector, k=k, filter=filter)
+        if executor is None:
+            return [search(embedding) for embedding in embeddings]
+        return list(executor.map(search, embeddings))
+
+    def similarity_search_with_score(
+        self, query: str, k: int = 4, filter: Optional[dict] = None
+    ) -> List[Tuple[Document, float]]:
+        """Embed `query` and return its `k` nearest chunks, like
+        `PGVector.similarity_search_with_score`."""
+        start = time.perf_counter()
+        results = self.search_by_vector(self.embed_queries([query])[0], k, filter)
+        self.latencies.record(time.perf_counter() - start)
+        return results
+
+    def stats(self) -> Dict:
+        """Startup cost and steady state latency of the service.
+
+        :return: seconds spent loading the model, connecting and warming up,
+            and the p50/p99 latency in ms of the last (up to) 10000 searches
+        :rtype: Dict
+        """
+        stats = dict(self.startup)
+        stats["startup_seconds"] = sum(self.startup.values())
+        stats.update(self.latencies.stats())
+        return stats
+
+    def close(self) -> None:
+        self.pool.closeall()
+
+
+def results_to_json(results: List[Tuple[Document, float]]) -> List[Dict]:
+    return [
+        {"page_content": doc.page_content, "metadata": doc.metadata, "score": score}
+        for doc, score in results
+    ]
+
+
+def print_stats(stats: Dict) -> None:
+    print(
+        f"startup: {stats['startup_seconds']:.2f}s "
+        f"(model {stats['model_seconds']:.2f}s, "
+        f"connect {stats['connect_seconds']:.2f}s, "
+        f"warmup {stats['warmup_seconds']:.2f}s)"
+    )
+    if stats["n_queries"]:
+        print(
+            f"steady state over {stats['n_queries']} queries: "
+            f"p50 {stats['p50_ms']:.1f}ms, p99 {stats['p99_ms']:.1f}ms"
+        )
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "command",
+        choices=["serve", "bench"],
+        help="serve queries over HTTP, or time repeated queries",
+    )
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="address")
+    parser.add_argument("--port", type=int, default=7862, help="port to serve on")
+    parser.add_argument(
+        "--query", type=str, nargs="+", default=None, help="bench queries"
+    )
+    parser.add_argument(
+        "--n_queries", type=int, default=200, help="bench queries to run"
+    )
+    parser.add_argument("--top_k", type=int, default=4, help="bench results")
+    parser.add_argument(
+        "--pool_size", type=int, default=8, help="database connections kept open"
+    )
+    parser.add_argument(
+        "--device", type=str, default=None, help="device, autodetected by default"
+    )
+    parser.add_argument(
+        "--embedding_cache_dir",
+        type=str,
+        default=None,
+        help="directory of the on-disk embedding cache, disabled if not set",
+    )
+    parser.add_argument(
+        "--ef_search", type=int, default=None, help="hnsw.ef_search at query time"
+    )
+    parser.add_argument(
+        "--probes", type=int, default=None, help="ivfflat.probes at query time"
+    )
+    parser.add_argument(
+        "--quantized",
+        type=str,
+        default=None,
+        choices=["halfvec", "binary"],
+        help="search the halfvec or binary index built by quantization.py",
+    )
+    parser.add_argument(
+        "--candidates_per_result",
+        type=int,
+        default=10,
+        help="candidates rescored at full precision per result with --quantized",
+    )
+
+    args = parser.parse_args()
+
+    service = RetrievalService(
+        embedding_cache_dir=args.embedding_cache_dir,
+        device=args.device,
+        ef_search=args.ef_search,
+        probes=args.probes,
+        quantized=args.quantized,
+        candidates_per_result=args.candidates_per_result,
+        pool_size=args.pool_size,
+    )
+    print_stats(service.stats())
+
+    if args.command == "bench":
+        queries = args.query or ["What is retrieval augmented generation?"]
+        for i in range(args.n_queries):
+            service.similarity_search_with_score(queries[i % len(queries)], args.top_k)
+        print_stats(service.stats())
+        service.close()
+    else:
+        from flask import Flask, request
+
+        app = Flask(__name__)
+
+        @app.route("/search", methods=["POST"])
+        def search():
+            data = request.get_json(force=True)
+            results = service.similarity_search_with_score(
+                data["query"], k=data.get("k", 4), filter=data.get("filter")
+            )
+            return {"results": results_to_json(results)}
+
+        @app.route("/stats", methods=["GET"])
+        def stats():
+            return service.stats()
+
+        app.run(host=args.host, port=args.port, threaded=True)
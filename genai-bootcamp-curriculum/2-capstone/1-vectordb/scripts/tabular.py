@@ -0,0 +1,129 @@
+import math
+from typing import Dict, Iterator, List, Optional
+
+import pandas as pd
+from langchain_core.documents import Document
+
+TABLE_EXTENSIONS = (".csv", ".xlsx", ".xls")
+
+
+def read_table(path: str, chunksize: int = 10000) -> Iterator[pd.DataFrame]:
+    """Read a CSV or Excel file in chunks of `chunksize` rows.
+
+    CSVs are streamed; Excel files have to be read whole and are then sliced.
+
+    :param path: path to a .csv, .xlsx or .xls file
+    :type path: str
+    :param chunksize: rows per chunk
+    :type chunksize: int, optional
+    :return: iterator of DataFrames
+    :rtype: Iterator[pd.DataFrame]
+    """
+    if path.endswith(".csv"):
+        yield from pd.read_csv(path, chunksize=chunksize)
+        return
+
+    df = pd.read_excel(path)
+    for start in range(0, len(df), chunksize):
+        yield df.iloc[start : start + chunksize]
+
+
+def default_template(columns: List[str]) -> str:
+    """One `column: value` line per column."""
+    return "\n".join(f"{column}: {{{column}}}" for column in columns)
+
+
+def _json_value(value):
+    # numpy scalars and NaN don't survive json metadata
+    if hasattr(value, "item"):
+        value = value.item()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+def _blank_cells(record: Dict) -> Dict:
+    # blank cells render as empty strings rather than "nan"
+    return {column: "" if _json_value(v) is None else v for column, v in record.items()}
+
+
+def _group_runs(records: List[Dict], group_by: List[str]) -> List[List[Dict]]:
+    runs = []
+    for record in records:
+        # blank cells are equal to each other, unlike NaN
+        key = [_json_value(record[column]) for column in group_by]
+        if runs and [_json_value(runs[-1][0][column]) for column in group_by] == key:
+            runs[-1].append(record)
+        else:
+            runs.append([record])
+    return runs
+
+
+def render_table(
+    path: str,
+    template: Optional[str] = None,
+    group_by: Optional[List[str]] = None,
+    group_template: Optional[str] = None,
+    metadata_columns: Optional[List[str]] = None,
+    chunksize: int = 10000,
+) -> Iterator[Document]:
+    """Render the rows of a table into Documents ready to embed.
+
+    Each row is formatted with `template`, a `str.format` string over the
+    column names (e.g. "{Table Name}: {Table Description}"). With `group_by`,
+    consecutive rows sharing the same values in those columns become one
+    Document: `group_template` rendered with the first row, followed by each
+    row rendered with `template`. The `metadata_columns` of the (first) row
+    are kept as metadata fields so searches can filter on them.
+
+    :param path: path to a .csv, .xlsx or .xls file
+    :type path: str
+    :param template: row template, defaults to a `column: value` line per column
+    :type template: Optional[str], optional
+    :param group_by: columns whose runs of equal values form one Document
+    :type group_by: Optional[List[str]], optional
+    :param group_template: header of a group, defaults to none
+    :type group_template: Optional[str], optional
+    :param metadata_columns: columns kept as metadata
+    :type metadata_columns: Optional[List[str]], optional
+    :param chunksize: rows read at a time
+    :type chunksize: int, optional
+    :return: iterator of Documents
+    :rtype: Iterator[Document]
+    """
+    group_by = group_by or []
+    metadata_columns = metadata_columns or []
+    n_rows = 0
+    carry: List[Dict] = []
+
+    def to_document(rows: List[Dict], row_number: int) -> Document:
+        lines = [template.format_map(_blank_cells(row)) for row in rows]
+        if group_template is not None:
+            lines.insert(0, group_template.format_map(_blank_cells(rows[0])))
+        metadata = {"source": path, "row": row_number}
+        for column in metadata_columns:
+            metadata[column] = _json_value(rows[0][column])
+        return Document(page_content="\n".join(lines), metadata=metadata)
+
+    for df in read_table(path, chunksize):
+        if template is None:
+            template = default_template(list(df.columns))
+        # blank cells stay NaN, so they become None in the metadata
+        records = carry + df.to_dict("records")
+        n_rows += len(df)
+        if not group_by:
+            first = n_rows - len(records)
+            for i, record in enumerate(records):
+                yield to_document([record], first + i)
+            continue
+
+        # the last run may continue in the next chunk
+        runs = _group_runs(records, group_by)
+        carry = runs.pop()
+        first = n_rows - len(records)
+        for run in runs:
+            yield to_document(run, first)
+            first += len(run)
+
+    if carry:
+        yield to_document(carry, n_rows - len(carry))
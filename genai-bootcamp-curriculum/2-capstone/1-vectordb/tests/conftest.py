@@ -0,0 +1,48 @@
+import os
+import re
+import sys
+
+import pytest
+
+# the scripts import each other by module name
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts")
+)
+
+
+class WordTokenizer:
+    """A tokenizer with one token per whitespace separated word, standing in
+    for a Hugging Face fast tokenizer so tests need no model download."""
+
+    def __init__(self):
+        self.words = []
+        self.ids = {}
+
+    def _encode(self, text):
+        ids, offsets = [], []
+        for match in re.finditer(r"\S+", text):
+            word = match.group()
+            if word not in self.ids:
+                self.ids[word] = len(self.words)
+                self.words.append(word)
+            ids.append(self.ids[word])
+            offsets.append((match.start(), match.end()))
+        return ids, offsets
+
+    def __call__(self, text, add_special_tokens=True, return_offsets_mapping=False):
+        texts = [text] if isinstance(text, str) else text
+        encoded = [self._encode(t) for t in texts]
+        output = {"input_ids": [ids for ids, _ in encoded]}
+        if return_offsets_mapping:
+            output["offset_mapping"] = [offsets for _, offsets in encoded]
+        if isinstance(text, str):
+            output = {key: value[0] for key, value in output.items()}
+        return output
+
+    def decode(self, ids):
+        return " ".join(self.words[i] for i in ids)
+
+
+@pytest.fixture
+def tokenizer():
+    return WordTokenizer()
@@ -0,0 +1,81 @@
+import pytest
+from langchain_core.documents import Document
+
+from bm25_index import BM25Index, tokenize
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = BM25Index(str(tmp_path / "bm25.sqlite"))
+    index.add(
+        [
+            Document(
+                page_content="ColumnAcronyms lists the acronym of each column",
+                metadata={"source": "tables.csv", "row": 1},
+            ),
+            Document(
+                page_content="ColumnAcronyms lists the acronym of each column",
+                metadata={"source": "copy.csv", "row": 1},
+            ),
+            Document(
+                page_content="The owner table maps systems to their owners",
+                metadata={"source": "tables.csv", "row": 2},
+            ),
+        ]
+    )
+    return index
+
+
+def test_tokenize_splits_identifiers_and_drops_stopwords():
+    assert tokenize("What is in ColumnAcronyms?") == [
+        "columnacronyms",
+        "column",
+        "acronyms",
+    ]
+
+
+def test_search_ranks_matching_chunks_first(index):
+    results = index.search("owner of systems", k=3)
+
+    assert results[0][0].metadata["row"] == 2
+    # chunks sharing no term are never returned
+    assert len(results) == 1
+
+
+def test_identical_text_from_two_sources_is_kept_apart(index):
+    results = index.search("ColumnAcronyms", k=5)
+
+    assert len(index) == 3
+    assert {doc.metadata["source"] for doc, _ in results} == {"tables.csv", "copy.csv"}
+
+
+def test_filter_is_applied_before_ranking(index):
+    results = index.search("ColumnAcronyms owner", k=1, filter={"source": "copy.csv"})
+
+    assert [doc.metadata["source"] for doc, _ in results] == ["copy.csv"]
+
+
+def test_filter_does_not_change_scores(index):
+    unfiltered = dict(
+        (doc.metadata["source"], score)
+        for doc, score in index.search("ColumnAcronyms", k=5)
+    )
+    filtered = index.search("ColumnAcronyms", k=5, filter={"source": "copy.csv"})
+
+    assert filtered[0][1] == pytest.approx(unfiltered["copy.csv"])
+
+
+def test_adding_a_chunk_again_replaces_it(index):
+    chunk = Document(page_content="owner table", metadata={"row": 3})
+    index.add([chunk])
+    index.add([chunk])
+
+    assert len(index) == 4
+
+
+def test_delete_removes_chunks(index):
+    index.add([Document(page_content="temporary acronym")], ids=["tmp"])
+    index.delete(["tmp"])
+
+    assert len(index) == 3
+    assert index.search("temporary") == []
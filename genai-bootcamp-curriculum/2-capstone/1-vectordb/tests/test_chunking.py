@@ -0,0 +1,57 @@
+from langchain_core.documents import Document
+
+from chunking import TokenBudgetSplitter
+
+
+def make_splitter(tokenizer, max_tokens, overlap_tokens=0):
+    splitter = TokenBudgetSplitter(max_tokens=max_tokens, overlap_tokens=overlap_tokens)
+    splitter._tokenizer = tokenizer
+    return splitter
+
+
+def test_chunks_stay_within_budget_and_end_on_sentences(tokenizer):
+    text = "One two three. Four five six. Seven eight nine. Ten eleven twelve."
+    chunks = make_splitter(tokenizer, max_tokens=6).split_documents(
+        [Document(page_content=text, metadata={"source": "a.pdf"})]
+    )
+
+    assert [chunk.page_content for chunk in chunks] == [
+        "One two three. Four five six.",
+        "Seven eight nine. Ten eleven twelve.",
+    ]
+    assert all(chunk.metadata == {"source": "a.pdf"} for chunk in chunks)
+
+
+def test_long_sentence_is_cut_into_windows(tokenizer):
+    text = " ".join(f"w{i}" for i in range(10))
+    chunks = make_splitter(tokenizer, max_tokens=4).split_documents(
+        [Document(page_content=text)]
+    )
+
+    assert [len(chunk.page_content.split()) for chunk in chunks] == [4, 4, 2]
+    assert " ".join(chunk.page_content for chunk in chunks) == text
+
+
+def test_overlap_repeats_trailing_sentences(tokenizer):
+    text = "A b. C d. E f. G h."
+    chunks = make_splitter(tokenizer, max_tokens=4, overlap_tokens=2).split_documents(
+        [Document(page_content=text)]
+    )
+
+    assert [chunk.page_content for chunk in chunks] == [
+        "A b. C d.",
+        "C d. E f.",
+        "E f. G h.",
+    ]
+
+
+def test_blank_documents_give_no_chunks(tokenizer):
+    splitter = make_splitter(tokenizer, max_tokens=4)
+
+    assert splitter.split_documents([Document(page_content=" \n\n ")]) == []
+
+
+def test_splitter_pickles_without_its_tokenizer(tokenizer):
+    splitter = make_splitter(tokenizer, max_tokens=4)
+
+    assert splitter.__getstate__()["_tokenizer"] is None
@@ -0,0 +1,49 @@
+from langchain_core.documents import Document
+
+from context_packer import pack_context
+
+
+def docs(*texts):
+    return [Document(page_content=text) for text in texts]
+
+
+def test_documents_that_fit_are_joined_whole(tokenizer):
+    context, stats = pack_context(docs("One two. Three.", "Four five."), tokenizer)
+
+    assert context == "One two. Three.\n\nFour five."
+    assert stats["docs_used"] == 2
+    assert not stats["truncated"]
+
+
+def test_repeated_sentences_are_packed_once(tokenizer):
+    context, stats = pack_context(
+        docs("Alpha beta gamma. Delta epsilon.", "Delta epsilon. Zeta eta."), tokenizer
+    )
+
+    assert context == "Alpha beta gamma. Delta epsilon.\n\nZeta eta."
+    assert stats["tokens_saved"] == 2
+
+
+def test_near_duplicate_documents_are_dropped(tokenizer):
+    text = "a b c d e f g h i j k l"
+    context, stats = pack_context(docs(text, text + " m."), tokenizer)
+
+    assert context == text
+    assert stats["duplicates"] == 1
+
+
+def test_budget_cuts_at_the_last_sentence_that_fits(tokenizer):
+    context, stats = pack_context(
+        docs("One two. Three four.", "Five six. Seven eight."), tokenizer, max_tokens=6
+    )
+
+    assert context == "One two. Three four.\n\nFive six."
+    assert stats["tokens"] <= 6
+    assert stats["truncated"]
+
+
+def test_a_first_sentence_over_budget_is_cut(tokenizer):
+    context, stats = pack_context(docs("w1 w2 w3 w4 w5"), tokenizer, max_tokens=3)
+
+    assert context == "w1 w2 w3"
+    assert stats["truncated"]
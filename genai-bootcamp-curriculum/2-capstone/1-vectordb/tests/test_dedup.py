@@ -0,0 +1,74 @@
+from langchain_core.documents import Document
+
+from dedup import ChunkDeduplicator, lsh_bands, normalize
+from manifest import chunk_id
+
+TEXT = (
+    "The quarterly report lists every system of record with its owner, "
+    "its source system acronym and the tables it feeds downstream."
+)
+
+
+def test_lsh_bands_use_every_permutation_they_can():
+    bands, rows = lsh_bands(0.8, 128)
+
+    assert bands * rows <= 128
+    assert bands > 1 and rows > 1
+
+
+def test_lsh_bands_lower_threshold_gets_more_bands():
+    assert lsh_bands(0.5, 128)[0] > lsh_bands(0.9, 128)[0]
+
+
+def test_normalize_ignores_case_and_layout():
+    assert normalize("  Page\n 1 of\t3 ") == normalize("page 1 of 3")
+
+
+def test_exact_duplicates_are_dropped_and_recorded():
+    deduplicator = ChunkDeduplicator()
+    first = Document(page_content=TEXT, metadata={"source": "a.pdf"})
+    copy = Document(page_content=TEXT.upper(), metadata={"source": "b.pdf"})
+
+    assert deduplicator.add(first)
+    assert not deduplicator.add(copy)
+    assert deduplicator.n_exact == 1
+    assert deduplicator.take_duplicates() == {chunk_id(first): [{"source": "b.pdf"}]}
+    # handed over once
+    assert deduplicator.take_duplicates() == {}
+
+
+def test_near_duplicates_are_dropped_above_threshold():
+    deduplicator = ChunkDeduplicator(threshold=0.5)
+    near = TEXT.replace("downstream", "downstream every night")
+    other = "An unrelated paragraph about something else entirely, with new words."
+
+    assert deduplicator.add(Document(page_content=TEXT))
+    assert not deduplicator.add(Document(page_content=near))
+    assert deduplicator.add(Document(page_content=other))
+    assert (deduplicator.n_exact, deduplicator.n_near) == (0, 1)
+
+
+def test_seeded_chunks_drop_their_copies():
+    deduplicator = ChunkDeduplicator()
+
+    assert deduplicator.seed([(TEXT, "committed-id")]) == 1
+    assert not deduplicator.add(Document(page_content=TEXT, metadata={"page": 2}))
+    assert deduplicator.take_duplicates() == {"committed-id": [{"page": 2}]}
+
+
+def test_take_duplicates_holds_back_uncommitted_survivors():
+    deduplicator = ChunkDeduplicator()
+    first = Document(page_content="first chunk")
+    second = Document(page_content="second chunk")
+    for chunk in (first, second, first, second):
+        deduplicator.add(chunk)
+
+    assert list(deduplicator.take_duplicates(n_kept=1)) == [chunk_id(first)]
+    assert list(deduplicator.take_duplicates()) == [chunk_id(second)]
+
+
+def test_filter_keeps_new_chunks_with_their_items():
+    deduplicator = ChunkDeduplicator()
+    items = [(Document(page_content=text), i) for i, text in enumerate("aba")]
+
+    assert [item for _, item in deduplicator.filter(iter(items))] == [0, 1]
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+from embedding_cache import CachedEmbeddings, EmbeddingCache
+
+
+class CountingEmbeddings:
+    def __init__(self):
+        self.texts = []
+
+    def embed_documents(self, texts):
+        self.texts += texts
+        return [[float(len(text)), 1.0] for text in texts]
+
+    def embed_query(self, text):
+        self.texts.append(text)
+        return [float(len(text)), -1.0]
+
+
+def test_vectors_round_trip(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), "model")
+    keys = [cache.key("a"), cache.key("b")]
+    cache.put_many(keys, np.array([[1.0, 2.0], [3.0, 4.0]]))
+
+    found = cache.get_many(keys + [cache.key("c")])
+    assert found[keys[1]].tolist() == [3.0, 4.0]
+    assert cache.stats() == {"hits": 2, "misses": 1}
+
+
+def test_models_and_kinds_are_kept_apart(tmp_path):
+    assert EmbeddingCache.key("a", "query") != EmbeddingCache.key("a", "document")
+    assert (
+        EmbeddingCache(str(tmp_path), "model").path
+        != EmbeddingCache(str(tmp_path), "model", normalize=False).path
+    )
+
+
+def test_least_recently_used_vectors_are_evicted(tmp_path):
+    # room for two 2-d float32 vectors
+    cache = EmbeddingCache(str(tmp_path), "model", max_bytes=16)
+    a, b, c = (cache.key(text) for text in "abc")
+    cache.put_many([a, b], np.eye(2))
+    cache.get_many([a])
+    cache.put_many([c], np.ones((1, 2)))
+
+    assert set(cache.get_many([a, b, c])) == {a, c}
+
+
+def test_other_dimensions_are_rejected(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), "model")
+    cache.put_many([cache.key("a")], np.ones((1, 2)))
+
+    with pytest.raises(ValueError):
+        cache.put_many([cache.key("b")], np.ones((1, 3)))
+
+
+def test_cached_embeddings_only_embed_missing_texts_once(tmp_path):
+    model = CountingEmbeddings()
+    embeddings = CachedEmbeddings(model, EmbeddingCache(str(tmp_path), "model"))
+
+    first = embeddings.embed_documents(["a", "bb", "a"])
+    second = embeddings.embed_documents(["bb", "ccc"])
+    query = embeddings.embed_query("a")
+
+    assert first == [[1.0, 1.0], [2.0, 1.0], [1.0, 1.0]]
+    assert second == [[2.0, 1.0], [3.0, 1.0]]
+    # queries are cached apart from documents
+    assert query == [1.0, -1.0]
+    assert model.texts == ["a", "bb", "ccc", "a"]
+
+
+def test_cache_persists_across_instances(tmp_path):
+    EmbeddingCache(str(tmp_path), "model").put_many(["k"], np.ones((1, 2)))
+    reopened = EmbeddingCache(str(tmp_path), "model")
+
+    assert reopened.get_many(["k"])["k"].tolist() == [1.0, 1.0]
@@ -0,0 +1,32 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from latency import LatencyWindow
+
+
+def test_empty_window_has_no_percentiles():
+    assert LatencyWindow().stats() == {"n_queries": 0}
+
+
+def test_percentiles_over_the_last_searches_in_ms():
+    window = LatencyWindow(maxlen=100)
+    for ms in range(200):
+        window.record(ms / 1000)
+
+    stats = window.stats()
+    assert stats["n_queries"] == 100
+    assert stats["p50_ms"] == pytest.approx(149.5)
+    assert stats["p99_ms"] == pytest.approx(198.01)
+
+
+def test_stats_can_be_read_while_threads_record():
+    window = LatencyWindow(maxlen=1000)
+    with ThreadPoolExecutor(4) as executor:
+        recorded = [executor.submit(window.record, 0.001) for _ in range(20000)]
+        for _ in range(200):
+            window.stats()
+        for future in recorded:
+            future.result()
+
+    assert window.stats()["n_queries"] == 1000
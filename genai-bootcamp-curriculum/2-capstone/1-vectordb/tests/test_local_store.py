@@ -0,0 +1,96 @@
+import datetime
+from decimal import Decimal
+
+import pytest
+
+from local_store import LocalVectorStore
+
+
+class FixedEmbeddings:
+    """Embeds queries to a fixed vector per text."""
+
+    def __init__(self, vectors):
+        self.vectors = vectors
+
+    def embed_documents(self, texts):
+        return [self.vectors[text] for text in texts]
+
+    def embed_query(self, text):
+        return self.vectors[text]
+
+
+VECTORS = {"north": [1.0, 0.0], "east": [0.0, 1.0], "north-east": [1.0, 1.0]}
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = LocalVectorStore(str(tmp_path), FixedEmbeddings(VECTORS))
+    store.add_texts(
+        list(VECTORS),
+        metadatas=[{"page": 1}, {"page": 2}, {"page": 3}],
+        ids=["n", "e", "ne"],
+    )
+    return store
+
+
+def test_search_returns_cosine_distances_closest_first(store):
+    results = store.similarity_search_with_score("north", k=2)
+
+    assert [doc.page_content for doc, _ in results] == ["north", "north-east"]
+    assert results[0][1] == pytest.approx(0.0, abs=1e-6)
+    assert results[1][1] == pytest.approx(1 - 2**-0.5, abs=1e-6)
+
+
+def test_filter_restricts_the_search(store):
+    results = store.similarity_search("north", k=2, filter={"page": {"$gte": 2}})
+
+    assert [doc.page_content for doc in results] == ["north-east", "east"]
+
+
+def test_deleted_rows_are_not_returned_and_ids_can_be_reused(store):
+    store.delete(["n"])
+    assert "north" not in [d.page_content for d in store.similarity_search("north")]
+
+    store.add_embeddings(["north again"], [[1.0, 0.0]], ids=["n"])
+    assert store.similarity_search("north", k=1)[0].page_content == "north again"
+
+
+def test_adding_an_existing_id_replaces_it(store):
+    store.add_embeddings(["east v2"], [[0.0, 1.0]], ids=["e"])
+
+    assert [text for text, _ in store.iter_texts()] == [
+        "north",
+        "north-east",
+        "east v2",
+    ]
+
+
+def test_store_reopens_with_its_rows(store, tmp_path):
+    reopened = LocalVectorStore(str(tmp_path), FixedEmbeddings(VECTORS))
+
+    assert [id_ for _, id_ in reopened.iter_texts()] == ["n", "e", "ne"]
+    assert reopened.similarity_search("east", k=1)[0].page_content == "east"
+
+
+def test_extend_metadata_appends_to_lists(store):
+    store.extend_metadata({"n": {"duplicates": [{"page": 9}]}})
+    store.extend_metadata({"n": {"duplicates": [{"page": 10}]}})
+
+    doc = store.similarity_search("north", k=1)[0]
+    assert doc.metadata == {
+        "page": 1,
+        "duplicates": [{"page": 9}, {"page": 10}],
+    }
+
+
+def test_vectors_of_another_dimension_are_rejected(store):
+    with pytest.raises(ValueError):
+        store.add_embeddings(["3d"], [[1.0, 0.0, 0.0]])
+
+
+def test_metadata_json_has_no_type_for_is_stored_as_strings(store):
+    metadata = {"date": datetime.date(2024, 1, 31), "amount": Decimal("1.50")}
+    store.add_embeddings(["dated"], [[1.0, 0.5]], metadatas=[metadata], ids=["d"])
+
+    doc = store.similarity_search("north", k=1, filter={"amount": "1.50"})[0]
+    assert doc.metadata == {"date": "2024-01-31", "amount": "1.50"}
@@ -0,0 +1,82 @@
+import pytest
+
+from metadata_filter import compile_filter, matches, metadata_expression, parse_keys
+
+
+def test_equality_compiles_to_a_text_comparison():
+    where, params = compile_filter({"source": "a.pdf"})
+
+    assert where == "((cmetadata ->> 'source') = %(filter_0)s)"
+    assert params == {"filter_0": "a.pdf"}
+
+
+def test_numbers_compare_through_the_guarded_numeric_expression():
+    where, params = compile_filter({"page": {"$gte": 3, "$lt": 10}})
+
+    expression = metadata_expression("page", "numeric")
+    assert where == f"({expression} >= %(filter_0)s AND {expression} < %(filter_1)s)"
+    assert params == {"filter_0": 3, "filter_1": 10}
+    # text that is not a number reads as NULL instead of failing the cast
+    assert "CASE WHEN" in expression
+
+
+def test_generated_columns_replace_expressions():
+    where, _ = compile_filter({"page": 3}, {("page", "numeric"): "meta_page_num"})
+
+    assert where == "(meta_page_num = %(filter_0)s)"
+
+
+def test_combinations_and_membership():
+    where, params = compile_filter(
+        {"$or": [{"source": {"$in": ["a.pdf", "b.pdf"]}}, {"page": {"NIN": [1, 2]}}]}
+    )
+
+    assert " OR " in where and "= ANY(" in where and "NOT coalesce(" in where
+    assert params == {"filter_0": ["a.pdf", "b.pdf"], "filter_1": [1, 2]}
+
+
+def test_unknown_operators_are_rejected():
+    with pytest.raises(ValueError):
+        compile_filter({"page": {"$like": "1%"}})
+
+
+@pytest.mark.parametrize(
+    "filter, expected",
+    [
+        ({"source": "a.pdf"}, True),
+        ({"source": "b.pdf"}, False),
+        ({"page": {"$gte": 3, "$lt": 10}}, True),
+        ({"page": {"$between": [4, 9]}}, False),
+        ({"source": {"$in": ["a.pdf", "b.pdf"]}}, True),
+        ({"missing": {"$nin": ["x"]}}, True),
+        ({"missing": "x"}, False),
+        ({"$or": [{"source": "b.pdf"}, {"page": 3}]}, True),
+        ({"$and": [{"source": "a.pdf"}, {"page": 4}]}, False),
+        ({"draft": True}, True),
+        # a numeric filter never matches text that is not a number
+        ({"label": {"$gt": 0}}, False),
+        ({"count": {"$gt": 2}}, True),
+    ],
+)
+def test_matches_evaluates_like_sql(filter, expected):
+    metadata = {
+        "source": "a.pdf",
+        "page": 3,
+        "draft": True,
+        "label": "n/a",
+        "count": "5",
+    }
+
+    assert matches(metadata, filter) is expected
+
+
+def test_no_filter_matches_everything():
+    assert matches({}, None)
+
+
+def test_parse_keys():
+    assert parse_keys(["source", "page:numeric", "a:b"]) == [
+        ("source", "text"),
+        ("page", "numeric"),
+        ("a:b", "text"),
+    ]
@@ -0,0 +1,81 @@
+from query_cache import _MISSING, LRUCache, LRUEmbeddings, SemanticCache
+
+
+def test_lru_cache_evicts_the_least_recently_used():
+    cache = LRUCache(max_size=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.get("a")
+    cache.put("c", 3)
+
+    assert cache.get("b") is _MISSING
+    assert (cache.get("a"), cache.get("c")) == (1, 3)
+    assert cache.stats() == {"entries": 2, "hits": 3, "misses": 1}
+
+
+class CountingEmbeddings:
+    def __init__(self):
+        self.calls = 0
+
+    def embed_query(self, text):
+        self.calls += 1
+        return [float(len(text))]
+
+
+def test_lru_embeddings_skip_the_model_until_the_version_changes():
+    version = [1]
+    model = CountingEmbeddings()
+    embeddings = LRUEmbeddings(model, version=lambda: version[0])
+
+    embeddings.embed_query("question")
+    embeddings.embed_query("question")
+    assert model.calls == 1
+
+    version[0] = 2
+    embeddings.embed_query("question")
+    assert model.calls == 2
+
+
+def test_semantic_cache_matches_similar_questions_under_the_same_key():
+    cache = SemanticCache(threshold=0.9)
+    cache.put([1.0, 0.0], "answer", key="prompt")
+
+    value, similarity = cache.get([0.99, 0.1], key="prompt")
+    assert value == "answer" and similarity > 0.9
+    assert cache.get([0.99, 0.1], key="other prompt") is None
+    assert cache.get([0.0, 1.0], key="prompt") is None
+
+
+def test_semantic_cache_evicts_the_least_recently_hit():
+    cache = SemanticCache(threshold=0.99, max_size=2)
+    cache.put([1.0, 0.0], "x")
+    cache.put([0.0, 1.0], "y")
+    cache.get([1.0, 0.0])
+    cache.put([1.0, 1.0], "xy")
+
+    assert cache.get([0.0, 1.0]) is None
+    assert cache.get([1.0, 0.0])[0] == "x"
+    assert cache.stats()["evicted"] == 1
+
+
+def test_semantic_cache_expires_entries(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("query_cache.time.monotonic", lambda: now[0])
+    cache = SemanticCache(ttl=10)
+    cache.put([1.0], "answer")
+
+    now[0] = 105.0
+    assert cache.get([1.0]) is not None
+    now[0] = 111.0
+    assert cache.get([1.0]) is None
+    assert cache.stats()["expired"] == 1
+
+
+def test_semantic_cache_is_dropped_on_a_new_version():
+    version = [1]
+    cache = SemanticCache(version=lambda: version[0])
+    cache.put([1.0], "answer")
+
+    version[0] = 2
+    assert cache.get([1.0]) is None
+    assert cache.stats()["invalidations"] == 1
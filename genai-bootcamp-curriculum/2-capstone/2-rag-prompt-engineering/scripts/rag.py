@@ -1,65 +1,273 @@
-from typing import List, Dict
+import gc
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
 
-from langchain.vectorstores.pgvector import PGVector
 from operator import itemgetter
 from langchain.schema import StrOutputParser
 from langchain.prompts import PromptTemplate
 from langchain.schema.runnable import RunnablePassthrough
 from langchain.schema.runnable import RunnableParallel
+from langchain.schema.runnable import RunnableLambda
 from langchain.llms.huggingface_pipeline import HuggingFacePipeline
+from langchain_core.documents import Document
 
 from langchain.embeddings.sentence_transformer import SentenceTransformerEmbeddings
 import torch
 from transformers import AutoModelForCausalLM, AutoTokenizer, pipeline
 
-CONNECTION_STRING = PGVector.connection_string_from_db_params(
-    driver="psycopg2",
-    host="localhost",
-    port="5432",
-    database="postgres",
-    user="username",
-    password="password",
+from registry import REGISTRY
+
+# reuse the vector db helpers from the 1-vectordb lab
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../1-vectordb/scripts")
 )
+from bm25_index import BM25Index
+from context_packer import pack_context
+from db_config import CONNECTION_STRING
+from devices import resolve_device
+from embedding_cache import with_embedding_cache
+from hybrid_search import HybridSearch
+from local_store import LocalVectorStore
+from metadata_filter import FilteredPGVector
+from pipeline import batched
+from query_cache import CachedPGVector, CollectionVersion, LRUEmbeddings, SemanticCache
+from query_documents import read_queries
+from reduction import with_collection_reducer
+from reranker import DEFAULT_RERANKER, CrossEncoderReranker, RerankedSearch
+from retrieval_service import RetrievalService
 
 
-def format_docs(docs: List[str]) -> str:
-    return "\n\n".join(doc.page_content for doc in docs)
+def load_tokenizer(model_id: str):
+    return REGISTRY.get(
+        ("tokenizer", model_id), lambda: AutoTokenizer.from_pretrained(model_id)
+    )
 
 
-def build_rag_pipeline(
-    model_id: str = "mistralai/Mistral-7B-Instruct-v0.1", k: int = 1
-):
-    model_path_or_id = model_id
-    tokenizer = AutoTokenizer.from_pretrained(model_path_or_id)
-    model = AutoModelForCausalLM.from_pretrained(
-        model_path_or_id,
-        low_cpu_mem_usage=True,
-        torch_dtype=torch.float16,
-        bnb_4bit_compute_dtype=torch.float16,
-        use_flash_attention_2=True,
-        load_in_4bit=True,
+def load_llm(model_id: str):
+    return REGISTRY.get(
+        ("llm", model_id),
+        lambda: AutoModelForCausalLM.from_pretrained(
+            model_id,
+            low_cpu_mem_usage=True,
+            torch_dtype=torch.float16,
+            bnb_4bit_compute_dtype=torch.float16,
+            use_flash_attention_2=True,
+            load_in_4bit=True,
+        ),
     )
 
-    embedding_function = SentenceTransformerEmbeddings(
-        model_name="BAAI/bge-large-en-v1.5",
-        model_kwargs={"device": "cuda"},
-        encode_kwargs={"normalize_embeddings": True},
+
+def load_generation_pipeline(model_id: str) -> HuggingFacePipeline:
+    # loaded first, so that each component's load time is its own
+    model, tokenizer = load_llm(model_id), load_tokenizer(model_id)
+    return REGISTRY.get(
+        ("pipeline", model_id),
+        lambda: HuggingFacePipeline(
+            pipeline=pipeline(
+                "text-generation", model=model, tokenizer=tokenizer, max_new_tokens=100
+            )
+        ),
     )
 
-    db = PGVector(
-        connection_string=CONNECTION_STRING,
-        collection_name="embeddings",
-        embedding_function=embedding_function,
+
+def load_collection_version() -> CollectionVersion:
+    # what caches and reducers of the Postgres collection follow to notice
+    # a rebuild, add or sync
+    return REGISTRY.get(
+        ("collection_version",),
+        lambda: CollectionVersion(CONNECTION_STRING, "embeddings"),
     )
 
-    retriever = db.as_retriever(search_kwargs={"k": k})
-    pipe = pipeline(
-        "text-generation", model=model, tokenizer=tokenizer, max_new_tokens=100
+
+def load_embeddings(
+    embedding_device: Optional[str] = None,
+    embedding_cache_dir: Optional[str] = None,
+    reduced: bool = True,
+):
+    device = resolve_device(embedding_device)
+    model = REGISTRY.get(
+        ("embedding_model", device),
+        lambda: SentenceTransformerEmbeddings(
+            model_name="BAAI/bge-large-en-v1.5",
+            model_kwargs={"device": device},
+            encode_kwargs={"normalize_embeddings": True},
+        ),
     )
-    llm = HuggingFacePipeline(pipeline=pipe)
 
-    prompt_template = PromptTemplate.from_template(
-        """
+    # kept for the life of the process, so the reducer is read again, and
+    # cached queries dropped, when a rebuild changes the collection
+    version = load_collection_version().current if reduced else None
+
+    def load():
+        embedding_function = with_embedding_cache(model, embedding_cache_dir)
+        if reduced:
+            # project queries like the stored embeddings, if they were reduced
+            embedding_function = with_collection_reducer(
+                embedding_function, CONNECTION_STRING, version=version
+            )
+        # the answer cache and the search embed the same question, the
+        # second time is a lookup
+        return LRUEmbeddings(embedding_function, max_size=1000, version=version)
+
+    return REGISTRY.get(("embeddings", device, embedding_cache_dir, reduced), load)
+
+
+def load_retrieval(
+    embedding_cache_dir: Optional[str] = None,
+    embedding_device: Optional[str] = None,
+    query_cache_size: int = 0,
+    local_store: Optional[str] = None,
+    bm25_index: Optional[str] = None,
+    rerank_model: Optional[str] = None,
+    rerank_candidates: int = 20,
+    max_rerank_ms: Optional[float] = None,
+):
+    """The search of a pipeline: a vector store, fused with BM25 and
+    reranked if asked, built once per process for the same settings.
+
+    :return: object with `similarity_search` and, with BM25 or reranking,
+        `stats`
+    """
+    embedding_function = load_embeddings(
+        embedding_device, embedding_cache_dir, reduced=local_store is None
+    )
+    reranker = None
+    if rerank_model is not None:
+        reranker = REGISTRY.get(
+            ("reranker", rerank_model, embedding_device),
+            lambda: CrossEncoderReranker(rerank_model, device=embedding_device),
+        )
+
+    def load():
+        if local_store is not None:
+            # searched in-process, no database involved
+            db = LocalVectorStore(local_store, embedding_function)
+        elif query_cache_size:
+            # repeated questions skip the model and the table scan
+            db = CachedPGVector(
+                connection_string=CONNECTION_STRING,
+                collection_name="embeddings",
+                embedding_function=embedding_function,
+                max_results=query_cache_size,
+                max_embeddings=query_cache_size,
+            )
+        else:
+            # metadata filters run as (indexed) predicates of the vector query
+            db = FilteredPGVector(
+                connection_string=CONNECTION_STRING,
+                collection_name="embeddings",
+                embedding_function=embedding_function,
+            )
+
+        if bm25_index is not None:
+            # exact table names and acronyms are found without raising k
+            db = HybridSearch(db, BM25Index(bm25_index))
+
+        if reranker is not None:
+            # over-fetch and keep the k candidates the cross-encoder ranks best
+            db = RerankedSearch(
+                db,
+                reranker,
+                candidates=rerank_candidates,
+                max_rerank_ms=max_rerank_ms,
+            )
+        return db
+
+    return REGISTRY.get(
+        (
+            "retrieval",
+            embedding_cache_dir,
+            resolve_device(embedding_device),
+            query_cache_size,
+            local_store,
+            bm25_index,
+            rerank_model,
+            rerank_candidates,
+            max_rerank_ms,
+        ),
+        load,
+    )
+
+
+def load_answer_cache(
+    max_size: int = 1000,
+    threshold: float = 0.95,
+    ttl: Optional[float] = None,
+    **retrieval_kwargs,
+) -> SemanticCache:
+    """The answers of recent questions, shared by every pipeline searching
+    the same store and invalidated when it changes.
+
+    :param max_size: answers kept
+    :type max_size: int, optional
+    :param threshold: cosine similarity from which a question gets the
+        answer of a cached one
+    :type threshold: float, optional
+    :param ttl: seconds an answer is kept, forever if not set
+    :type ttl: Optional[float], optional
+    :param retrieval_kwargs: retrieval settings of `build_rag_pipeline`
+    :return: the cache
+    :rtype: SemanticCache
+    """
+    local_store = retrieval_kwargs.get("local_store")
+
+    def load():
+        if local_store is not None:
+            store = load_retrieval(**retrieval_kwargs)
+            # under the BM25 fusion and the reranking
+            while hasattr(store, "vectorstore"):
+                store = store.vectorstore
+            version = store.version
+        else:
+            version = load_collection_version().current
+        return SemanticCache(threshold, max_size, ttl, version)
+
+    return REGISTRY.get(("answer_cache", max_size, threshold, ttl, local_store), load)
+
+
+def warmup(model_id: str = "mistralai/Mistral-7B-Instruct-v0.1", **retrieval_kwargs):
+    """Load every component of a pipeline and run each once, so that the
+    first question is not the one paying for it.
+
+    :param model_id: generation model
+    :type model_id: str, optional
+    :param retrieval_kwargs: retrieval settings of `build_rag_pipeline`
+    :return: load times, see `Registry.stats`
+    :rtype: Dict
+    """
+    load_retrieval(**retrieval_kwargs).similarity_search("warmup", k=1)
+    load_tokenizer(model_id)
+    load_generation_pipeline(model_id).pipeline("warmup", max_new_tokens=1)
+    return REGISTRY.stats()
+
+
+def unload(kind: Optional[str] = None) -> int:
+    """Drop loaded components, e.g. "llm" to free the GPU for another model.
+
+    Pipelines built before keep working and load what they need again.
+
+    :param kind: "tokenizer", "llm", "pipeline", "embedding_model",
+        "embeddings", "reranker", "retrieval" or "answer_cache", everything
+        by default
+    :type kind: Optional[str], optional
+    :return: number of components dropped
+    :rtype: int
+    """
+    if kind in (None, "llm"):
+        # the pipeline holds the model
+        REGISTRY.unload("pipeline")
+    n_unloaded = REGISTRY.unload(kind)
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    return n_unloaded
+
+
+DEFAULT_PROMPT = """
         Answer the question using only this context:
         
         Context: {context}
@@ -68,11 +276,63 @@ def build_rag_pipeline(
         
         Answer: 
         """
+
+
+def build_rag_pipeline(
+    model_id: str = "mistralai/Mistral-7B-Instruct-v0.1",
+    k: int = 1,
+    embedding_cache_dir: Optional[str] = None,
+    embedding_device: Optional[str] = None,
+    query_cache_size: int = 0,
+    local_store: Optional[str] = None,
+    bm25_index: Optional[str] = None,
+    search_filter: Optional[Dict] = None,
+    rerank_model: Optional[str] = None,
+    rerank_candidates: int = 20,
+    max_rerank_ms: Optional[float] = None,
+    prompt: str = DEFAULT_PROMPT,
+    max_context_tokens: int = 1024,
+    answer_cache_size: int = 0,
+    answer_cache_threshold: float = 0.95,
+    answer_cache_ttl: Optional[float] = None,
+):
+    # Models, tokenizer and database connections come from the process-wide
+    # registry, loaded on the first question, so building a chain is cheap
+    # and chains differing only in k, filter or prompt share them
+    retrieval_kwargs = dict(
+        embedding_cache_dir=embedding_cache_dir,
+        embedding_device=embedding_device,
+        query_cache_size=query_cache_size,
+        local_store=local_store,
+        bm25_index=bm25_index,
+        rerank_model=rerank_model,
+        rerank_candidates=rerank_candidates,
+        max_rerank_ms=max_rerank_ms,
+    )
+    search_kwargs = {"k": k}
+    if search_filter:
+        search_kwargs["filter"] = search_filter
+
+    retriever = RunnableLambda(
+        lambda question: load_retrieval(**retrieval_kwargs).similarity_search(
+            question, **search_kwargs
+        )
+    )
+    llm = RunnableLambda(
+        lambda prompt_value: load_generation_pipeline(model_id).invoke(prompt_value)
     )
 
+    def pack(input: Dict):
+        # deduplicated, best first and cut to the budget in the model's tokens
+        return pack_context(
+            input["documents"], load_tokenizer(model_id), max_context_tokens
+        )
+
+    prompt_template = PromptTemplate.from_template(prompt)
+
     rag_chain_from_docs = (
         {
-            "context": lambda input: format_docs(input["documents"]),
+            "context": lambda input: input["packed"][0],
             "question": itemgetter("question"),
         }
         | prompt_template
@@ -80,15 +340,263 @@ def build_rag_pipeline(
         | StrOutputParser()
     )
 
-    rag_chain_with_source = RunnableParallel(
-        {"documents": retriever, "question": RunnablePassthrough()}
-    ) | {
+    outputs = {
         "sources": lambda input: [
             (doc.page_content, doc.metadata) for doc in input["documents"]
         ],
         "answer": rag_chain_from_docs,
+        "context_stats": lambda input: input["packed"][1],
     }
-    return rag_chain_with_source
+    if rerank_model is not None:
+        # time spent retrieving and reranking, reported with the answer
+        outputs["retrieval_stats"] = lambda input: load_retrieval(
+            **retrieval_kwargs
+        ).stats()
+
+    rag_chain_with_source = (
+        RunnableParallel({"documents": retriever, "question": RunnablePassthrough()})
+        | RunnablePassthrough.assign(packed=pack)
+        | outputs
+    )
+    if not answer_cache_size:
+        return rag_chain_with_source
+
+    # paraphrases of an answered question skip retrieval and generation; an
+    # answer only serves chains that would have produced it
+    cache_key = (
+        model_id,
+        k,
+        json.dumps(search_filter, sort_keys=True, default=str),
+        prompt,
+        max_context_tokens,
+        tuple(sorted(retrieval_kwargs.items())),
+    )
+
+    def answer(question: str) -> Dict:
+        cache = load_answer_cache(
+            answer_cache_size,
+            answer_cache_threshold,
+            answer_cache_ttl,
+            **retrieval_kwargs,
+        )
+        # the search embeds the question with the same function, which
+        # then has it cached
+        embedding = load_embeddings(
+            embedding_device, embedding_cache_dir, reduced=local_store is None
+        ).embed_query(question)
+        cached = cache.get(embedding, cache_key)
+        if cached is not None:
+            (result, cached_question), similarity = cached
+            return {
+                **result,
+                "answer_cache": {
+                    "hit": True,
+                    "question": cached_question,
+                    "similarity": similarity,
+                },
+            }
+        result = rag_chain_with_source.invoke(question)
+        cache.put(embedding, (result, question), cache_key)
+        return {**result, "answer_cache": {"hit": False}}
+
+    return RunnableLambda(answer)
+
+
+def retrieve_batch(
+    questions: List[str],
+    k: int,
+    executor: ThreadPoolExecutor,
+    concurrency: int = 8,
+    search_filter: Optional[Dict] = None,
+    **retrieval_kwargs,
+) -> List[List[Document]]:
+    """Retrieve the documents of many questions at once.
+
+    A plain Postgres search goes through a `RetrievalService`: the questions
+    are embedded in one batch and searched concurrently over its pooled
+    connections. Other settings (local store, BM25, reranking, query cache)
+    search their store concurrently, one question per thread.
+
+    :param questions: questions to retrieve for
+    :type questions: List[str]
+    :param k: documents per question
+    :type k: int
+    :param executor: threads the searches run on
+    :type executor: ThreadPoolExecutor
+    :param concurrency: database connections the searches share
+    :type concurrency: int, optional
+    :param search_filter: metadata filter of every question
+    :type search_filter: Optional[Dict], optional
+    :param retrieval_kwargs: retrieval settings of `build_rag_pipeline`
+    :return: the documents of each question, in question order
+    :rtype: List[List[Document]]
+    """
+    plain = not any(
+        retrieval_kwargs.get(name)
+        for name in ("local_store", "bm25_index", "rerank_model", "query_cache_size")
+    )
+    if plain:
+        embedding_cache_dir = retrieval_kwargs.get("embedding_cache_dir")
+        device = resolve_device(retrieval_kwargs.get("embedding_device"))
+        # follows the collection across rebuilds, see `RetrievalService`
+        service = REGISTRY.get(
+            ("retrieval_service", embedding_cache_dir, device, concurrency),
+            lambda: RetrievalService(
+                embedding_cache_dir=embedding_cache_dir,
+                device=device,
+                pool_size=concurrency,
+            ),
+        )
+        results = service.search_batch(questions, k, executor, filter=search_filter)
+        return [[doc for doc, _ in question_results] for question_results in results]
+
+    db = load_retrieval(**retrieval_kwargs)
+    search_kwargs = {"k": k}
+    if search_filter:
+        search_kwargs["filter"] = search_filter
+    return list(
+        executor.map(
+            lambda question: db.similarity_search(question, **search_kwargs), questions
+        )
+    )
+
+
+def generate_batch(
+    model_id: str, prompts: List[str], batch_size: int = 8, max_new_tokens: int = 100
+) -> List[str]:
+    """Generate the answers of many prompts in padded batches.
+
+    Prompts are sorted by token length before being batched, so each batch
+    is padded to a length close to that of all its prompts instead of the
+    longest prompt of a random few.
+
+    :param model_id: generation model
+    :type model_id: str
+    :param prompts: prompts to complete
+    :type prompts: List[str]
+    :param batch_size: prompts generated at once
+    :type batch_size: int, optional
+    :param max_new_tokens: tokens generated per prompt
+    :type max_new_tokens: int, optional
+    :return: the generated text of each prompt, without the prompt, in
+        prompt order
+    :rtype: List[str]
+    """
+    model, tokenizer = load_llm(model_id), load_tokenizer(model_id)
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    # a decoder-only model continues from the end of the prompt
+    tokenizer.padding_side = "left"
+
+    lengths = [len(ids) for ids in tokenizer(prompts)["input_ids"]]
+    order = sorted(range(len(prompts)), key=lambda i: lengths[i])
+    answers = [""] * len(prompts)
+    for start in range(0, len(order), batch_size):
+        batch = order[start : start + batch_size]
+        inputs = tokenizer(
+            [prompts[i] for i in batch], return_tensors="pt", padding=True
+        ).to(model.device)
+        with torch.no_grad():
+            outputs = model.generate(
+                **inputs,
+                max_new_tokens=max_new_tokens,
+                pad_token_id=tokenizer.pad_token_id,
+            )
+        generated = outputs[:, inputs["input_ids"].shape[1] :]
+        for i, text in zip(
+            batch, tokenizer.batch_decode(generated, skip_special_tokens=True)
+        ):
+            answers[i] = text
+    return answers
+
+
+def answer_questions_file(
+    questions_file: str,
+    output: str = "-",
+    model_id: str = "mistralai/Mistral-7B-Instruct-v0.1",
+    k: int = 1,
+    batch_size: int = 8,
+    retrieval_batch_size: int = 256,
+    concurrency: int = 8,
+    max_new_tokens: int = 100,
+    search_filter: Optional[Dict] = None,
+    prompt: str = DEFAULT_PROMPT,
+    max_context_tokens: int = 1024,
+    **retrieval_kwargs,
+):
+    """Answer every question of a file, writing the answers as JSONL.
+
+    Questions are read `retrieval_batch_size` at a time. The documents of a
+    batch are retrieved together (see `retrieve_batch`), packed into
+    prompts, and the answers generated `batch_size` prompts at a time (see
+    `generate_batch`). Each batch is written as soon as it is answered, in
+    input order.
+
+    :param questions_file: .jsonl or .csv file with a "query" per question,
+        see `query_documents.read_queries`
+    :type questions_file: str
+    :param output: JSONL file to write, "-" for stdout
+    :type output: str, optional
+    :param model_id: generation model
+    :type model_id: str, optional
+    :param k: documents retrieved per question
+    :type k: int, optional
+    :param batch_size: prompts generated at once
+    :type batch_size: int, optional
+    :param retrieval_batch_size: questions read and retrieved at once
+    :type retrieval_batch_size: int, optional
+    :param concurrency: searches run at once
+    :type concurrency: int, optional
+    :param max_new_tokens: tokens generated per answer
+    :type max_new_tokens: int, optional
+    :param search_filter: metadata filter of every question
+    :type search_filter: Optional[Dict], optional
+    :param prompt: prompt template with {context} and {question}
+    :type prompt: str, optional
+    :param max_context_tokens: token budget of each context
+    :type max_context_tokens: int, optional
+    :param retrieval_kwargs: retrieval settings of `build_rag_pipeline`
+    """
+    prompt_template = PromptTemplate.from_template(prompt)
+    out = sys.stdout if output == "-" else open(output, "w")
+
+    start_time = time.time()
+    n_questions = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for records in batched(read_queries(questions_file), retrieval_batch_size):
+            questions = [record["query"] for record in records]
+            documents = retrieve_batch(
+                questions, k, executor, concurrency, search_filter, **retrieval_kwargs
+            )
+            tokenizer = load_tokenizer(model_id)
+            prompts = []
+            for record, question, docs in zip(records, questions, documents):
+                context, record["context_stats"] = pack_context(
+                    docs, tokenizer, max_context_tokens
+                )
+                record["sources"] = [
+                    {"page_content": doc.page_content, "metadata": doc.metadata}
+                    for doc in docs
+                ]
+                prompts.append(
+                    prompt_template.format(context=context, question=question)
+                )
+            answers = generate_batch(model_id, prompts, batch_size, max_new_tokens)
+            for record, answer in zip(records, answers):
+                record["answer"] = answer
+                out.write(json.dumps(record) + "\n")
+            out.flush()
+            n_questions += len(records)
+    seconds = time.time() - start_time
+
+    if out is not sys.stdout:
+        out.close()
+    # stdout may be the answers, so report on stderr
+    print(
+        f"Answered {n_questions} questions in {seconds:.1f}s: "
+        f"{n_questions / seconds:.2f} questions/s.",
+        file=sys.stderr,
+    )
 
 
 if __name__ == "__main__":
@@ -101,17 +609,177 @@ if __name__ == "__main__":
         default="mistralai/Mistral-7B-Instruct-v0.1",
         help="pretrained model id to use for generation",
     )
-    parser.add_argument("--query", type=str, required=True, help="query")
+    questions = parser.add_mutually_exclusive_group(required=True)
+    questions.add_argument("--query", type=str, help="query")
+    questions.add_argument(
+        "--questions_file",
+        type=str,
+        help="JSONL or CSV file of questions to answer in batches",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default="-",
+        help="JSONL file the --questions_file answers are written to, - for stdout",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=8,
+        help="--questions_file prompts generated at once",
+    )
+    parser.add_argument(
+        "--retrieval_batch_size",
+        type=int,
+        default=256,
+        help="--questions_file questions embedded and searched at once",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=8,
+        help="--questions_file searches run at once",
+    )
     parser.add_argument(
         "--top_k",
         type=int,
         default=1,
         help="how many documents to stuff in the rag prompt",
     )
+    parser.add_argument(
+        "--embedding_cache_dir",
+        type=str,
+        default=None,
+        help="directory of the on-disk embedding cache, disabled if not set",
+    )
+
+    parser.add_argument(
+        "--embedding_device",
+        type=str,
+        default=None,
+        help="device to embed queries on, autodetected by default",
+    )
+
+    parser.add_argument(
+        "--query_cache_size",
+        type=int,
+        default=0,
+        help="questions whose embeddings and search results are cached, 0 disables",
+    )
+
+    parser.add_argument(
+        "--local_store",
+        type=str,
+        default=None,
+        help="search the in-process store in this directory instead of Postgres",
+    )
+
+    parser.add_argument(
+        "--bm25_index",
+        type=str,
+        default=None,
+        help="BM25 index built by embed_documents.py, fused with the vector search",
+    )
+
+    parser.add_argument(
+        "--filter",
+        type=json.loads,
+        default=None,
+        help="metadata filter of the retrieved documents as JSON, "
+        'e.g. \'{"source": {"in": ["a.pdf"]}}\'',
+    )
+
+    parser.add_argument(
+        "--rerank",
+        nargs="?",
+        const=DEFAULT_RERANKER,
+        default=None,
+        help="rerank retrieved documents with this cross-encoder, "
+        f"{DEFAULT_RERANKER} if none is given",
+    )
+
+    parser.add_argument(
+        "--rerank_candidates",
+        type=int,
+        default=20,
+        help="documents retrieved and rescored with --rerank to keep --top_k",
+    )
+
+    parser.add_argument(
+        "--max_rerank_ms",
+        type=float,
+        default=None,
+        help="time --rerank may take before keeping the vector order, unlimited "
+        "if not set",
+    )
+
+    parser.add_argument(
+        "--max_context_tokens",
+        type=int,
+        default=1024,
+        help="tokens of the generation model the retrieved context may take",
+    )
 
     args = parser.parse_args()
 
+    retrieval_kwargs = dict(
+        embedding_cache_dir=args.embedding_cache_dir,
+        embedding_device=args.embedding_device,
+        query_cache_size=args.query_cache_size,
+        local_store=args.local_store,
+        bm25_index=args.bm25_index,
+        rerank_model=args.rerank,
+        rerank_candidates=args.rerank_candidates,
+        max_rerank_ms=args.max_rerank_ms,
+    )
+
+    if args.questions_file is not None:
+        answer_questions_file(
+            args.questions_file,
+            output=args.output,
+            model_id=args.generation_llm,
+            k=args.top_k,
+            batch_size=args.batch_size,
+            retrieval_batch_size=args.retrieval_batch_size,
+            concurrency=args.concurrency,
+            search_filter=args.filter,
+            max_context_tokens=args.max_context_tokens,
+            **retrieval_kwargs,
+        )
+        sys.exit()
+
     # query it
-    rag_chain = build_rag_pipeline(model_id=args.generation_llm, k=args.k)
+    rag_chain = build_rag_pipeline(
+        model_id=args.generation_llm,
+        k=args.top_k,
+        search_filter=args.filter,
+        max_context_tokens=args.max_context_tokens,
+        **retrieval_kwargs,
+    )
+    # load everything up front, so the answer time below is steady state
+    load_stats = warmup(args.generation_llm, **retrieval_kwargs)
+    print(
+        f"loaded in {load_stats['load_seconds']:.1f}s: "
+        + ", ".join(
+            f"{name} {seconds:.1f}s" for name, seconds in load_stats["loaded"].items()
+        )
+    )
+    start = time.time()
     res = rag_chain.invoke(args.query)
+    seconds = time.time() - start
     print(res["answer"])
+    context_stats = res["context_stats"]
+    print(
+        f"context: {context_stats['tokens']} tokens from "
+        f"{context_stats['docs_used']} of {context_stats['docs']} documents "
+        f"({context_stats['duplicates']} duplicates), "
+        f"{context_stats['tokens_saved']} tokens saved"
+    )
+    if "retrieval_stats" in res:
+        stats = res["retrieval_stats"]
+        print(
+            f"retrieve {stats['retrieve']['p50_ms']:.1f}ms, "
+            f"rerank {stats['rerank'].get('p50_ms', 0.0):.1f}ms"
+            f"{' (kept the vector order)' if stats['fallbacks'] else ''}, "
+            f"answered in {seconds:.2f}s"
+        )
@@ -0,0 +1,93 @@
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+
+class Registry:
+    """A process-wide cache of heavy components (models, tokenizers, vector
+    store connections), each built once, on first use, and shared by every
+    caller asking for it with the same settings.
+
+    Components are keyed by a tuple whose first item is their kind, e.g.
+    `("llm", model_id)`, so they can be unloaded by kind. Loading is timed,
+    and concurrent callers asking for a component being loaded wait for it
+    instead of loading it twice.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loading: Dict[Tuple, threading.Lock] = {}
+        self.components: Dict[Tuple, Any] = {}
+        self.load_seconds: Dict[Tuple, float] = {}
+        self.hits = self.misses = 0
+
+    def get(self, key: Tuple[Hashable, ...], load: Callable[[], Any]) -> Any:
+        """The component of `key`, loaded with `load` if it is not already.
+
+        :param key: kind of the component, then every setting it depends on
+        :type key: Tuple[Hashable, ...]
+        :param load: builds the component
+        :type load: Callable[[], Any]
+        :return: the component
+        :rtype: Any
+        """
+        with self._lock:
+            if key in self.components:
+                self.hits += 1
+                return self.components[key]
+            key_lock = self._loading.setdefault(key, threading.Lock())
+
+        with key_lock:
+            with self._lock:
+                if key in self.components:
+                    self.hits += 1
+                    return self.components[key]
+            start = time.perf_counter()
+            component = load()
+            with self._lock:
+                self.misses += 1
+                self.components[key] = component
+                self.load_seconds[key] = time.perf_counter() - start
+                self._loading.pop(key, None)
+            return component
+
+    def unload(self, kind: Optional[str] = None) -> int:
+        """Drop components, closing those that can be closed.
+
+        :param kind: kind of the components to drop, all of them by default
+        :type kind: Optional[str], optional
+        :return: number of components dropped
+        :rtype: int
+        """
+        with self._lock:
+            keys = [key for key in self.components if kind in (None, key[0])]
+            dropped = [self.components.pop(key) for key in keys]
+            for key in keys:
+                self.load_seconds.pop(key, None)
+        for component in dropped:
+            if callable(getattr(component, "close", None)):
+                component.close()
+        return len(dropped)
+
+    def stats(self) -> Dict:
+        """Loaded components with their load time, and cache hits and misses.
+
+        :return: {"loaded": {name: seconds}, "load_seconds": total, "hits": int,
+            "misses": int}
+        :rtype: Dict
+        """
+        with self._lock:
+            loaded = {
+                " ".join(str(part) for part in key if part is not None): seconds
+                for key, seconds in self.load_seconds.items()
+            }
+            return {
+                "loaded": loaded,
+                "load_seconds": sum(loaded.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+# shared by every pipeline of the process
+REGISTRY = Registry()